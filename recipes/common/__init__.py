@@ -0,0 +1,15 @@
+"""Helpers shared by all of the recipes.
+
+Each recipe is its own pulumi project, so the ``__main__.py`` of a recipe puts
+the ``recipes`` directory on ``sys.path`` before importing from here.
+"""
+
+import os
+from pathlib import Path
+
+# Local cache used by the helpers (templates, artifacts, ...). Override with the
+# PULUMI_RECIPES_CACHE environment variable.
+CACHE_DIR = Path(os.getenv("PULUMI_RECIPES_CACHE", "~/.cache/pulumi-recipes")).expanduser()
+
+# Scripts that are copied to the servers (they only use the standard library).
+SERVER_FILES_DIR = Path(__file__).resolve().parent / "server"
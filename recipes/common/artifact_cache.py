@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""The deployer side artifact cache, and the command that fills it.
+
+Used by common/artifacts.py, which runs this file through `local.Command`
+for every artifact, so files are only downloaded during `pulumi up` (never
+during `pulumi preview`). Prints the sha256 of the artifact and its path,
+with the home directory as `~` so the output is the same on every machine:
+
+    python3 artifact_cache.py <url> [<sha256>]
+
+Nothing is downloaded when the file is already cached. A download is
+verified against <sha256> when it is given. The files are kept
+in $PULUMI_RECIPES_CACHE/artifacts, each with a `<file>.sha256.json` that
+records its checksum. Only the python standard library is used.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import urllib.request
+from pathlib import Path
+from typing import Iterable, Optional, Set
+
+DEFAULT_DIR = Path(os.getenv("PULUMI_RECIPES_CACHE", "~/.cache/pulumi-recipes")).expanduser() / "artifacts"
+
+
+def filename(url: str) -> str:
+    return url.rsplit("/", 1)[-1]
+
+
+def display_path(path: Path) -> str:
+    """`path` with the home directory as `~`."""
+    try:
+        return str(Path("~") / path.relative_to(Path.home()))
+    except ValueError:
+        return str(path)
+
+
+class ArtifactCache:
+    """A checksum verified, size bounded (LRU) download cache."""
+
+    def __init__(self, directory: Path = DEFAULT_DIR, max_bytes: int = 4 * 1024**3):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        # The files used by this run, never evicted by it.
+        self.in_use: Set[str] = set()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, url: str) -> Path:
+        return self.directory / filename(url)
+
+    def use(self, urls: Iterable[str]):
+        """Mark the files of `urls` as used by this run."""
+        for url in urls:
+            path = self.path(url)
+            self.in_use.add(path.name)
+            # Access time is unreliable (noatime mounts), so the mtime of the
+            # checksum file records when the artifact was last used.
+            if self.cached_sha256(path) is not None:
+                os.utime(self._meta_path(path))
+
+    def fetch(self, url: str, sha256: Optional[str] = None) -> str:
+        """Download `url` unless it is cached, and return its checksum."""
+        path = self.path(url)
+        cached = self.cached_sha256(path)
+        if cached is None:
+            cached = self._download(url, path)
+        if sha256 and cached != sha256:
+            path.unlink()
+            self._meta_path(path).unlink()
+            raise ValueError(f"Checksum mismatch for {url}: expected {sha256}, got {cached}")
+        os.utime(self._meta_path(path))
+        return cached
+
+    def cached_sha256(self, path: Path) -> Optional[str]:
+        """Checksum recorded for `path`, or None if it is missing or changed."""
+        meta_path = self._meta_path(path)
+        if not path.exists() or not meta_path.exists():
+            return None
+        meta = json.loads(meta_path.read_text())
+        stat = path.stat()
+        if (stat.st_size, stat.st_mtime_ns) != (meta["size"], meta["mtime_ns"]):
+            return None
+        return meta["sha256"]
+
+    def evict(self):
+        """Delete the least recently used artifacts until the cache fits.
+
+        The files in `in_use` are kept even when they alone are too big.
+        """
+        entries = []
+        for meta in self.directory.glob("*.sha256.json"):
+            path = self.directory / meta.name[:-len(".sha256.json")]
+            if not path.exists():
+                meta.unlink()
+                continue
+            entries.append((meta.stat().st_mtime, path.stat().st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path.name in self.in_use:
+                continue
+            path.unlink()
+            self._meta_path(path).unlink()
+            total -= size
+
+    def _download(self, url: str, path: Path) -> str:
+        print(f"Downloading {url} to the artifact cache", file=sys.stderr, flush=True)
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.directory, prefix=f".{path.name}.", delete=False) as tmp:
+            try:
+                with urllib.request.urlopen(url, timeout=60) as response:
+                    while chunk := response.read(1024 * 1024):
+                        digest.update(chunk)
+                        tmp.write(chunk)
+            except BaseException:
+                tmp.close()
+                os.unlink(tmp.name)
+                raise
+        shutil.move(tmp.name, path)
+        stat = path.stat()
+        sha256 = digest.hexdigest()
+        self._meta_path(path).write_text(json.dumps(
+            {"sha256": sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        ))
+        return sha256
+
+    @staticmethod
+    def _meta_path(path: Path) -> Path:
+        return path.with_name(path.name + ".sha256.json")
+
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        sys.exit(__doc__)
+    cache = ArtifactCache()
+    sha256 = cache.fetch(*sys.argv[1:])
+    print(f"{sha256}  {display_path(cache.path(sys.argv[1]))}")
+
+
+if __name__ == "__main__":
+    main()
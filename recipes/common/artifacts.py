@@ -0,0 +1,141 @@
+"""Deployer side cache for the files every server downloads.
+
+Without the cache each server downloads the R, Python and RStudio product
+.deb files (and the `just` binary) from the internet. With it the files are
+downloaded once to the machine running pulumi, verified with sha256 and
+copied to each server's ~/artifacts directory. The server side justfiles use
+the copy in ~/artifacts when there is one.
+
+The downloads run as commands during `pulumi up` (see artifact_cache.py).
+The cache is evicted least recently used first once it grows past its size
+limit, never evicting the artifacts of the current run.
+"""
+
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pulumi
+from pulumi_command import local
+
+from common import ssh
+from common.artifact_cache import ArtifactCache, filename
+
+FETCH = Path(__file__).resolve().parent / "artifact_cache.py"
+
+JUST_VERSION = "1.5.0"
+
+REMOTE_DIR = "artifacts"
+
+# One fetch command per artifact, shared by the servers of a stack.
+_fetch_commands: Dict[str, local.Command] = {}
+
+
+@dataclass(frozen=True)
+class Artifact:
+    url: str
+    sha256: Optional[str] = None
+
+    @property
+    def filename(self) -> str:
+        return filename(self.url)
+
+
+def r_artifact(version: str) -> Artifact:
+    return Artifact(f"https://cdn.rstudio.com/r/ubuntu-2004/pkgs/r-{version}_1_amd64.deb")
+
+
+def python_artifact(version: str) -> Artifact:
+    return Artifact(f"https://cdn.rstudio.com/python/ubuntu-2004/pkgs/python-{version}_1_amd64.deb")
+
+
+def just_artifact(version: str = JUST_VERSION) -> Artifact:
+    return Artifact(
+        f"https://github.com/casey/just/releases/download/{version}/"
+        f"just-{version}-x86_64-unknown-linux-musl.tar.gz"
+    )
+
+
+def fetch_args(artifact: Artifact) -> str:
+    return " ".join(filter(None, [artifact.url, artifact.sha256]))
+
+
+def _fetch_command(artifact: Artifact) -> local.Command:
+    """The command that downloads `artifact` into the cache, one per run."""
+    if artifact.filename not in _fetch_commands:
+        _fetch_commands[artifact.filename] = local.Command(
+            f"fetch {artifact.filename}",
+            create=f"python3 {os.path.relpath(FETCH)} {fetch_args(artifact)}",
+            triggers=[artifact.url, artifact.sha256]
+        )
+    return _fetch_commands[artifact.filename]
+
+
+def push_artifacts(
+    name: str,
+    cache: ArtifactCache,
+    artifacts: List[Artifact],
+    connection: ssh.AnyConnection,
+    depends_on: List[pulumi.Resource]
+) -> Dict[str, pulumi.Resource]:
+    """Copy `artifacts` to ~/artifacts on a server.
+
+    The artifacts are downloaded into the cache by a command during `pulumi
+    up`, not while the program runs, and only once: a copy that finds the
+    file evicted from the cache fetches it again. Each copy is triggered by
+    the artifact's checksum and skipped when the server already has a file
+    with that checksum, which is then verified. Returns the verify command
+    for each artifact by filename.
+    """
+    cache.use(artifact.url for artifact in artifacts)
+    if not pulumi.runtime.is_dry_run():
+        cache.evict()
+    make_dir = ssh.command(
+        f"{name} make ~/{REMOTE_DIR}",
+        create=f"mkdir -p ~/{REMOTE_DIR}",
+        connection=connection,
+        opts=pulumi.ResourceOptions(depends_on=depends_on)
+    )
+    commands = {}
+    for artifact in artifacts:
+        fetch = _fetch_command(artifact)
+        # "<sha256>  <path>", the path with ~ for the home directory.
+        fetched = fetch.stdout.apply(lambda stdout: stdout.strip().split("  ", 1))
+        sha256 = fetched.apply(lambda x: x[0])
+        copy = ssh.copy_file(
+            f"{name} copy ~/{REMOTE_DIR}/{artifact.filename}",
+            local_path=fetched.apply(lambda x: x[1]),
+            remote_path=f"{REMOTE_DIR}/{artifact.filename}",
+            connection=connection,
+            opts=pulumi.ResourceOptions(depends_on=[make_dir, fetch]),
+            triggers=[sha256],
+            sha256=sha256,
+            fetch=fetch_args(artifact)
+        )
+        commands[artifact.filename] = ssh.command(
+            f"{name} verify ~/{REMOTE_DIR}/{artifact.filename}",
+            create=pulumi.Output.concat(
+                f"cd ~/{REMOTE_DIR} && echo \"", sha256, f"  {artifact.filename}\" | sha256sum -c -"
+            ),
+            connection=connection,
+            opts=pulumi.ResourceOptions(depends_on=[copy]),
+            triggers=[sha256]
+        )
+    return commands
+
+
+def install_just_command(cache: Optional[ArtifactCache]) -> str:
+    """Shell command that installs `just` to ~/bin on a server.
+
+    Uses the copy pushed from the artifact cache when `cache` is set and the
+    official install script otherwise.
+    """
+    if cache is None:
+        install = """curl --proto '=https' --tlsv1.2 -sSf https://just.systems/install.sh | bash -s -- --to ~/bin;"""
+    else:
+        install = f"""mkdir -p ~/bin && tar -xzf ~/{REMOTE_DIR}/{just_artifact().filename} -C ~/bin just;"""
+    return "\n".join([
+        install,
+        """echo 'export PATH="$PATH:$HOME/bin"' >> ~/.bashrc;"""
+    ])
@@ -0,0 +1,119 @@
+"""Push all of a server's config files as a single bundle.
+
+The rendered config files are packed into one .tar.gz together with a
+manifest of their sha256 hashes and destinations. The bundle is uploaded with
+a single file copy (so there is no shell quoting of the file contents)
+and `server/apply_bundle.py` installs only the files that changed and removes
+the ones the previous bundle had, reloading only the services that own them.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import pulumi
+
+from common import CACHE_DIR, ssh
+
+REMOTE_PATH = "config-bundle.tar.gz"
+
+# Placeholders filled in on the server from the instance metadata, for config
+# files rendered before the server exists (see common/cloudinit.py).
+PUBLIC_IP = "@@PUBLIC_IP@@"
+PUBLIC_HOSTNAME = "@@PUBLIC_HOSTNAME@@"
+
+
+@dataclass
+class ConfigFile:
+    """A rendered config file and where it is installed on the server."""
+    name: str
+    destination: str
+    content: pulumi.Input[str]
+    service: Optional[str] = None
+    mode: str = "0644"
+    # "user" or "user:group", root by default.
+    owner: Optional[str] = None
+    # Fill in the PUBLIC_IP and PUBLIC_HOSTNAME placeholders on the server.
+    substitute: bool = False
+
+
+def write_bundle(files: List[Tuple[ConfigFile, str]]) -> Tuple[str, str]:
+    """Write a bundle of (file, content) pairs. Returns its path and sha256.
+
+    The archive is reproducible (sorted entries, fixed timestamps) so the
+    same content always gives the same hash.
+    """
+    manifest = {"files": []}
+    entries = []
+    for f, content in sorted(files, key=lambda x: x[0].name):
+        data = content.encode("utf-8")
+        manifest["files"].append({
+            "name": f.name,
+            "destination": f.destination,
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "mode": f.mode,
+            "owner": f.owner,
+            "service": f.service,
+            "substitute": f.substitute,
+        })
+        entries.append((f"files/{f.name}", data))
+    entries.insert(0, ("manifest.json", json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8")))
+
+    buffer = io.BytesIO()
+    # mtime=0 keeps the gzip header (and so the hash) reproducible.
+    with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode="w", format=tarfile.PAX_FORMAT) as tar:
+            for name, data in entries:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o600
+                tar.addfile(info, io.BytesIO(data))
+    data = buffer.getvalue()
+    sha256 = hashlib.sha256(data).hexdigest()
+
+    directory = CACHE_DIR / "bundles"
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{sha256}.tar.gz"
+    if not path.exists():
+        # Bundles can hold secrets (passwords, private keys).
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as out:
+            out.write(data)
+    return str(path), sha256
+
+
+def make_bundle(files: List[ConfigFile]) -> pulumi.Output:
+    """Write the bundle for `files`. Resolves to its path and sha256."""
+    return pulumi.Output.all(*[f.content for f in files]).apply(
+        lambda contents: write_bundle(list(zip(files, contents)))
+    )
+
+
+def push_bundle(
+    name: str,
+    files: List[ConfigFile],
+    connection: ssh.AnyConnection,
+    depends_on: List[pulumi.Resource]
+) -> Tuple[pulumi.Resource, pulumi.Output]:
+    """Upload the bundle for `files` to ~/config-bundle.tar.gz.
+
+    Returns the upload and the bundle's sha256, which should trigger the
+    step that applies it.
+    """
+    bundle = make_bundle(files)
+    path = bundle.apply(lambda b: b[0])
+    sha256 = bundle.apply(lambda b: b[1])
+    copy = ssh.copy_file(
+        f"{name} copy ~/{REMOTE_PATH}",
+        local_path=path,
+        remote_path=REMOTE_PATH,
+        connection=connection,
+        opts=pulumi.ResourceOptions(depends_on=depends_on),
+        triggers=[sha256]
+    )
+    return copy, sha256
@@ -0,0 +1,228 @@
+"""Size a deployment from the number of users it has to serve.
+
+Set `expected_users` (concurrent sessions) in the stack config and the recipes
+pick their instance type, node count, EFS throughput and database class from
+the plan made here instead of the built in defaults. Values set explicitly in
+the stack config always win, and an explicit `instance_type` (or `node_count`
+of a cluster) is planned around: the rest is sized for it, and the plan warns
+when it is too small. The plan is printed by `pulumi preview` and exported as
+`capacity_plan`.
+
+Stack config read here (all but `expected_users` are optional):
+
+    expected_users          concurrent sessions to plan for
+    session_memory_mib      memory per session (default 2048)
+    session_vcpus           sustained vCPUs per session (default 0.5)
+    session_efs_mibps       EFS throughput per session in MiB/s (default 0.5, clusters only)
+    capacity_headroom       factor on top of the expected load (default 1.25)
+    db_connections_per_node database connections per node (default 20, clusters only)
+
+Only the ratios between the instance prices below matter, they are used to
+pick the cheapest layout.
+"""
+
+import math
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import pulumi
+
+from common import hardware
+from common.hardware import Hardware
+
+# Candidate instance types: vCPUs, memory, the share of each vCPU that can be
+# used all the time (t3 instances only sustain their baseline), and the
+# on-demand price per hour in us-east-1.
+INSTANCE_TYPES = {
+    "t3.medium": (2, 4096, 0.2, 0.0416),
+    "t3.large": (2, 8192, 0.3, 0.0832),
+    "t3.xlarge": (4, 16384, 0.4, 0.1664),
+    "t3.2xlarge": (8, 32768, 0.4, 0.3328),
+    "m5.large": (2, 8192, 1.0, 0.096),
+    "m5.xlarge": (4, 16384, 1.0, 0.192),
+    "m5.2xlarge": (8, 32768, 1.0, 0.384),
+    "m5.4xlarge": (16, 65536, 1.0, 0.768),
+    "m5.8xlarge": (32, 131072, 1.0, 1.536),
+    "r5.large": (2, 16384, 1.0, 0.126),
+    "r5.xlarge": (4, 32768, 1.0, 0.252),
+    "r5.2xlarge": (8, 65536, 1.0, 0.504),
+    "r5.4xlarge": (16, 131072, 1.0, 1.008),
+}
+
+# Database classes and their memory. RDS postgres sets max_connections to
+# memory / 9531392 bytes.
+DB_INSTANCE_CLASSES = {
+    "db.t3.micro": 1024,
+    "db.t3.small": 2048,
+    "db.t3.medium": 4096,
+    "db.m5.large": 8192,
+    "db.m5.xlarge": 16384,
+    "db.m5.2xlarge": 32768,
+}
+RDS_BYTES_PER_CONNECTION = 9531392
+
+# Below this an EFS file system is fine on bursting credits.
+EFS_BURSTING_MIBPS = 1.0
+
+
+@dataclass
+class CapacityPlan:
+    """The sizing for a deployment."""
+    expected_users: int
+    instance_type: str
+    node_count: int
+    sessions_per_node: int
+    # Only planned for clusters (with shared storage and a database).
+    efs_throughput_mode: Optional[str] = None
+    efs_mibps: Optional[float] = None
+    db_instance_class: Optional[str] = None
+    db_connections: Optional[int] = None
+    warnings: List[str] = field(default_factory=list)
+
+    def summary(self) -> str:
+        lines = [
+            f"capacity plan for {self.expected_users} concurrent users:",
+            f"  {self.node_count} x {self.instance_type}, up to {self.sessions_per_node} sessions each",
+        ]
+        if self.efs_throughput_mode:
+            lines.append(f"  EFS {self.efs_throughput_mode} throughput, about {self.efs_mibps:.1f} MiB/s")
+        if self.db_instance_class:
+            lines.append(f"  database {self.db_instance_class} for {self.db_connections} connections")
+        return "\n".join(lines + [f"  warning: {w}" for w in self.warnings])
+
+
+def sessions_per_node(hardware: Hardware, baseline: float, session_memory_mib: int, session_vcpus: float) -> int:
+    by_memory = hardware.session_memory_mib // session_memory_mib
+    by_cpu = math.floor(hardware.vcpus * baseline / session_vcpus) if session_vcpus > 0 else by_memory
+    return max(0, min(by_memory, by_cpu))
+
+
+def db_instance_class(connections: int) -> str:
+    """The smallest class whose max_connections fits `connections`."""
+    for name, memory_mib in DB_INSTANCE_CLASSES.items():
+        if memory_mib * 1024**2 // RDS_BYTES_PER_CONNECTION >= connections:
+            return name
+    return list(DB_INSTANCE_CLASSES)[-1]
+
+
+def make_plan(
+    expected_users: int,
+    session_memory_mib: int = 2048,
+    session_vcpus: float = 0.5,
+    session_efs_mibps: float = 0.5,
+    headroom: float = 1.25,
+    db_connections_per_node: int = 20,
+    min_nodes: int = 1,
+    max_nodes: Optional[int] = None,
+    cluster: bool = False,
+    instance_types: Optional[Dict[str, Tuple[int, int, float, float]]] = None
+) -> CapacityPlan:
+    """The cheapest layout that serves `expected_users` with `headroom`.
+
+    Every instance type (of `instance_types`, INSTANCE_TYPES by default) is
+    tried with as many nodes as it needs (at least `min_nodes`); layouts that
+    need more than `max_nodes` are skipped unless nothing fits, in which case
+    the biggest single layout is used and the plan carries a warning. EFS
+    throughput and the database class are only planned for a `cluster`.
+    """
+    if expected_users < 1:
+        raise ValueError("expected_users must be at least 1")
+    if headroom < 1:
+        raise ValueError("capacity_headroom must be at least 1")
+    sessions = math.ceil(expected_users * headroom)
+
+    warnings = []
+    options = []
+    for name, (vcpus, memory_mib, baseline, price) in (instance_types or INSTANCE_TYPES).items():
+        per_node = sessions_per_node(Hardware(name, vcpus, memory_mib), baseline, session_memory_mib, session_vcpus)
+        if per_node == 0:
+            continue
+        nodes = max(min_nodes, math.ceil(sessions / per_node))
+        # Cheapest first, then the fewest nodes.
+        options.append((nodes * price, nodes, name, per_node))
+    if not options and instance_types is not None:
+        # The instance types were chosen in the stack config, so the plan
+        # only warns.
+        name = list(instance_types)[0]
+        options.append((0.0, max_nodes or min_nodes, name, 0))
+        warnings.append(f"a single session does not fit on {name}")
+    if not options:
+        raise ValueError("a single session does not fit on any of the candidate instance types")
+
+    fitting = [o for o in options if max_nodes is None or o[1] <= max_nodes]
+    if fitting:
+        _, nodes, instance_type, per_node = min(fitting)
+    else:
+        _, _, instance_type, per_node = max(options, key=lambda o: o[3])
+        nodes = max_nodes
+        warnings.append(
+            f"{sessions} sessions do not fit on {max_nodes} node(s), "
+            f"the biggest candidate ({instance_type}) takes {per_node * nodes}"
+        )
+
+    plan = CapacityPlan(
+        expected_users=expected_users,
+        instance_type=instance_type,
+        node_count=nodes,
+        sessions_per_node=per_node,
+        warnings=warnings,
+    )
+    if cluster:
+        plan.efs_mibps = sessions * session_efs_mibps
+        plan.efs_throughput_mode = "elastic" if plan.efs_mibps > EFS_BURSTING_MIBPS else "bursting"
+        plan.db_connections = nodes * db_connections_per_node
+        # max_connections also needs the headroom (and a few for RDS itself).
+        plan.db_instance_class = db_instance_class(math.ceil(plan.db_connections * headroom) + 3)
+    return plan
+
+
+def plan_from_config(
+    config: pulumi.Config,
+    min_nodes: int = 1,
+    max_nodes: Optional[int] = None,
+    cluster: bool = False,
+    db_connections_per_node: Optional[int] = None
+) -> Optional[CapacityPlan]:
+    """The plan for the stack config, or None without `expected_users`.
+
+    With `instance_type` set in the stack config only that type is planned
+    for; pass an explicit node count as `min_nodes` and `max_nodes`.
+    """
+    expected_users = config.get_int("expected_users")
+    if expected_users is None:
+        return None
+    instance_type = config.get("instance_type")
+    return make_plan(
+        expected_users,
+        session_memory_mib=config.get_int("session_memory_mib") or 2048,
+        session_vcpus=config.get_float("session_vcpus") or 0.5,
+        session_efs_mibps=config.get_float("session_efs_mibps") or 0.5,
+        headroom=config.get_float("capacity_headroom") or 1.25,
+        db_connections_per_node=db_connections_per_node or config.get_int("db_connections_per_node") or 20,
+        min_nodes=min_nodes,
+        max_nodes=max_nodes,
+        cluster=cluster,
+        instance_types={instance_type: instance_spec(instance_type)} if instance_type else None,
+    )
+
+
+def instance_spec(instance_type: str) -> Tuple[int, int, float, float]:
+    """The INSTANCE_TYPES entry of `instance_type`, looked up if it has none.
+
+    Types that are looked up count with every vCPU, and have no price as
+    they are the only candidate.
+    """
+    if instance_type in INSTANCE_TYPES:
+        return INSTANCE_TYPES[instance_type]
+    info = hardware.lookup(instance_type)
+    return (info.vcpus, info.memory_mib, 1.0, 0.0)
+
+
+def publish(plan: Optional[CapacityPlan]):
+    """Print the plan (it shows up in `pulumi preview`) and export it."""
+    if plan is None:
+        return
+    pulumi.log.info(plan.summary())
+    for warning in plan.warnings:
+        pulumi.log.warn(f"capacity plan: {warning}")
+    pulumi.export("capacity_plan", asdict(plan))
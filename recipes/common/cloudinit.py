@@ -0,0 +1,151 @@
+"""Let servers provision themselves at boot with cloud-init.
+
+By default pulumi waits for each server to boot and then pushes the .env
+file, the justfile, the config files and every build step over SSH. With
+`bootstrap: cloud-init` the same files are rendered into the instance's
+user data instead and the server runs `just build-*` (or `just configure-*`
+on a golden image) itself on first boot, so `pulumi up` returns as soon as
+the instances exist.
+
+Values that are only known on the server (its own public ip and host name)
+are written to the config files as placeholders, which
+`server/apply_bundle.py` fills in from the instance metadata.
+"""
+
+import base64
+import gzip
+import json
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pulumi
+from pulumi_command import local
+
+from common import SERVER_FILES_DIR
+from common.artifacts import install_just_command
+
+BOOTSTRAP_MODES = ("ssh", "cloud-init")
+
+# Where the files are written by cloud-init before they are copied to the
+# home directory of the default user (which does not exist yet when
+# write_files runs).
+BOOT_DIR = "/opt/rstudio-recipes"
+USER = "ubuntu"
+LOG_FILE = "/var/log/rstudio-recipes-bootstrap.log"
+DONE_FILE = ".bootstrap-done"
+
+# EC2 limits user data to 16 KiB.
+MAX_USER_DATA_BYTES = 16 * 1024
+
+
+def env_file(values: Dict[str, pulumi.Input[str]]) -> pulumi.Output:
+    """The contents of the ~/.env file read by the server side justfiles."""
+    return pulumi.Output.all(**values).apply(
+        lambda v: "".join(f"export {key}={value}\n" for key, value in v.items())
+    )
+
+
+def write_env_command(values: Dict[str, pulumi.Input[str]]) -> pulumi.Output:
+    """Shell command that writes the ~/.env file over SSH."""
+    return env_file(values).apply(lambda text: f"cat > .env << 'EOF'\n{text}EOF")
+
+
+def bootstrap_script(target: str) -> str:
+    """Script run as the default user on first boot."""
+    return "\n".join([
+        "set -euo pipefail",
+        "cd ~",
+        f"cp -a {BOOT_DIR}/. ~",
+        install_just_command(None),
+        'export PATH="$PATH:$HOME/bin"',
+        f"just {target}",
+        f"touch ~/{DONE_FILE}",
+    ]) + "\n"
+
+
+def user_data(
+    target: str,
+    files: Dict[str, pulumi.Input[str]],
+    bundle_path: Optional[pulumi.Input[str]] = None,
+    justfile: str = "server-side-files/justfile",
+    steps_file: str = "server-side-files/build-steps.json"
+) -> pulumi.Output:
+    """Base64 encoded (gzipped) cloud-config that provisions a server.
+
+    `files` maps file names in the home directory (.env, ...) to their
+    contents. The justfile, build-steps.json, the server side helpers and the
+    config bundle at `bundle_path` are added to them.
+    """
+    files = dict(files)
+    files["justfile"] = Path(justfile).read_text()
+    files["build-steps.json"] = Path(steps_file).read_text()
+    for path in [SERVER_FILES_DIR / "steprunner.py", SERVER_FILES_DIR / "apply_bundle.py"]:
+        files[path.name] = path.read_text()
+    names = list(files)
+
+    def render(args: List) -> str:
+        contents, bundle = args[:len(names)], args[len(names)]
+        write_files = [
+            {"path": f"{BOOT_DIR}/{name}", "content": content, "permissions": "0600"}
+            for name, content in zip(names, contents)
+        ]
+        if bundle is not None:
+            write_files.append({
+                "path": f"{BOOT_DIR}/config-bundle.tar.gz",
+                "encoding": "b64",
+                "content": base64.b64encode(Path(bundle).read_bytes()).decode(),
+                "permissions": "0600",
+            })
+        write_files.append({
+            "path": f"{BOOT_DIR}/bootstrap.sh",
+            "content": bootstrap_script(target),
+            "permissions": "0700",
+        })
+        document = {
+            "write_files": write_files,
+            "runcmd": [
+                f"chown -R {USER}:{USER} {BOOT_DIR}",
+                f"runuser -l {USER} -c 'bash {BOOT_DIR}/bootstrap.sh' >> {LOG_FILE} 2>&1",
+            ],
+        }
+        # JSON is valid YAML, and it needs no care with indentation or quoting.
+        data = gzip.compress(("#cloud-config\n" + json.dumps(document)).encode(), mtime=0)
+        if len(data) > MAX_USER_DATA_BYTES:
+            raise ValueError(f"The cloud-init user data is {len(data)} bytes, the limit is {MAX_USER_DATA_BYTES}")
+        return base64.b64encode(data).decode()
+
+    return pulumi.Output.all(*[files[name] for name in names], bundle_path).apply(render)
+
+
+def wait_until_ready(
+    name: str,
+    url: pulumi.Input[str],
+    depends_on: List[pulumi.Resource],
+    timeout_minutes: int = 45
+) -> local.Command:
+    """Poll `url` from the deployer until the server answers.
+
+    The certificate is not checked, the recipes use self signed certs.
+    """
+    attempts = timeout_minutes * 6
+    return local.Command(
+        name,
+        create=pulumi.Output.concat(
+            f"for i in $(seq 1 {attempts}); do ",
+            "curl -fks -o /dev/null --max-time 5 ", url, " && exit 0; ",
+            "sleep 10; done; ",
+            f"echo 'not ready after {timeout_minutes} minutes, see {LOG_FILE} on the server' >&2; exit 1"
+        ),
+        opts=pulumi.ResourceOptions(depends_on=depends_on)
+    )
+
+
+def instance_args(user_data: Optional[pulumi.Output]) -> dict:
+    """Arguments for `ec2.Instance` that boot it with `user_data`.
+
+    Changing the user data replaces the instance, since cloud-init only runs
+    it on the first boot.
+    """
+    if user_data is None:
+        return {}
+    return {"user_data_base64": user_data, "user_data_replace_on_change": True}
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""Deploy or destroy many stacks of one recipe at once.
+
+Made for training sandboxes: one `rsw-single-server` or `rsc-single-server`
+stack per trainee. The stacks are listed in a json file, and driven with the
+pulumi Automation API, several at a time:
+
+    {
+      "recipe": "rsw-single-server",
+      "defaults": {"aws:region": "us-east-2", "manage_keys": true, "instance_type": "t3.large"},
+      "secrets": ["rsw_license"],
+      "stacks": [
+        {"name": "trainee-01", "email": "ada@example.com", "rsw_license": "..."},
+        {"name": "trainee-02", "email": "grace@example.com", "rsw_license": "..."}
+      ]
+    }
+
+Every key of a stack other than `name` is stack config, on top of
+`defaults`; keys listed in `secrets` (and the license and password keys) are
+set as secrets. `recipe` is a recipe directory, relative to the file.
+
+Usage:
+
+    python3 fleet.py up trainees.json [--concurrency 10] [--retries 2] [--events events.jsonl]
+    python3 fleet.py destroy trainees.json [--remove]
+
+Each stack is a separate `pulumi` process, so 30 stacks take about as long
+as the slowest one as long as --concurrency allows it. A failed stack is
+retried (after a backoff) while the others go on. The engine events of every
+stack are written as json lines to --events (`-` for stdout), and the run ends
+with a summary of every stack and its outputs (--outputs). It exits with 1 if
+a stack failed.
+
+Run it with the python of the recipe's venv, it needs the `pulumi` package
+(and the pulumi CLI on the PATH).
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, TextIO
+
+from pulumi import automation as auto
+
+# Config keys that are always set as secrets.
+SECRET_KEYS = {"rsw_license", "rsc_license", "mail_trap_password"}
+
+DEFAULT_OUTPUTS = ["rsw_public_dns", "rsc_public_dns"]
+
+# Seconds before the first retry of a stack, doubled for every further retry.
+RETRY_DELAY = 30
+
+
+@dataclass
+class StackSpec:
+    name: str
+    config: Dict[str, Any]
+
+
+@dataclass
+class StackResult:
+    name: str
+    status: str = "pending"
+    attempts: int = 0
+    seconds: float = 0
+    outputs: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+
+def load_fleet(path: str):
+    """The recipe directory, the stacks and the secret config keys of `path`."""
+    fleet = json.loads(Path(path).read_text())
+    recipe = (Path(path).resolve().parent / fleet["recipe"]).resolve()
+    if not (recipe / "Pulumi.yaml").exists():
+        raise SystemExit(f"fleet: {recipe} is not a recipe directory")
+    defaults = fleet.get("defaults", {})
+    specs = []
+    for entry in fleet["stacks"]:
+        entry = dict(entry)
+        specs.append(StackSpec(name=entry.pop("name"), config={**defaults, **entry}))
+
+    names = [s.name for s in specs]
+    if len(set(names)) != len(names):
+        raise SystemExit("fleet: stack names must be unique")
+    # The EC2 key pair of a stack is named after its email.
+    emails = [s.config.get("email") for s in specs]
+    if None in emails or len(set(emails)) != len(emails):
+        raise SystemExit("fleet: every stack needs its own email")
+    return recipe, specs, SECRET_KEYS | set(fleet.get("secrets", []))
+
+
+class EventLog:
+    """Writes the engine events of every stack as json lines."""
+
+    def __init__(self, out: Optional[TextIO]):
+        self.out = out
+        self.lock = threading.Lock()
+
+    def write(self, stack: str, attempt: int, event: str, **data):
+        if self.out is None:
+            return
+        line = json.dumps({
+            "time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "stack": stack,
+            "attempt": attempt,
+            "event": event,
+            **{k: v for k, v in data.items() if v is not None},
+        }, default=str)
+        with self.lock:
+            self.out.write(line + "\n")
+            self.out.flush()
+
+    def engine_event(self, stack: str, attempt: int, event: auto.EngineEvent):
+        """Keep the events that say what happened to which resource."""
+        if event.resource_pre_event:
+            meta = event.resource_pre_event.metadata
+            self.write(stack, attempt, "resource-start", op=str(meta.op), urn=meta.urn, type=meta.type)
+        elif event.res_outputs_event:
+            meta = event.res_outputs_event.metadata
+            self.write(stack, attempt, "resource-done", op=str(meta.op), urn=meta.urn, type=meta.type)
+        elif event.res_op_failed_event:
+            meta = event.res_op_failed_event.metadata
+            self.write(stack, attempt, "resource-failed", op=str(meta.op), urn=meta.urn, type=meta.type)
+        elif event.diagnostic_event and event.diagnostic_event.severity in ("warning", "error"):
+            diagnostic = event.diagnostic_event
+            self.write(stack, attempt, diagnostic.severity, urn=diagnostic.urn, message=diagnostic.message.strip())
+        elif event.summary_event:
+            self.write(
+                stack, attempt, "summary",
+                changes=event.summary_event.resource_changes,
+                seconds=event.summary_event.duration_seconds
+            )
+
+
+def progress(message: str):
+    print(f"{time.strftime('%H:%M:%S')} {message}", file=sys.stderr, flush=True)
+
+
+def select_stack(recipe: Path, spec: StackSpec, secrets: set) -> auto.Stack:
+    stack = auto.create_or_select_stack(stack_name=spec.name, work_dir=str(recipe))
+    stack.set_all_config({
+        key: auto.ConfigValue(value=json.dumps(value) if isinstance(value, bool) else str(value), secret=key in secrets)
+        for key, value in spec.config.items()
+    })
+    return stack
+
+
+def run_stack(args, recipe: Path, spec: StackSpec, secrets: set, events: EventLog) -> StackResult:
+    """Bring one stack up (or down), with retries."""
+    result = StackResult(spec.name)
+    start = time.perf_counter()
+    for attempt in range(1, args.retries + 2):
+        result.attempts = attempt
+        progress(f"{spec.name}: {args.command} (attempt {attempt})")
+        events.write(spec.name, attempt, "start", command=args.command)
+        on_event = lambda event, attempt=attempt: events.engine_event(spec.name, attempt, event)
+        try:
+            stack = select_stack(recipe, spec, secrets)
+            if args.command == "up":
+                up = stack.up(on_event=on_event, color="never")
+                result.outputs = {
+                    k: "[secret]" if v.secret else v.value
+                    for k, v in up.outputs.items() if k in args.outputs
+                }
+            else:
+                stack.destroy(on_event=on_event, color="never")
+                if args.remove:
+                    stack.workspace.remove_stack(spec.name)
+            result.status, result.error = "ok", None
+            break
+        except auto.CommandError as e:
+            # The last lines of stderr carry the error, the rest is progress.
+            result.status = "failed"
+            result.error = "\n".join(str(e).strip().splitlines()[-5:])
+            events.write(spec.name, attempt, "failed", message=result.error)
+            if attempt <= args.retries:
+                delay = RETRY_DELAY * 2 ** (attempt - 1)
+                progress(f"{spec.name}: failed, retrying in {delay}s")
+                time.sleep(delay)
+    result.seconds = time.perf_counter() - start
+    progress(f"{spec.name}: {result.status} after {result.seconds:.0f}s")
+    events.write(spec.name, result.attempts, "end", status=result.status, outputs=result.outputs or None)
+    return result
+
+
+def print_summary(results: List[StackResult], wall: float, file: TextIO = sys.stdout):
+    ok = [r for r in results if r.status == "ok"]
+    print(f"\n{len(ok)} of {len(results)} stacks ok in {wall:.0f}s "
+          f"(slowest {max((r.seconds for r in results), default=0):.0f}s)", file=file)
+    for r in results:
+        outputs = "  ".join(f"{k}={v}" for k, v in r.outputs.items())
+        retried = f" ({r.attempts} attempts)" if r.attempts > 1 else ""
+        print(f"  {r.name:<24} {r.status:<7} {r.seconds:>6.0f}s{retried}  {outputs}", file=file)
+        if r.error:
+            for line in r.error.splitlines():
+                print(f"      {line}", file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["up", "destroy"])
+    parser.add_argument("fleet", help="json file with the recipe and the stacks")
+    parser.add_argument("--concurrency", type=int, default=10, help="stacks deployed at the same time")
+    parser.add_argument("--retries", type=int, default=2, help="retries of a failed stack")
+    parser.add_argument("--events", help="write the engine events as json lines to this file ('-' for stdout)")
+    parser.add_argument("--outputs", nargs="+", default=DEFAULT_OUTPUTS, help="stack outputs in the summary")
+    parser.add_argument("--summary", help="also write the summary as json to this file")
+    parser.add_argument("--only", nargs="+", metavar="STACK", help="only these stacks of the fleet")
+    parser.add_argument("--remove", action="store_true", help="remove the stacks after destroy")
+    args = parser.parse_args()
+
+    recipe, specs, secrets = load_fleet(args.fleet)
+    if args.only:
+        specs = [s for s in specs if s.name in args.only]
+
+    out = None
+    if args.events == "-":
+        out = sys.stdout
+    elif args.events:
+        out = open(args.events, "a")
+    events = EventLog(out)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        results = list(pool.map(lambda spec: run_stack(args, recipe, spec, secrets, events), specs))
+    wall = time.perf_counter() - start
+
+    if out not in (None, sys.stdout):
+        out.close()
+    # Keep stdout to the events when they go there.
+    print_summary(results, wall, file=sys.stderr if out is sys.stdout else sys.stdout)
+    if args.summary:
+        Path(args.summary).write_text(json.dumps([asdict(r) for r in results], indent=2, default=str))
+    sys.exit(0 if all(r.status == "ok" for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
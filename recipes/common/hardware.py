@@ -0,0 +1,65 @@
+"""Size the server side config to the instance type.
+
+The vCPUs and memory of an instance type are looked up at deploy time, so the
+launcher thread pool and the session limits follow the `instance_type` of a
+stack instead of being fixed for a t3.medium.
+"""
+
+import functools
+from dataclasses import dataclass
+
+from pulumi_aws import ec2
+
+DEFAULT_INSTANCE_TYPE = "t3.medium"
+
+# Memory kept back for the OS and the RStudio services themselves.
+MIN_RESERVED_MIB = 1024
+RESERVED_FRACTION = 0.1
+
+# The launcher mostly waits on sessions and I/O, so it gets at least this many
+# threads even on a small instance.
+MIN_THREAD_POOL_SIZE = 4
+
+
+@dataclass(frozen=True)
+class Hardware:
+    """What an instance type provides."""
+    instance_type: str
+    vcpus: int
+    memory_mib: int
+    # Local NVMe instance store, 0 for EBS only instance types.
+    instance_storage_gb: int = 0
+
+    @property
+    def reserved_mib(self) -> int:
+        return max(MIN_RESERVED_MIB, int(self.memory_mib * RESERVED_FRACTION))
+
+    @property
+    def session_memory_mib(self) -> int:
+        """Memory that sessions can use between them."""
+        return max(self.memory_mib - self.reserved_mib, 512)
+
+
+@functools.lru_cache(maxsize=None)
+def lookup(instance_type: str) -> Hardware:
+    """Look up the vCPUs, memory and instance store of `instance_type` (once per run)."""
+    info = ec2.get_instance_type(instance_type=instance_type)
+    return Hardware(instance_type, info.default_vcpus, info.memory_size, info.total_instance_storage or 0)
+
+
+def launcher_settings(hardware: Hardware, debug_logging: bool = False) -> dict:
+    """Template values for launcher.conf and the session profiles.
+
+    A single session may use every vCPU and all of the session memory, and
+    gets one vCPU and a quarter of the session memory (at least 1 GiB, at most
+    the whole) unless the user asks for more.
+    """
+    max_mem_mb = hardware.session_memory_mib
+    return {
+        "thread_pool_size": max(MIN_THREAD_POOL_SIZE, hardware.vcpus),
+        "debug_logging": debug_logging,
+        "max_cpus": hardware.vcpus,
+        "default_cpus": 1,
+        "max_mem_mb": max_mem_mb,
+        "default_mem_mb": min(max_mem_mb, max(1024, max_mem_mb // 4)),
+    }
@@ -0,0 +1,185 @@
+"""Hibernate idle servers and wake them up on a timetable.
+
+A stopped server costs only its volumes, and a hibernated one comes back with
+its memory (running sessions included) in a minute or two, instead of the
+full build that a `pulumi destroy` and `pulumi up` means. Stack config read
+here (all optional):
+
+    hibernation        launch the servers with hibernation enabled
+    root_volume_gb     size of the root volume (default: that of the AMI, or
+                       with hibernation enough for the installs and the memory)
+    stop_schedule      EventBridge Scheduler expression to stop the servers,
+                       e.g. "cron(0 19 ? * MON-FRI *)"
+    start_schedule     expression to start them again, e.g. "cron(0 7 ? * MON-FRI *)"
+    schedule_timezone  time zone of the expressions (default UTC)
+    elastic_ip         keep the public address across stops (default: on
+                       with hibernation or a schedule)
+
+Hibernation needs an encrypted root volume that can hold the memory, so it is
+made encrypted and sized here, and it can only be set when an instance is
+launched: turning it on or off replaces the servers. A stopped server gets
+a new public address when it starts, which would break the config files and
+the SSH connections that use it, hence the Elastic IP.
+"""
+
+import json
+import math
+from dataclasses import dataclass
+from typing import List, Optional
+
+import pulumi
+from pulumi_aws import ec2, iam, scheduler
+
+from common.hardware import Hardware
+
+# Root volume for the OS, R, Python and the RStudio products, without the
+# memory image.
+ROOT_VOLUME_BASE_GB = 16
+
+SCHEDULE_PREFIXES = ("cron(", "rate(", "at(")
+
+
+@dataclass
+class HibernationSettings:
+    hibernate: bool = False
+    root_volume_gb: Optional[int] = None
+    stop_schedule: Optional[str] = None
+    start_schedule: Optional[str] = None
+    timezone: str = "UTC"
+    elastic_ip: bool = False
+
+
+def settings_from_config(config: pulumi.Config) -> HibernationSettings:
+    settings = HibernationSettings(
+        hibernate=config.get_bool("hibernation") or False,
+        root_volume_gb=config.get_int("root_volume_gb"),
+        stop_schedule=config.get("stop_schedule"),
+        start_schedule=config.get("start_schedule"),
+        timezone=config.get("schedule_timezone") or "UTC",
+    )
+    for expression in (settings.stop_schedule, settings.start_schedule):
+        if expression and not expression.startswith(SCHEDULE_PREFIXES):
+            raise ValueError(f"schedules are EventBridge Scheduler expressions (cron(...), rate(...) or at(...)), not {expression!r}")
+    elastic_ip = config.get_bool("elastic_ip")
+    settings.elastic_ip = elastic_ip if elastic_ip is not None else bool(
+        settings.hibernate or settings.stop_schedule or settings.start_schedule
+    )
+    return settings
+
+
+def root_volume_gb(settings: HibernationSettings, hardware: Hardware) -> Optional[int]:
+    """The root volume size, or None to keep the size of the AMI."""
+    if not settings.hibernate:
+        return settings.root_volume_gb
+    needed = ROOT_VOLUME_BASE_GB + math.ceil(hardware.memory_mib / 1024)
+    if settings.root_volume_gb is None:
+        return needed
+    if settings.root_volume_gb < needed:
+        pulumi.log.warn(f"root_volume_gb {settings.root_volume_gb} is too small for hibernation, using {needed}")
+        return needed
+    return settings.root_volume_gb
+
+
+def instance_args(settings: HibernationSettings, hardware: Hardware) -> dict:
+    """Arguments for `ec2.Instance` for the hibernation settings."""
+    size = root_volume_gb(settings, hardware)
+    if size is None:
+        return {}
+    args = {
+        "root_block_device": ec2.InstanceRootBlockDeviceArgs(
+            volume_size=size,
+            volume_type="gp3",
+            encrypted=settings.hibernate,
+            delete_on_termination=True,
+        ),
+    }
+    if settings.hibernate:
+        args["hibernation"] = True
+    return args
+
+
+@dataclass
+class PublicAddress:
+    """Where a server is reached from outside."""
+    public_ip: pulumi.Output
+    public_dns: pulumi.Output
+
+
+def public_address(name: str, server: ec2.Instance, settings: HibernationSettings, tags: dict) -> PublicAddress:
+    """The public address of `server`, an Elastic IP if `elastic_ip` is set.
+
+    Everything that connects to the server should use this address, so it
+    waits for the Elastic IP to be attached.
+    """
+    if not settings.elastic_ip:
+        return PublicAddress(server.public_ip, server.public_dns)
+    eip = ec2.Eip(f"{name} address", instance=server.id, vpc=True, tags=tags)
+    return PublicAddress(eip.public_ip, eip.public_dns)
+
+
+def _target(action: str, role: iam.Role, instance_ids: pulumi.Output, hibernate: bool) -> scheduler.ScheduleTargetArgs:
+    """A universal target that calls ec2:<action> for the servers."""
+    def body(ids: List[str]) -> str:
+        request = {"InstanceIds": ids}
+        if action == "stopInstances" and hibernate:
+            request["Hibernate"] = True
+        return json.dumps(request)
+
+    return scheduler.ScheduleTargetArgs(
+        arn=f"arn:aws:scheduler:::aws-sdk:ec2:{action}",
+        role_arn=role.arn,
+        input=instance_ids.apply(body),
+    )
+
+
+def make_schedule(name: str, servers: List[ec2.Instance], settings: HibernationSettings, tags: dict):
+    """Stop (hibernate) and start `servers` on the schedules, if any are set."""
+    if not (settings.stop_schedule or settings.start_schedule):
+        return
+    role = iam.Role(
+        f"{name} scheduler role",
+        assume_role_policy=json.dumps({
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Principal": {"Service": "scheduler.amazonaws.com"},
+                "Action": "sts:AssumeRole",
+            }],
+        }),
+        tags=tags,
+    )
+    iam.RolePolicy(
+        f"{name} scheduler policy",
+        role=role.id,
+        policy=pulumi.Output.all(*[s.arn for s in servers]).apply(lambda arns: json.dumps({
+            "Version": "2012-10-17",
+            "Statement": [
+                {"Effect": "Allow", "Action": ["ec2:StartInstances", "ec2:StopInstances"], "Resource": arns},
+                # Starting an instance with an encrypted volume creates a grant
+                # on its KMS key.
+                {
+                    "Effect": "Allow",
+                    "Action": "kms:CreateGrant",
+                    "Resource": "*",
+                    "Condition": {"Bool": {"kms:GrantIsForAWSResource": "true"}},
+                },
+            ],
+        })),
+    )
+    instance_ids = pulumi.Output.all(*[s.id for s in servers])
+    for action, expression in (("stopInstances", settings.stop_schedule), ("startInstances", settings.start_schedule)):
+        if not expression:
+            continue
+        scheduler.Schedule(
+            f"{name} {action}",
+            schedule_expression=expression,
+            schedule_expression_timezone=settings.timezone,
+            flexible_time_window=scheduler.ScheduleFlexibleTimeWindowArgs(mode="OFF"),
+            target=_target(action, role, instance_ids, settings.hibernate),
+        )
+    pulumi.export("schedule", {
+        "stop": settings.stop_schedule,
+        "start": settings.start_schedule,
+        "timezone": settings.timezone,
+        "hibernate": settings.hibernate,
+    })
@@ -0,0 +1,121 @@
+"""Golden machine images.
+
+Building a node from the stock Ubuntu image means running the whole install
+pipeline (apt, R, Python, the RStudio product, ...) on every node. When image
+baking is enabled a built node is snapshotted into an AMI tagged with a key
+made from the server side justfile and the installed versions. Later
+deployments (and extra HA nodes) that compute the same key boot straight from
+that AMI and only run the configure step.
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pulumi
+from pulumi_aws import ec2
+
+from common.templates import hash_text
+
+# Ubuntu Server 20.04 LTS (HVM), SSD Volume Type for us-east-2
+BASE_AMI = "ami-0fb653ca2d3203ac1"
+
+IMAGE_KEY_TAG = "rs:image-key"
+
+
+@dataclass
+class MachineImage:
+    """The AMI that the servers should boot from."""
+    ami: str
+    key: Optional[str] = None
+    baked: bool = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.key is not None
+
+    @property
+    def needs_bake(self) -> bool:
+        return self.enabled and not self.baked
+
+
+def image_key(justfile: str, **versions: str) -> str:
+    """Hash of the server side justfile and the versions it installs."""
+    text = Path(justfile).read_text()
+    text += "".join(f"\n{k}={v}" for k, v in sorted(versions.items()))
+    return hash_text(text)
+
+
+def find_image(key: str) -> Optional[str]:
+    """Return the id of the newest available AMI baked with `key`, if any."""
+    result = ec2.get_amis(
+        owners=["self"],
+        filters=[
+            ec2.GetAmisFilterArgs(name=f"tag:{IMAGE_KEY_TAG}", values=[key]),
+            ec2.GetAmisFilterArgs(name="state", values=["available"]),
+        ],
+    )
+    if not result.ids:
+        return None
+    return result.ids[0]
+
+
+def resolve_image(enabled: bool, justfile: str, **versions: str) -> MachineImage:
+    if not enabled:
+        return MachineImage(ami=BASE_AMI)
+    key = image_key(justfile, **versions)
+    ami = find_image(key)
+    if ami is None:
+        pulumi.log.info(f"No golden image for key {key[:12]}, building from {BASE_AMI}")
+        return MachineImage(ami=BASE_AMI, key=key)
+    pulumi.log.info(f"Using golden image {ami} for key {key[:12]}")
+    return MachineImage(ami=ami, key=key, baked=True)
+
+
+def instance_options(image: MachineImage, **kwargs) -> pulumi.ResourceOptions:
+    """Options for servers booting from `image`.
+
+    Once a golden image exists the servers that were used to bake it should not
+    be replaced just because the AMI lookup now returns a different id.
+    """
+    if image.enabled:
+        kwargs["ignore_changes"] = kwargs.get("ignore_changes", []) + ["ami"]
+    return pulumi.ResourceOptions(**kwargs)
+
+
+def install_env(env: Dict[str, pulumi.Input[str]], image: MachineImage, secrets: List[str]) -> Dict[str, pulumi.Input[str]]:
+    """The .env for the install stages.
+
+    While a golden image is baked the `secrets` (the license) are left out,
+    the image is shared with other stacks. The full .env is written once the
+    image is taken.
+    """
+    if not image.needs_bake:
+        return env
+    return {key: value for key, value in env.items() if key not in secrets}
+
+
+def bake_image(
+    name: str,
+    server: ec2.Instance,
+    image: MachineImage,
+    tags: dict,
+    depends_on: List[pulumi.Resource]
+) -> ec2.AmiFromInstance:
+    """Snapshot `server` into a golden image once `depends_on` has finished.
+
+    `depends_on` should be the install stages only: the configure stages
+    (license, users, mounts, config files) are deployment specific and have
+    to wait for the image. The AMI is retained when the stack is destroyed so
+    other stacks can reuse it.
+    """
+    ami = ec2.AmiFromInstance(
+        f"{name} golden image",
+        name=f"{name}-{pulumi.get_stack()}-{image.key[:12]}",
+        source_instance_id=server.id,
+        snapshot_without_reboot=True,
+        tags=tags | {"Name": f"{name}-golden-image", IMAGE_KEY_TAG: image.key},
+        opts=pulumi.ResourceOptions(depends_on=depends_on, retain_on_delete=True),
+    )
+    pulumi.export(f"{name}_golden_image_id", ami.id)
+    return ami
@@ -0,0 +1,69 @@
+"""The SSH key pair of a stack.
+
+By default a recipe uses the key pair made by `just key-pair-new`: the public
+key is in the stack config and the private key in `key.pem`. With
+`manage_keys` set the key is made by pulumi (`tls.PrivateKey`) instead and
+kept, encrypted, in the stack state, so a new stack needs nothing but
+`pulumi up`. `just key-pair-export` writes it to `key.pem` for `just
+server-ssh`.
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+import pulumi
+from pulumi_aws import ec2
+
+if TYPE_CHECKING:
+    import pulumi_tls as tls
+
+KEY_ALGORITHMS = ("ed25519", "rsa")
+PRIVATE_KEY_FILE = "key.pem"
+
+
+@dataclass
+class StackKeys:
+    """The EC2 key pair and the matching private key."""
+    key_pair: ec2.KeyPair
+    managed_key: Optional["tls.PrivateKey"] = None
+    private_key_file: str = PRIVATE_KEY_FILE
+
+    @property
+    def private_key(self) -> pulumi.Input[str]:
+        """The private key in OpenSSH format, for `ssh.connection`."""
+        if self.managed_key is not None:
+            return self.managed_key.private_key_openssh
+        # Only read when a connection is made, so cloud-init stacks do not
+        # need the file.
+        return Path(self.private_key_file).read_text()
+
+
+def make_keys(
+    name: str,
+    key_name: str,
+    tags: dict,
+    managed: bool = False,
+    public_key: Optional[str] = None,
+    algorithm: str = "ed25519"
+) -> StackKeys:
+    """Make the EC2 key pair from `public_key` or from a new managed key."""
+    if not managed:
+        if not public_key:
+            raise ValueError("set public_key (see `just key-pair-new`) or manage_keys")
+        key_pair = ec2.KeyPair(name, key_name=key_name, public_key=public_key, tags=tags)
+        return StackKeys(key_pair)
+
+    if algorithm not in KEY_ALGORITHMS:
+        raise ValueError(f"key_algorithm must be one of: {', '.join(KEY_ALGORITHMS)}")
+    # Only stacks that manage their key load the tls provider.
+    import pulumi_tls as tls
+
+    managed_key = tls.PrivateKey(
+        f"{name} private key",
+        algorithm=algorithm.upper(),
+        rsa_bits=4096 if algorithm == "rsa" else None
+    )
+    key_pair = ec2.KeyPair(name, key_name=key_name, public_key=managed_key.public_key_openssh, tags=tags)
+    pulumi.export("private_key", pulumi.Output.secret(managed_key.private_key_openssh))
+    return StackKeys(key_pair, managed_key)
@@ -0,0 +1,253 @@
+"""A caching proxy for R and Python packages, shared by the servers of a stack.
+
+Every node of a cluster installs the same packages from Package Manager and
+PyPI. With `package_cache` set, a small server is deployed next to them that
+runs nginx as a caching proxy for both, and the repository settings of the
+servers (repos.conf, the Connect package repositories, pip.conf) point at it,
+so a package leaves the internet once per stack. Stack config read here (all
+optional):
+
+    package_cache                  deploy the cache and use it
+    package_cache_size_gb          size of the cache, the least recently used
+                                   packages are evicted beyond it (default 50)
+    package_cache_instance_type    instance type of the cache (default t3.small)
+    package_cache_r_packages       R packages (and their dependencies) to fetch
+                                   into the cache when it starts
+    package_cache_python_packages  Python packages to fetch into it
+
+Package files never change once published and are kept for 30 days after
+their last use; the repository indexes are revalidated after a few minutes.
+R binaries are cached per R version, since Package Manager picks the binary
+from the user agent. The cache is only reachable from inside the VPC.
+
+The package lists are read on the first boot of the cache server (see
+server/warm_cache.py), changing them later does not replace it.
+"""
+
+import base64
+import gzip
+import json
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import pulumi
+from pulumi_aws import ec2
+
+from common import SERVER_FILES_DIR
+from common.images import BASE_AMI
+
+PACKAGE_MANAGER = "packagemanager.rstudio.com"
+# Linux binaries for Ubuntu 20.04, the release of BASE_AMI.
+CRAN_PATH = "/cran/__linux__/focal/latest"
+PUBLIC_CRAN_URL = f"https://{PACKAGE_MANAGER}{CRAN_PATH}"
+PUBLIC_PYPI_URL = "https://pypi.org/simple/"
+
+CACHE_DIR = "/var/cache/nginx/packages"
+WARM_DIR = "/opt/package-cache"
+# Root volume for the OS, on top of the cache.
+ROOT_VOLUME_BASE_GB = 8
+
+NGINX_CONF = """\
+# Written by pulumi (common/package_cache.py).
+
+# R asks for packages with "R (<version> <platform> ...)" as user agent.
+map $http_user_agent $r_version {{
+    "~^R \\((?<version>[0-9]+\\.[0-9]+)" $version;
+    default "";
+}}
+
+proxy_cache_path {cache_dir} levels=1:2 keys_zone=packages:64m max_size={max_size_gb}g inactive=30d use_temp_path=off;
+
+server {{
+    listen 80 default_server;
+
+    proxy_cache packages;
+    proxy_cache_lock on;
+    proxy_cache_lock_timeout 10m;
+    proxy_cache_revalidate on;
+    proxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;
+    proxy_http_version 1.1;
+    proxy_ssl_server_name on;
+    proxy_read_timeout 300s;
+    proxy_max_temp_file_size 4096m;
+    add_header X-Cache-Status $upstream_cache_status always;
+
+    location /cran/ {{
+        proxy_pass https://{package_manager};
+        proxy_set_header Host {package_manager};
+        proxy_cache_key "$request_uri R-$r_version";
+        proxy_cache_valid 200 30d;
+
+        location ~ /(PACKAGES[^/]*|archive\\.rds)$ {{
+            proxy_pass https://{package_manager};
+            proxy_cache_valid 200 5m;
+        }}
+    }}
+
+    # The indexes link to files.pythonhosted.org, which is proxied below.
+    location /pypi/ {{
+        proxy_pass https://pypi.org/;
+        proxy_set_header Host pypi.org;
+        proxy_set_header Accept-Encoding "";
+        proxy_cache_key "$request_uri $http_accept";
+        proxy_cache_valid 200 5m;
+        sub_filter "https://files.pythonhosted.org/" "/pythonhosted/";
+        sub_filter_once off;
+        sub_filter_types text/html application/vnd.pypi.simple.v1+html application/vnd.pypi.simple.v1+json;
+    }}
+
+    location /pythonhosted/ {{
+        proxy_pass https://files.pythonhosted.org/;
+        proxy_set_header Host files.pythonhosted.org;
+        proxy_cache_valid 200 30d;
+    }}
+}}
+"""
+
+
+@dataclass
+class PackageCacheSettings:
+    enabled: bool = False
+    size_gb: int = 50
+    instance_type: str = "t3.small"
+    r_packages: List[str] = field(default_factory=list)
+    python_packages: List[str] = field(default_factory=list)
+
+
+def settings_from_config(config: pulumi.Config) -> PackageCacheSettings:
+    settings = PackageCacheSettings(
+        enabled=config.get_bool("package_cache") or False,
+        size_gb=config.get_int("package_cache_size_gb") or 50,
+        instance_type=config.get("package_cache_instance_type") or "t3.small",
+        r_packages=config.get_object("package_cache_r_packages") or [],
+        python_packages=config.get_object("package_cache_python_packages") or [],
+    )
+    if settings.size_gb < 1:
+        raise ValueError("package_cache_size_gb must be at least 1")
+    return settings
+
+
+@dataclass
+class PackageCache:
+    """Where the servers find the cache."""
+    private_ip: pulumi.Output
+
+    @property
+    def cran_url(self) -> pulumi.Output:
+        return pulumi.Output.concat("http://", self.private_ip, CRAN_PATH)
+
+    @property
+    def pypi_url(self) -> pulumi.Output:
+        return pulumi.Output.concat("http://", self.private_ip, "/pypi/simple/")
+
+
+def cran_url(cache: Optional[PackageCache]) -> pulumi.Output:
+    """The CRAN repository for the servers, the cache if there is one."""
+    if cache is None:
+        return pulumi.Output.from_input(PUBLIC_CRAN_URL)
+    return cache.cran_url
+
+
+def repos_conf(cache: Optional[PackageCache]) -> pulumi.Output:
+    """/etc/rstudio/repos.conf for Workbench.
+
+    Shipped with and without the cache, so that turning the cache off points
+    the servers back at Package Manager.
+    """
+    return cran_url(cache).apply(lambda url: f"CRAN={url}\n")
+
+
+def pip_conf(cache: Optional[PackageCache]) -> pulumi.Output:
+    """/etc/pip.conf, PyPI without the cache.
+
+    The cache is plain http inside the VPC, so it is a trusted host.
+    """
+    if cache is None:
+        return pulumi.Output.from_input(f"[global]\nindex-url = {PUBLIC_PYPI_URL}\n")
+    return pulumi.Output.all(cache.pypi_url, cache.private_ip).apply(
+        lambda x: f"[global]\nindex-url = {x[0]}\ntrusted-host = {x[1]}\n"
+    )
+
+
+def nginx_conf(settings: PackageCacheSettings) -> str:
+    return NGINX_CONF.format(
+        cache_dir=CACHE_DIR,
+        max_size_gb=settings.size_gb,
+        package_manager=PACKAGE_MANAGER,
+    )
+
+
+def user_data(settings: PackageCacheSettings, r_version: str, python_version: str) -> str:
+    """Base64 encoded (gzipped) cloud-config that sets up the cache."""
+    warm = {
+        "cache_url": "http://127.0.0.1",
+        "cran_path": CRAN_PATH,
+        "r_version": r_version,
+        "r_packages": settings.r_packages,
+        "python_version": python_version,
+        "python_packages": settings.python_packages,
+    }
+    document = {
+        "packages": ["nginx", "python3-pip"],
+        "write_files": [
+            {"path": "/etc/nginx/sites-available/default", "content": nginx_conf(settings)},
+            {"path": f"{WARM_DIR}/warm_cache.py", "content": (SERVER_FILES_DIR / "warm_cache.py").read_text()},
+            {"path": f"{WARM_DIR}/warm.json", "content": json.dumps(warm, indent=2)},
+        ],
+        "runcmd": [
+            f"mkdir -p {CACHE_DIR}",
+            f"chown www-data:www-data {CACHE_DIR}",
+            "systemctl restart nginx",
+            # In the background, the servers can use the cache meanwhile.
+            f"nohup python3 {WARM_DIR}/warm_cache.py {WARM_DIR}/warm.json > /var/log/package-cache-warm.log 2>&1 &",
+        ],
+    }
+    # JSON is valid YAML, and it needs no care with indentation or quoting.
+    data = gzip.compress(("#cloud-config\n" + json.dumps(document)).encode(), mtime=0)
+    return base64.b64encode(data).decode()
+
+
+def make_package_cache(
+    name: str,
+    settings: PackageCacheSettings,
+    tags: dict,
+    r_version: str,
+    python_version: str,
+    subnet_id: Optional[pulumi.Input[str]] = None
+) -> Optional[PackageCache]:
+    """The package cache server, or None when `package_cache` is not set."""
+    if not settings.enabled:
+        return None
+    vpc = ec2.get_vpc(default=True)
+    security_group = ec2.SecurityGroup(
+        f"{name} package cache sg",
+        description="Package cache, HTTP from inside the VPC",
+        ingress=[
+            {"protocol": "TCP", "from_port": 80, "to_port": 80, "cidr_blocks": [vpc.cidr_block], "description": "HTTP"},
+        ],
+        egress=[
+            {"protocol": "All", "from_port": -1, "to_port": -1, "cidr_blocks": ["0.0.0.0/0"], "description": "Allow all outbound traffic"},
+        ],
+        tags=tags,
+    )
+    server = ec2.Instance(
+        f"{name} package cache",
+        instance_type=settings.instance_type,
+        ami=BASE_AMI,
+        subnet_id=subnet_id,
+        vpc_security_group_ids=[security_group.id],
+        root_block_device=ec2.InstanceRootBlockDeviceArgs(
+            volume_size=settings.size_gb + ROOT_VOLUME_BASE_GB,
+            volume_type="gp3",
+            delete_on_termination=True,
+        ),
+        user_data_base64=user_data(settings, r_version, python_version),
+        tags=tags,
+    )
+    cache = PackageCache(server.private_ip)
+    pulumi.export("package_cache", {
+        "private_ip": server.private_ip,
+        "cran_url": cache.cran_url,
+        "pypi_url": cache.pypi_url,
+    })
+    return cache
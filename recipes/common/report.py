@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""Report where the time of a `pulumi up` went.
+
+Reads the log written by `pulumi up --logtostderr -v=<n> 2> _logs.txt` and
+prints a timeline of the resources that were created, updated or replaced,
+how many of them ran at once, and the critical path (the chain of resources
+that determined the total time). The dependencies between resources are
+taken from `pulumi stack export` when given, and guessed from the timeline
+otherwise.
+
+The timings of the server side steps (the `build_timings` stack output) can
+be added with --timings.
+
+Usage:
+
+    python3 report.py _logs.txt [--stack _stack.json] [--timings _timings.json]
+
+Only the python standard library is used.
+"""
+
+import argparse
+import json
+import re
+import sys
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# glog header: I0817 12:34:56.789012   12345 file.go:123] message
+GLOG_LINE = re.compile(r"^[IWEF](\d{4} \d{2}:\d{2}:\d{2}\.\d{6})\s+\d+\s+[^\]]+\] (.*)$")
+# Resource names can contain spaces ("server copy ~/.env"), so a URN only ends
+# at what the engine writes after one: a quote or bracket, the next field of a
+# "key=value, " list, the next URN of a list, " (preview ...)", the word the
+# step executor appends ("... retired", "... failed, signalling cancellation")
+# or the end of the line.
+URN_END = r"(?=['\"\]]|, [#\w]+=| \(| urn:pulumi:| (?:applied|completed|failed|retired|succeeded)\b|\s*$)"
+URN_PATTERN = rf"urn:pulumi:[^\s\"']+::[^\"'\]\n]+?{URN_END}"
+URN = re.compile(URN_PATTERN)
+# The step executor names the operation, e.g. "step create on urn:...".
+STEP = re.compile(rf"\bstep (\w+) on ({URN_PATTERN})")
+# Operations that do nothing and are left out of the timeline.
+NO_OPS = {"same", "read", "refresh"}
+
+BAR_WIDTH = 50
+
+
+@dataclass
+class Span:
+    urn: str
+    start: float
+    end: float
+    ops: List[str] = field(default_factory=list)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    @property
+    def name(self) -> str:
+        # urn:pulumi:stack::project::parent$type::name
+        parts = self.urn.split("::", 3)
+        if len(parts) < 4:
+            return self.urn
+        return f"{parts[3]} ({parts[2].rsplit('$', 1)[-1]})"
+
+
+def parse_time(text: str) -> float:
+    # glog leaves out the year, which does not matter for durations (unless
+    # the run spans new year).
+    return datetime.strptime(f"2000{text}", "%Y%m%d %H:%M:%S.%f").timestamp()
+
+
+def parse_log(path: str) -> List[Span]:
+    """One span per resource: from the first to the last log line about it."""
+    spans: Dict[str, Span] = {}
+    with open(path, errors="replace") as f:
+        for line in f:
+            match = GLOG_LINE.match(line)
+            if not match:
+                continue
+            t = parse_time(match.group(1))
+            message = match.group(2)
+            for step in STEP.finditer(message):
+                op, urn = step.groups()
+                span = spans.setdefault(urn, Span(urn, t, t))
+                if op not in span.ops:
+                    span.ops.append(op)
+            for urn in URN.findall(message):
+                span = spans.setdefault(urn, Span(urn, t, t))
+                span.start = min(span.start, t)
+                span.end = max(span.end, t)
+    return [
+        span for span in spans.values()
+        # The stack itself spans the whole run, and resources whose only
+        # step did nothing are not interesting.
+        if "pulumi:pulumi:Stack" not in span.urn and not (span.ops and set(span.ops) <= NO_OPS)
+    ]
+
+
+def load_dependencies(path: Optional[str]) -> Optional[Dict[str, List[str]]]:
+    if not path:
+        return None
+    state = json.loads(Path(path).read_text())
+    resources = state.get("deployment", state).get("resources", [])
+    return {r["urn"]: r.get("dependencies", []) + ([r["parent"]] if r.get("parent") else []) for r in resources}
+
+
+def critical_path(spans: List[Span], dependencies: Optional[Dict[str, List[str]]]) -> List[Span]:
+    """Walk back from the resource that finished last.
+
+    Each step goes to the dependency that finished last (with the stack
+    export) or to the resource that finished last before this one started
+    (without it).
+    """
+    by_urn = {span.urn: span for span in spans}
+    current = max(spans, key=lambda s: s.end)
+    path = [current]
+    while True:
+        if dependencies is not None:
+            candidates = [by_urn[u] for u in dependencies.get(current.urn, []) if u in by_urn]
+        else:
+            candidates = [s for s in spans if s.end <= current.start and s is not current]
+        if not candidates:
+            break
+        current = max(candidates, key=lambda s: s.end)
+        path.append(current)
+    return list(reversed(path))
+
+
+def concurrency(spans: List[Span]) -> Dict[int, float]:
+    """Seconds spent with n resources in progress, for every n."""
+    events = sorted([(s.start, 1) for s in spans] + [(s.end, -1) for s in spans])
+    seconds: Dict[int, float] = {}
+    running, last = 0, events[0][0]
+    for t, change in events:
+        seconds[running] = seconds.get(running, 0.0) + t - last
+        running += change
+        last = t
+    return seconds
+
+
+def print_timeline(spans: List[Span], critical: List[Span]):
+    t0 = min(s.start for s in spans)
+    total = max(s.end for s in spans) - t0 or 1.0
+    on_path = {s.urn for s in critical}
+    width = min(max(len(s.name) for s in spans), 60)
+    print(f"{'resource':<{width}}  {'start':>7} {'duration':>9}")
+    for s in sorted(spans, key=lambda s: s.start):
+        offset = int((s.start - t0) / total * BAR_WIDTH)
+        length = max(1, int(s.duration / total * BAR_WIDTH))
+        bar = " " * offset + ("#" if s.urn in on_path else "=") * length
+        print(f"{s.name[:width]:<{width}}  {s.start - t0:>6.1f}s {s.duration:>8.1f}s  |{bar:<{BAR_WIDTH}}|")
+
+
+def print_summary(spans: List[Span], critical: List[Span], inferred: bool):
+    t0 = min(s.start for s in spans)
+    wall = max(s.end for s in spans) - t0
+    busy = sum(s.duration for s in spans)
+    seconds = concurrency(spans)
+    print(f"\nwall clock {wall:.1f}s, sum of resources {busy:.1f}s, "
+          f"average parallelism {busy / wall if wall else 0:.1f}, maximum {max(seconds)}")
+    idle = seconds.get(0, 0.0)
+    if idle:
+        print(f"nothing in progress for {idle:.1f}s")
+
+    print(f"\ncritical path{' (inferred from the timeline, pass --stack for the real dependencies)' if inferred else ''}:")
+    previous = None
+    for s in critical:
+        wait = s.start - previous.end if previous else s.start - t0
+        print(f"  {s.duration:>8.1f}s  (+{max(wait, 0):.1f}s wait)  {s.name}")
+        previous = s
+
+
+def print_build_timings(path: str):
+    data = json.loads(sys.stdin.read() if path == "-" else Path(path).read_text())
+    # {step: record} for a single server, {node: {step: record}} for rsw-ha.
+    servers = data if data and all(isinstance(v, dict) and "step" not in v for v in data.values()) else {"server": data}
+    for server, timings in servers.items():
+        records = sorted(timings.values(), key=lambda r: -r["duration"])
+        if not records:
+            continue
+        total = sum(r["duration"] for r in records)
+        width = max(len(r["step"]) for r in records)
+        print(f"\n{server}: server side steps by duration")
+        for r in records:
+            print(f"  {r['step']:<{width}}  {r['status']:<7} {r['duration']:>8.1f}s  {r['duration'] / total:>4.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("log", help="log written by pulumi up --logtostderr")
+    parser.add_argument("--stack", help="output of pulumi stack export, for the dependencies")
+    parser.add_argument("--timings", help="output of pulumi stack output build_timings --json ('-' for stdin)")
+    args = parser.parse_args()
+
+    spans = parse_log(args.log)
+    if not spans:
+        sys.exit(f"report: no resources found in {args.log}, was pulumi run with --logtostderr -v=9?")
+    dependencies = load_dependencies(args.stack)
+    critical = critical_path(spans, dependencies)
+    print_timeline(spans, critical)
+    print_summary(spans, critical, inferred=dependencies is None)
+    if args.timings:
+        print_build_timings(args.timings)
+
+
+if __name__ == "__main__":
+    main()
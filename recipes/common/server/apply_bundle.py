@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Install the config files from a config bundle.
+
+A config bundle is a .tar.gz made by pulumi (see common/bundle.py) that holds
+the rendered config files and a manifest.json:
+
+    {
+      "files": [
+        {
+          "name": "rserver.conf",
+          "destination": "/etc/rstudio/rserver.conf",
+          "sha256": "...",
+          "mode": "0644",
+          "owner": null,
+          "service": "rstudio-server"
+        }
+      ]
+    }
+
+Only the files whose sha256 differs from the installed copy are installed,
+and a service is reloaded only when one of its files changed, in the order of
+RELOAD_COMMANDS. In files with
+"substitute" set, the @@PUBLIC_IP@@ and @@PUBLIC_HOSTNAME@@ placeholders are
+replaced with values from the EC2 instance metadata first.
+
+The files installed by a bundle are recorded in STATE_PATH. A file that the
+previous bundle installed and the new one no longer lists is deleted (unless
+it was changed on the server since), and its service is reloaded too if it
+still has files in the bundle. A service whose files all left the bundle is
+not reloaded, as it is no longer configured by the bundle.
+
+Usage (as root):
+
+    python3 apply_bundle.py config-bundle.tar.gz
+
+Only the python standard library is used because this runs on the server.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import urllib.request
+from pathlib import Path
+from typing import Optional
+
+# How to reload each service, and whether a failed reload is an error.
+# Services are reloaded in this order, so the ones that others connect to come
+# first.
+RELOAD_COMMANDS = {
+    "pgbouncer": (["systemctl", "reload-or-restart", "pgbouncer"], True),
+    "rstudio-server": (["rstudio-server", "restart"], True),
+    # rstudio-launcher restart can exit with an error even though it
+    # restarted, so a failure is only reported.
+    "rstudio-launcher": (["rstudio-launcher", "restart"], False),
+    "rstudio-connect": (["systemctl", "restart", "rstudio-connect"], True),
+}
+
+METADATA_URL = "http://169.254.169.254/latest"
+
+# The files installed by the last bundle: destination -> sha256 and service.
+STATE_PATH = Path("/var/lib/rstudio-recipes/config-bundle.json")
+
+# Placeholder -> instance metadata path.
+PLACEHOLDERS = {
+    "@@PUBLIC_IP@@": "meta-data/public-ipv4",
+    "@@PUBLIC_HOSTNAME@@": "meta-data/public-hostname",
+}
+
+
+def metadata(path: str) -> str:
+    """Read the instance metadata (IMDSv2)."""
+    request = urllib.request.Request(
+        f"{METADATA_URL}/api/token", method="PUT",
+        headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"}
+    )
+    with urllib.request.urlopen(request, timeout=5) as response:
+        token = response.read().decode()
+    request = urllib.request.Request(f"{METADATA_URL}/{path}", headers={"X-aws-ec2-metadata-token": token})
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return response.read().decode()
+
+
+def substitute(path: Path):
+    text = path.read_text()
+    for placeholder, metadata_path in PLACEHOLDERS.items():
+        if placeholder in text:
+            text = text.replace(placeholder, metadata(metadata_path))
+    path.write_text(text)
+
+
+def sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def install(source: Path, destination: Path, mode: str, owner: Optional[str] = None):
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    tmp = destination.with_name(f".{destination.name}.tmp")
+    shutil.copyfile(source, tmp)
+    os.chmod(tmp, int(mode, 8))
+    if owner:
+        user, _, group = owner.partition(":")
+        shutil.chown(tmp, user, group or None)
+    os.replace(tmp, destination)
+
+
+def read_state() -> dict:
+    if not STATE_PATH.exists():
+        return {}
+    return json.loads(STATE_PATH.read_text())
+
+
+def write_state(state: dict):
+    STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = STATE_PATH.with_name(f".{STATE_PATH.name}.tmp")
+    tmp.write_text(json.dumps(state, indent=2, sort_keys=True))
+    os.replace(tmp, STATE_PATH)
+
+
+def remove(destination: Path, installed_sha256: str) -> bool:
+    """Delete a file the bundle no longer lists. Returns whether it was."""
+    if not destination.exists():
+        return False
+    if sha256(destination) != installed_sha256:
+        print(f"kept       {destination} (changed since it was installed)")
+        return False
+    destination.unlink()
+    print(f"removed    {destination}")
+    return True
+
+
+def apply(bundle: str) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        with tarfile.open(bundle, "r:gz") as tar:
+            tar.extractall(tmp)
+        manifest = json.loads((Path(tmp) / "manifest.json").read_text())
+
+        previous = read_state()
+        state = {}
+        services = []
+        for entry in manifest["files"]:
+            source = Path(tmp) / "files" / entry["name"]
+            destination = Path(entry["destination"])
+            if sha256(source) != entry["sha256"]:
+                print(f"apply_bundle: {entry['name']} does not match the manifest", file=sys.stderr)
+                return 1
+            if entry.get("substitute"):
+                substitute(source)
+            service = entry.get("service")
+            state[str(destination)] = {"sha256": sha256(source), "service": service}
+            if destination.exists() and sha256(destination) == sha256(source):
+                print(f"unchanged  {destination}")
+                continue
+            install(source, destination, entry.get("mode", "0644"), entry.get("owner"))
+            print(f"installed  {destination}")
+            if service and service not in services:
+                services.append(service)
+
+    configured = {entry["service"] for entry in state.values()}
+    for destination, installed in previous.items():
+        if destination in state or not remove(Path(destination), installed["sha256"]):
+            continue
+        service = installed.get("service")
+        if service and service in configured and service not in services:
+            services.append(service)
+    write_state(state)
+
+    status = 0
+    for service in sorted(services, key=list(RELOAD_COMMANDS).index):
+        command, required = RELOAD_COMMANDS[service]
+        print(f"reloading  {service}", flush=True)
+        if subprocess.run(command).returncode != 0:
+            print(f"apply_bundle: reloading {service} failed", file=sys.stderr)
+            if required:
+                status = 1
+    return status
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    sys.exit(apply(sys.argv[1]))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""Run justfile recipes as a dependency graph.
+
+This file is copied to each server next to the justfile. The steps and the
+dependencies between them are declared in a json file:
+
+    {
+      "steps": {
+        "download-r": {},
+        "install-r": {"needs": ["download-r"], "lock": "dpkg"}
+      },
+      "targets": {
+        "bake-rsw": ["install-r"]
+      }
+    }
+
+Every step is a recipe in the justfile. A step starts as soon as all of the
+steps it needs have finished, so downloads run concurrently. Steps that share
+a lock (for example everything that calls apt or gdebi) run one at a time.
+
+Usage:
+
+    python3 steprunner.py build-steps.json bake-rsw
+    python3 steprunner.py build-steps.json install-r symlink-r --only
+
+With --only exactly the listed steps run, one after the other, without the
+steps they need (this is how pulumi runs each build stage). Either way the
+timing of every step is appended to ~/logs/timings.jsonl.
+
+Every declared step that succeeds leaves a stamp in ~/.stamps with a key
+made from its inputs: the commands of the recipe as `just --dry-run` prints
+them (so with the versions and urls filled in from .env) and the keys of the
+steps it needs. A step whose stamp matches is skipped, so running a build
+again after a failure continues from the step that failed. Steps declared
+with "stamp": false always run, and so do all of them with --force.
+
+Only the python standard library is used because this runs on a fresh server.
+"""
+
+import argparse
+import hashlib
+import json
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List, Optional
+
+LOG_DIR = Path.home() / "logs"
+TIMINGS_FILE = LOG_DIR / "timings.jsonl"
+STAMP_DIR = Path.home() / ".stamps"
+
+# A step that ran successfully or was skipped because its stamp matched.
+DONE = ("ok", "skipped")
+
+
+class Step:
+    def __init__(self, name: str, needs: List[str], lock: str = None):
+        self.name = name
+        self.needs = needs
+        self.lock = lock
+        self.status = "pending"
+        self.start = None
+        self.end = None
+        self.waited = 0.0
+
+    @property
+    def duration(self) -> float:
+        if self.start is None:
+            return 0.0
+        return (self.end or time.time()) - self.start
+
+
+def load_steps(path: str, targets: List[str], only: bool = False) -> Dict[str, Step]:
+    """Load the steps needed (directly or not) to build `targets`.
+
+    With `only`, just the `targets` themselves are loaded and each one needs
+    the one before it, so they run in order.
+    """
+    spec = json.loads(Path(path).read_text())
+    declared = spec["steps"]
+    if only:
+        steps = {}
+        for i, name in enumerate(targets):
+            steps[name] = Step(name, targets[i - 1:i], declared.get(name, {}).get("lock"))
+        return steps
+
+    wanted = []
+    for target in targets:
+        if target in spec.get("targets", {}):
+            wanted.extend(spec["targets"][target])
+        elif target in declared:
+            wanted.append(target)
+        else:
+            sys.exit(f"steprunner: unknown target '{target}'")
+
+    steps = {}
+    while wanted:
+        name = wanted.pop()
+        if name in steps:
+            continue
+        if name not in declared:
+            sys.exit(f"steprunner: unknown step '{name}'")
+        options = declared[name]
+        steps[name] = Step(name, options.get("needs", []), options.get("lock"))
+        wanted.extend(steps[name].needs)
+    check_acyclic(steps)
+    return steps
+
+
+class Stamps:
+    """The stamps of the declared steps that succeeded, keyed on their inputs."""
+
+    def __init__(self, path: str, just: str, enabled: bool = True):
+        self.declared = json.loads(Path(path).read_text())["steps"]
+        self.just = just
+        self.enabled = enabled
+        self.keys: Dict[str, Optional[str]] = {}
+
+    def key(self, name: str) -> Optional[str]:
+        """The key of a step, None if it has no stamp."""
+        if name not in self.keys:
+            self.keys[name] = self._key(name)
+        return self.keys[name]
+
+    def _key(self, name: str) -> Optional[str]:
+        if name not in self.declared or not self.declared[name].get("stamp", True):
+            return None
+        result = subprocess.run([self.just, "--dry-run", name], capture_output=True, text=True)
+        if result.returncode:
+            return None
+        digest = hashlib.sha256((result.stdout + result.stderr).encode())
+        for need in self.declared[name].get("needs", []):
+            digest.update(f"{need}={self.key(need)}".encode())
+        return digest.hexdigest()
+
+    def matches(self, name: str) -> bool:
+        key = self.key(name) if self.enabled else None
+        path = STAMP_DIR / name
+        return key is not None and path.exists() and path.read_text().strip() == key
+
+    def record(self, name: str, ok: bool):
+        path = STAMP_DIR / name
+        key = self.key(name)
+        if ok and key is not None:
+            STAMP_DIR.mkdir(exist_ok=True)
+            path.write_text(key + "\n")
+        else:
+            path.unlink(missing_ok=True)
+
+
+def check_acyclic(steps: Dict[str, Step]):
+    visiting, done = set(), set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in visiting:
+            sys.exit("steprunner: dependency cycle " + " -> ".join(path + [name]))
+        visiting.add(name)
+        for need in steps[name].needs:
+            visit(need, path + [name])
+        visiting.discard(name)
+        done.add(name)
+
+    for name in steps:
+        visit(name, [])
+
+
+def run_step(step: Step, just: str, locks: Dict[str, threading.Lock], stamps: Stamps) -> int:
+    if stamps.matches(step.name):
+        step.status = "skipped"
+        return 0
+    lock = locks[step.lock] if step.lock else None
+    queued = time.time()
+    if lock:
+        lock.acquire()
+    try:
+        step.waited = time.time() - queued
+        step.start = time.time()
+        step.status = "running"
+        log_path = LOG_DIR / f"{step.name}.log"
+        with open(log_path, "w") as log:
+            result = subprocess.run([just, step.name], stdout=log, stderr=subprocess.STDOUT)
+        step.end = time.time()
+        step.status = "ok" if result.returncode == 0 else "failed"
+        stamps.record(step.name, result.returncode == 0)
+        return result.returncode
+    finally:
+        if lock:
+            lock.release()
+
+
+def run(steps: Dict[str, Step], just: str, jobs: int, stamps: Stamps) -> bool:
+    LOG_DIR.mkdir(exist_ok=True)
+    locks = {step.lock: threading.Lock() for step in steps.values() if step.lock}
+    running = {}
+    failed = False
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while True:
+            if not failed:
+                for step in steps.values():
+                    ready = all(steps[n].status in DONE for n in step.needs)
+                    if step.status == "pending" and ready:
+                        step.status = "queued"
+                        print(f"[steprunner] start   {step.name}", flush=True)
+                        running[pool.submit(run_step, step, just, locks, stamps)] = step.name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = steps[running.pop(future)]
+                if future.exception() is not None:
+                    step.status = "failed"
+                    print(f"[steprunner] error   {step.name}: {future.exception()}", flush=True)
+                print(f"[steprunner] {step.status:<7} {step.name} ({step.duration:.1f}s)", flush=True)
+                if step.status == "failed":
+                    failed = True
+                    log_path = LOG_DIR / f"{step.name}.log"
+                    if log_path.exists():
+                        print(log_path.read_text()[-4000:], flush=True)
+    return not failed
+
+
+def print_timings(steps: Dict[str, Step]):
+    started = [s.start for s in steps.values() if s.start]
+    if not started:
+        return
+    t0 = min(started)
+    ordered = sorted(steps.values(), key=lambda s: (s.start is None, s.start or 0))
+    width = max(len(s.name) for s in ordered)
+    print(f"\n{'step':<{width}}  {'status':<7} {'start':>7} {'wait':>7} {'duration':>9}")
+    for s in ordered:
+        if s.start is None:
+            print(f"{s.name:<{width}}  {s.status:<7} {'-':>7} {'-':>7} {'-':>9}")
+        else:
+            print(f"{s.name:<{width}}  {s.status:<7} {s.start - t0:>6.1f}s {s.waited:>6.1f}s {s.duration:>8.1f}s")
+    ended = [s.end for s in steps.values() if s.end]
+    total = max(ended) - t0 if ended else 0.0
+    serial = sum(s.duration for s in steps.values() if s.start)
+    print(f"\nwall clock {total:.1f}s, sum of steps {serial:.1f}s", flush=True)
+
+
+def record_timings(steps: Dict[str, Step]):
+    """Append the timing of each step that ran to TIMINGS_FILE."""
+    with open(TIMINGS_FILE, "a") as f:
+        for s in sorted(steps.values(), key=lambda s: s.start or 0):
+            if s.start is None:
+                continue
+            f.write(json.dumps({
+                "step": s.name,
+                "status": s.status,
+                "start": round(s.start, 3),
+                "end": round(s.end or time.time(), 3),
+                "duration": round(s.duration, 3),
+                "waited": round(s.waited, 3),
+            }) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("steps_file")
+    parser.add_argument("targets", nargs="+", metavar="target")
+    parser.add_argument("--just", default="just", help="path to the just executable")
+    parser.add_argument("--jobs", type=int, default=4, help="maximum number of steps to run at once")
+    parser.add_argument("--only", action="store_true", help="run only the given steps, in order")
+    parser.add_argument("--force", action="store_true", help="run the steps even if their stamps match")
+    args = parser.parse_args()
+
+    steps = load_steps(args.steps_file, args.targets, args.only)
+    stamps = Stamps(args.steps_file, args.just, enabled=not args.force)
+    ok = run(steps, args.just, args.jobs, stamps)
+    print_timings(steps)
+    record_timings(steps)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Warm the package cache with a list of R and Python packages.
+
+Runs on the package cache server once nginx is up. Every package is
+downloaded through the cache together with its dependencies, and then thrown
+away, so even the first user who installs it gets it from the cache. The
+list is a json file written by pulumi (see common/package_cache.py):
+
+    {
+      "cache_url": "http://127.0.0.1",
+      "cran_path": "/cran/__linux__/focal/latest",
+      "r_version": "4.1.2",
+      "r_packages": ["shiny", "tidyverse"],
+      "python_version": "3.10.4",
+      "python_packages": ["pandas", "numpy"]
+    }
+
+R packages are fetched with the user agent of R, so Package Manager serves
+(and the cache keeps) the same Linux binaries that R on the servers asks
+for. Python packages are fetched with `pip download` for the Python version
+of the servers.
+
+Usage:
+
+    python3 warm_cache.py warm.json
+
+Only the python standard library is used because this runs on the server.
+"""
+
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set
+
+# Packages that come with R.
+BASE_PACKAGES = {
+    "R", "base", "compiler", "datasets", "grDevices", "graphics", "grid", "methods",
+    "parallel", "splines", "stats", "stats4", "tcltk", "tools", "utils",
+}
+DEPENDENCY_FIELDS = ("Depends", "Imports", "LinkingTo")
+WORKERS = 8
+
+
+def r_user_agent(r_version: str) -> str:
+    return f"R ({r_version} x86_64-pc-linux-gnu x86_64 linux-gnu)"
+
+
+def fetch(url: str, user_agent: str) -> bytes:
+    request = urllib.request.Request(url, headers={"User-Agent": user_agent})
+    with urllib.request.urlopen(request, timeout=300) as response:
+        return response.read()
+
+
+def parse_packages(text: str) -> Dict[str, Dict[str, str]]:
+    """The records of a PACKAGES file (Debian control format) by package."""
+    packages = {}
+    for block in text.split("\n\n"):
+        record: Dict[str, str] = {}
+        key = None
+        for line in block.splitlines():
+            if line[:1].isspace() and key:
+                record[key] += " " + line.strip()
+            elif ":" in line:
+                key, _, value = line.partition(":")
+                record[key] = value.strip()
+        if "Package" in record:
+            packages[record["Package"]] = record
+    return packages
+
+
+def dependencies(record: Dict[str, str]) -> List[str]:
+    names = []
+    for field in DEPENDENCY_FIELDS:
+        for item in record.get(field, "").split(","):
+            name = item.split("(")[0].strip()
+            if name and name not in BASE_PACKAGES:
+                names.append(name)
+    return names
+
+
+def resolve(wanted: List[str], packages: Dict[str, Dict[str, str]]) -> Set[str]:
+    """`wanted` and everything they depend on."""
+    found: Set[str] = set()
+    todo = list(wanted)
+    while todo:
+        name = todo.pop()
+        if name in found:
+            continue
+        if name not in packages:
+            print(f"warm: R package {name} is not in the repository", file=sys.stderr)
+            continue
+        found.add(name)
+        todo.extend(dependencies(packages[name]))
+    return found
+
+
+def warm_r(settings: dict) -> int:
+    if not settings.get("r_packages"):
+        return 0
+    user_agent = r_user_agent(settings["r_version"])
+    contrib = settings["cache_url"] + settings["cran_path"] + "/src/contrib"
+    packages = parse_packages(fetch(f"{contrib}/PACKAGES", user_agent).decode())
+    names = sorted(resolve(settings["r_packages"], packages))
+
+    def download(name: str) -> int:
+        try:
+            return len(fetch(f"{contrib}/{name}_{packages[name]['Version']}.tar.gz", user_agent))
+        except OSError as e:
+            print(f"warm: {name}: {e}", file=sys.stderr)
+            return 0
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        size = sum(pool.map(download, names))
+    print(f"warm: {len(names)} R packages, {size / 1024**2:.0f} MiB")
+    return len(names)
+
+
+def warm_python(settings: dict) -> int:
+    if not settings.get("python_packages"):
+        return 0
+    index = settings["cache_url"] + "/pypi/simple/"
+    python_version = ".".join(settings["python_version"].split(".")[:2])
+    warmed = 0
+    with tempfile.TemporaryDirectory() as dest:
+        # One at a time, so a package without a wheel does not stop the rest.
+        for name in settings["python_packages"]:
+            result = subprocess.run([
+                sys.executable, "-m", "pip", "download", name,
+                "--dest", dest,
+                "--index-url", index,
+                "--python-version", python_version,
+                "--platform", "manylinux2014_x86_64",
+                "--platform", "manylinux_2_17_x86_64",
+                "--platform", "manylinux_2_28_x86_64",
+                "--only-binary", ":all:",
+                "--quiet",
+            ])
+            if result.returncode:
+                print(f"warm: pip could not download {name}", file=sys.stderr)
+            else:
+                warmed += 1
+    print(f"warm: {warmed} Python packages (with dependencies)")
+    return warmed
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    with open(sys.argv[1]) as f:
+        settings = json.load(f)
+    start = time.monotonic()
+    warm_r(settings)
+    warm_python(settings)
+    print(f"warm: done in {time.monotonic() - start:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
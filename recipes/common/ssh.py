@@ -0,0 +1,140 @@
+"""Run the provisioning steps over one shared SSH connection per host.
+
+Every `remote.Command` and `remote.CopyFile` opens its own SSH connection, so
+a server with a dozen steps pays for a dozen handshakes. With `ssh_multiplex`
+set, `command` and `copy_file` run the steps through `ssh_exec.py` instead,
+which keeps a single OpenSSH master connection per host for the whole
+`pulumi up`, limits the number of steps using it at once and retries while
+the instance is still booting.
+
+`connection` returns the connection to pass to `command` and `copy_file` (and
+to the other helpers in common); without multiplexing it is a plain
+`remote.ConnectionArgs` and the steps are the usual `remote` resources.
+
+The private key reaches `ssh_exec.py` as a secret in its environment and is
+only written to a file while it runs, so the inputs of the steps (and the
+state) are the same on every machine and no key is left on disk.
+"""
+
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, List, Optional, Union
+
+import pulumi
+from pulumi_command import local, remote
+
+SSH_EXEC = Path(__file__).resolve().parent / "ssh_exec.py"
+
+
+@dataclass
+class Connection:
+    """A host reached through a shared SSH connection."""
+    host: pulumi.Input[str]
+    user: str
+    private_key: pulumi.Input[str]
+    max_sessions: int = 4
+
+    def environment(self) -> dict:
+        return {
+            "SSH_HOST": self.host,
+            "SSH_USER": self.user,
+            "SSH_PRIVATE_KEY": pulumi.Output.secret(self.private_key),
+            "SSH_MAX_SESSIONS": str(self.max_sessions),
+        }
+
+
+AnyConnection = Union[remote.ConnectionArgs, Connection]
+
+
+def connection(
+    host: pulumi.Input[str],
+    user: str,
+    private_key: pulumi.Input[str],
+    multiplex: bool = False,
+    max_sessions: int = 4
+) -> AnyConnection:
+    if not multiplex:
+        return remote.ConnectionArgs(host=host, user=user, private_key=private_key)
+    return Connection(
+        host=host,
+        user=user,
+        private_key=private_key,
+        max_sessions=max_sessions
+    )
+
+
+def _ssh_exec(mode: str) -> str:
+    # Relative to the project directory, so the command (and the state) is the
+    # same on every machine.
+    return f"python3 {os.path.relpath(SSH_EXEC)} {mode}"
+
+
+def _local_path(path: pulumi.Input[str]) -> pulumi.Input[str]:
+    # Files in the repository are passed relative to the project directory too.
+    return os.path.relpath(path) if isinstance(path, str) else path
+
+
+def command(
+    name: str,
+    create: pulumi.Input[str],
+    connection: AnyConnection,
+    opts: Optional[pulumi.ResourceOptions] = None,
+    triggers: Optional[List[Any]] = None
+) -> pulumi.Resource:
+    """A `remote.Command` that can run over a shared connection."""
+    if not isinstance(connection, Connection):
+        return remote.Command(name, create=create, connection=connection, opts=opts, triggers=triggers)
+    return local.Command(
+        name,
+        create=_ssh_exec("run"),
+        environment=connection.environment() | {"SSH_COMMAND": create},
+        opts=opts,
+        triggers=triggers
+    )
+
+
+def _exec_connection(connection: AnyConnection) -> Connection:
+    if isinstance(connection, Connection):
+        return connection
+    return Connection(
+        host=connection.host,
+        user=connection.user,
+        private_key=connection.private_key
+    )
+
+
+def copy_file(
+    name: str,
+    local_path: pulumi.Input[str],
+    remote_path: pulumi.Input[str],
+    connection: AnyConnection,
+    opts: Optional[pulumi.ResourceOptions] = None,
+    triggers: Optional[List[Any]] = None,
+    sha256: Optional[pulumi.Input[str]] = None,
+    fetch: Optional[str] = None
+) -> pulumi.Resource:
+    """A `remote.CopyFile` that can run over a shared connection.
+
+    With `sha256` the file is only uploaded when the server does not already
+    have it with that checksum, and with `fetch` (the arguments of
+    artifact_cache.py) a `local_path` that is missing is downloaded into the
+    artifact cache first. Both need `ssh_exec.py`, so the copy always goes
+    through it.
+    """
+    if sha256 is not None:
+        connection = _exec_connection(connection)
+    if not isinstance(connection, Connection):
+        return remote.CopyFile(
+            name, local_path=local_path, remote_path=remote_path,
+            connection=connection, opts=opts, triggers=triggers
+        )
+    return local.Command(
+        name,
+        create=_ssh_exec("copy"),
+        environment=connection.environment() | {"SSH_LOCAL_PATH": _local_path(local_path), "SSH_REMOTE_PATH": remote_path}
+            | ({"SSH_SHA256": sha256} if sha256 is not None else {})
+            | ({"SSH_FETCH": fetch} if fetch is not None else {}),
+        opts=opts,
+        triggers=triggers
+    )
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Run a command or copy a file over a shared (multiplexed) SSH connection.
+
+Used by common/ssh.py through `local.Command`, so it runs on the machine
+running pulumi. All of the steps for a host share one OpenSSH master
+connection (ControlMaster) that stays open for the whole `pulumi up`, so only
+the first step pays for the SSH handshake. At most SSH_MAX_SESSIONS steps use
+the connection at once, and connecting is retried with a backoff while the
+instance is still booting.
+
+Usage:
+
+    python3 ssh_exec.py run     # runs $SSH_COMMAND
+    python3 ssh_exec.py copy    # copies $SSH_LOCAL_PATH to $SSH_REMOTE_PATH
+
+With SSH_SHA256 set, copy leaves a remote file with that checksum alone.
+With SSH_FETCH set (the arguments of artifact_cache.py), a missing
+SSH_LOCAL_PATH is downloaded into the artifact cache first. SSH_LOCAL_PATH
+can start with `~`.
+
+The connection is read from SSH_HOST, SSH_USER, SSH_PRIVATE_KEY and
+SSH_MAX_SESSIONS. ssh needs the key in a file, so it is written to one that
+only the user can read and deleted again when the step is done. Only the
+python standard library is used.
+"""
+
+import fcntl
+import hashlib
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+CONTROL_DIR = Path(os.getenv("PULUMI_RECIPES_CACHE", "~/.cache/pulumi-recipes")).expanduser() / "ssh"
+
+ARTIFACT_CACHE = Path(__file__).resolve().parent / "artifact_cache.py"
+
+CONNECT_TIMEOUT = 10
+BOOT_TIMEOUT = 600
+
+
+def ssh_options(key_file: str, control_path: Path) -> list:
+    return [
+        "-i", key_file,
+        "-o", "BatchMode=yes",
+        "-o", "StrictHostKeyChecking=no",
+        "-o", "UserKnownHostsFile=/dev/null",
+        "-o", "LogLevel=ERROR",
+        "-o", f"ConnectTimeout={CONNECT_TIMEOUT}",
+        "-o", "ServerAliveInterval=15",
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPath={control_path}",
+        "-o", "ControlPersist=10m",
+    ]
+
+
+@contextmanager
+def file_lock(path: Path, blocking: bool = True):
+    with open(path, "w") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def session_slot(prefix: Path, max_sessions: int):
+    """Wait for one of `max_sessions` slots for a host."""
+    while True:
+        for i in range(max_sessions):
+            with file_lock(prefix.with_name(f"{prefix.name}.slot{i}"), blocking=False) as locked:
+                if locked:
+                    yield
+                    return
+        time.sleep(0.2)
+
+
+def connect(destination: str, options: list, prefix: Path):
+    """Make sure the master connection is up, retrying while the host boots."""
+    # Only one step per host opens the master connection, the others wait for
+    # it and then reuse it.
+    with file_lock(prefix.with_name(f"{prefix.name}.connect")):
+        check = subprocess.run(["ssh", *options, "-O", "check", destination], capture_output=True)
+        if check.returncode == 0:
+            return
+        deadline = time.time() + BOOT_TIMEOUT
+        delay = 2
+        while True:
+            result = subprocess.run(["ssh", *options, destination, "true"], capture_output=True, text=True)
+            if result.returncode == 0:
+                return
+            if time.time() + delay > deadline:
+                sys.exit(f"ssh_exec: could not connect to {destination}: {result.stderr.strip()}")
+            print(f"ssh_exec: waiting for {destination} ({result.stderr.strip()}), retrying in {delay}s", file=sys.stderr, flush=True)
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+@contextmanager
+def key_file(private_key: str):
+    """Write `private_key` to a file for ssh -i, deleted on exit."""
+    fd, path = tempfile.mkstemp(dir=CONTROL_DIR, prefix="key-", suffix=".pem")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(private_key if private_key.endswith("\n") else private_key + "\n")
+        yield path
+    finally:
+        os.unlink(path)
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] not in ("run", "copy"):
+        sys.exit(__doc__)
+    host = os.environ["SSH_HOST"]
+    destination = f"{os.environ['SSH_USER']}@{host}"
+    max_sessions = int(os.getenv("SSH_MAX_SESSIONS", "4"))
+
+    CONTROL_DIR.mkdir(parents=True, exist_ok=True, mode=0o700)
+    # Unix socket paths are short, so the socket is named after a hash.
+    prefix = CONTROL_DIR / hashlib.sha1(destination.encode()).hexdigest()[:16]
+    with key_file(os.environ["SSH_PRIVATE_KEY"]) as key:
+        sys.exit(step(sys.argv[1], destination, ssh_options(key, prefix.with_suffix(".sock")), prefix, max_sessions))
+
+
+def step(mode: str, destination: str, options: list, prefix: Path, max_sessions: int) -> int:
+    """Run the command or copy the file, returns the exit code."""
+    connect(destination, options, prefix)
+    with session_slot(prefix, max_sessions):
+        if mode == "run":
+            result = subprocess.run(["ssh", *options, destination, os.environ["SSH_COMMAND"]])
+        else:
+            remote_path = os.environ["SSH_REMOTE_PATH"]
+            if os.getenv("SSH_SHA256"):
+                check = f"echo {shlex.quote(os.environ['SSH_SHA256'] + '  ' + remote_path)} | sha256sum -c --status - 2>/dev/null"
+                if subprocess.run(["ssh", *options, destination, check]).returncode == 0:
+                    print(f"ssh_exec: {remote_path} is up to date", file=sys.stderr)
+                    return 0
+            local_path = os.path.expanduser(os.environ["SSH_LOCAL_PATH"])
+            if not os.path.exists(local_path) and os.getenv("SSH_FETCH"):
+                subprocess.run(
+                    [sys.executable, str(ARTIFACT_CACHE), *shlex.split(os.environ["SSH_FETCH"])],
+                    stdout=subprocess.DEVNULL, check=True
+                )
+            tmp = shlex.quote(remote_path + ".part")
+            with open(local_path, "rb") as f:
+                result = subprocess.run(
+                    ["ssh", *options, destination, f"cat > {tmp} && mv {tmp} {shlex.quote(remote_path)}"],
+                    stdin=f
+                )
+    return result.returncode
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""Measure how long the recipe programs take to start.
+
+Runs each recipe's `__main__.py` in a fresh interpreter under pulumi's mocks
+(`pulumi.runtime.set_mocks`), so nothing reaches a pulumi engine or AWS, and
+reports two phases:
+
+- import: from the start of the child process until `main()` is called:
+  importing pulumi, the providers, the helpers in `common` and the program.
+- construct: `main()` until every resource of the stack is registered.
+
+This is the part of a `pulumi preview` that runs in the program, paid once
+per stack on every preview in CI. A program that takes longer than the budget
+(total seconds, --budget) fails the run. --importtime lists the slowest
+imports of each program (from `python -X importtime`).
+
+The programs run with a minimal stack config (see BENCH_CONFIG, add or
+override values with --config key=value), `manage_keys` set so no key file
+is needed, and PULUMI_RECIPES_OFFLINE set so no version index is fetched.
+
+Usage:
+
+    python3 startup.py [recipe dir ...] [--repeat 3] [--budget 3] [--importtime 10]
+
+Run it with a python that has the recipe requirements installed (the
+`pulumi-startup` justfile recipes, `startup` in rsw-ha, use the
+recipe's venv).
+"""
+
+import argparse
+import ast
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+RECIPES_DIR = Path(__file__).resolve().parents[1]
+
+# Seconds from interpreter start until every resource is registered.
+DEFAULT_BUDGET = 3.0
+
+# Enough config for every recipe to run with its defaults.
+BENCH_CONFIG = {
+    "email": "startup@example.com",
+    "rsw_license": "startup",
+    "rsc_license": "startup",
+    "mail_trap_user": "startup",
+    "mail_trap_password": "startup",
+    "daily": "false",
+    "ssl": "false",
+    "manage_keys": "true",
+}
+
+RESULT_PREFIX = "startup-result: "
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+# ------------------------------------------------------------------------------
+# Child: run one program under mocks
+# ------------------------------------------------------------------------------
+
+
+def project_name(recipe: Path) -> str:
+    match = re.search(r"^name:\s*(\S+)", (recipe / "Pulumi.yaml").read_text(), re.MULTILINE)
+    if not match:
+        raise SystemExit(f"startup: no project name in {recipe / 'Pulumi.yaml'}")
+    return match.group(1)
+
+
+def split_program(path: Path):
+    """The program without its final `main()` call, and the call."""
+    tree = ast.parse(path.read_text(), str(path))
+    last = tree.body[-1] if tree.body else None
+    if not (
+        isinstance(last, ast.Expr) and isinstance(last.value, ast.Call)
+        and isinstance(last.value.func, ast.Name) and not last.value.args
+    ):
+        raise SystemExit(f"startup: {path} does not end with a main() call")
+    body = ast.Module(body=tree.body[:-1], type_ignores=[])
+    return compile(body, str(path), "exec"), last.value.func.id
+
+
+def run_child(recipe: Path, started: float):
+    """Run the program in `recipe` and print the phase timings as json."""
+    program = recipe / "__main__.py"
+    code, entry = split_program(program)
+    os.chdir(recipe)
+    sys.path.insert(0, str(recipe))
+
+    import asyncio
+
+    import pulumi
+    from pulumi.runtime.stack import run_in_stack
+
+    class Mocks(pulumi.runtime.Mocks):
+        """Echo the inputs of every resource, with the outputs the recipes read."""
+
+        def __init__(self):
+            self.resources = 0
+
+        def new_resource(self, args: pulumi.runtime.MockResourceArgs):
+            self.resources += 1
+            outputs = dict(args.inputs)
+            if args.typ == "aws:ec2/instance:Instance":
+                outputs.update(publicIp="203.0.113.10", privateIp="10.0.0.10", publicDns="ec2.example.com")
+            return f"{args.name}-id", outputs
+
+        def call(self, args: pulumi.runtime.MockCallArgs):
+            if args.token == "aws:ec2/getInstanceType:getInstanceType":
+                return {"instanceType": args.args.get("instanceType"), "defaultVcpus": 2, "memorySize": 4096}
+            return {}
+
+    mocks = Mocks()
+    pulumi.runtime.set_mocks(mocks, project=project_name(recipe), stack="startup", preview=True)
+    namespace = {"__name__": "__main__", "__file__": str(program)}
+    exec(code, namespace)
+    imported = time.perf_counter()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(run_in_stack(namespace[entry]))
+    constructed = time.perf_counter()
+
+    print(RESULT_PREFIX + json.dumps({
+        "import": imported - started,
+        "construct": constructed - imported,
+        "resources": mocks.resources,
+    }), flush=True)
+
+
+# ------------------------------------------------------------------------------
+# Parent: run and report
+# ------------------------------------------------------------------------------
+
+
+def child_env(recipe: Path, overrides: Dict[str, str]) -> Dict[str, str]:
+    project = project_name(recipe)
+    config = {f"{project}:{k}": v for k, v in {**BENCH_CONFIG, **overrides}.items()}
+    env = dict(os.environ)
+    env.update(PULUMI_CONFIG=json.dumps(config), PULUMI_RECIPES_OFFLINE="1")
+    return env
+
+
+def measure(recipe: Path, overrides: Dict[str, str], importtime: bool = False) -> dict:
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + [__file__, "--child", str(recipe)]
+    process = subprocess.run(command, env=child_env(recipe, overrides), capture_output=True, text=True)
+    result = next(
+        (json.loads(line[len(RESULT_PREFIX):]) for line in process.stdout.splitlines() if line.startswith(RESULT_PREFIX)),
+        None
+    )
+    if process.returncode or result is None:
+        tail = "\n".join(process.stderr.strip().splitlines()[-15:])
+        raise RuntimeError(f"{recipe.name} exited with {process.returncode}:\n{tail}")
+    result["importtime"] = process.stderr if importtime else ""
+    return result
+
+
+def slowest_imports(importtime: str, count: int) -> List[tuple]:
+    """The `count` slowest top level imports (cumulative microseconds)."""
+    imports = []
+    for line in importtime.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        # The module names of top level imports follow a single space.
+        if match and len(match.group(3)) == 1:
+            imports.append((int(match.group(2)), match.group(4)))
+    return sorted(imports, reverse=True)[:count]
+
+
+def find_recipes() -> List[Path]:
+    return sorted(p.parent for p in RECIPES_DIR.glob("*/Pulumi.yaml"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recipes", nargs="*", help="recipe directories (default: all of them)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per recipe, the median is reported")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="seconds a program may take to start")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N", help="list the N slowest imports")
+    parser.add_argument("--config", action="append", default=[], metavar="KEY=VALUE", help="extra stack config")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(Path(args.child).resolve(), time.perf_counter())
+        return
+
+    overrides = dict(item.split("=", 1) for item in args.config)
+    recipes = [Path(r).resolve() for r in args.recipes] or find_recipes()
+    print(f"{'recipe':<36} {'import':>8} {'construct':>10} {'total':>8} {'resources':>10}")
+    over_budget = []
+    for recipe in recipes:
+        try:
+            runs = [measure(recipe, overrides) for _ in range(max(1, args.repeat))]
+            profile: Optional[dict] = measure(recipe, overrides, importtime=True) if args.importtime else None
+        except RuntimeError as e:
+            print(f"{recipe.name:<36} failed: {e}")
+            over_budget.append(recipe.name)
+            continue
+        imported = statistics.median(r["import"] for r in runs)
+        constructed = statistics.median(r["construct"] for r in runs)
+        total = imported + constructed
+        status = "ok" if total <= args.budget else f"over the {args.budget:g}s budget"
+        if total > args.budget:
+            over_budget.append(recipe.name)
+        print(
+            f"{recipe.name:<36} {imported:>7.2f}s {constructed:>9.2f}s {total:>7.2f}s "
+            f"{runs[0]['resources']:>10}  {status}"
+        )
+        if profile:
+            for micros, module in slowest_imports(profile["importtime"], args.importtime):
+                print(f"    {micros / 1e6:>7.2f}s  {module}")
+    if over_budget:
+        sys.exit(f"startup: over budget: {', '.join(over_budget)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Provision a server as a graph of pulumi steps.
+
+Instead of a single `just build-*` command, each logical stage of a build
+(users, R, Python, the product, config, restart, ...) is its own command
+(see common/ssh.py). Pulumi then runs independent stages in parallel, and a
+stage only runs again when one of the inputs it consumes changes: the text
+of the justfile recipes it runs plus any extra triggers (versions, rendered
+config files, ...).
+
+The recipes of a stage run through steprunner.py, which records how long
+each of them took in ~/logs/timings.jsonl on the server; `collect_timings`
+reads them back.
+"""
+
+import json
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import pulumi
+
+from common import ssh
+from common.templates import hash_text
+
+JUST = """export PATH="$PATH:$HOME/bin"; """
+
+
+@dataclass
+class Stage:
+    """A stage of the build, made of one or more justfile recipes."""
+    name: str
+    recipes: List[str]
+    needs: List[str] = field(default_factory=list)
+    triggers: List[Any] = field(default_factory=list)
+    depends_on: List[pulumi.Resource] = field(default_factory=list)
+    # Stages to run after, without running again when they do.
+    after: List[str] = field(default_factory=list)
+    # Run again whenever one of the stages it needs runs again (e.g. restart).
+    rerun_with_needs: bool = False
+
+
+def parse_recipes(justfile: str) -> Dict[str, str]:
+    """Map each recipe in `justfile` to its text (header and body)."""
+    recipes = {}
+    name = None
+    for line in Path(justfile).read_text().splitlines():
+        if line and not line[0].isspace():
+            match = re.match(r"^@?([A-Za-z_][\w-]*)[^:]*:(?!=)", line)
+            name = match.group(1) if match else None
+            if name:
+                recipes[name] = ""
+        if name:
+            recipes[name] += line + "\n"
+    return recipes
+
+
+def recipe_hash(recipes: Dict[str, str], name: str) -> str:
+    """Hash of a recipe and (recursively) the recipes it depends on or calls."""
+    seen, text, todo = set(), "", [name]
+    while todo:
+        current = todo.pop()
+        if current in seen:
+            continue
+        seen.add(current)
+        text += recipes[current]
+        header, *body = recipes[current].splitlines()
+        deps = re.findall(r"[\w-]+", header.split(":", 1)[1])
+        deps += [d for line in body for d in re.findall(r"\bjust ([\w-]+)", line)]
+        todo.extend(dep for dep in deps if dep in recipes)
+    return hash_text(text)
+
+
+def make_stages(
+    prefix: str,
+    stages: List[Stage],
+    justfile: str,
+    connection: ssh.AnyConnection,
+    depends_on: List[pulumi.Resource],
+    existing: Optional[Dict[str, pulumi.Resource]] = None
+) -> Dict[str, pulumi.Resource]:
+    """Create one command per stage.
+
+    Stages must be listed after the stages they need. Each stage depends on
+    `depends_on` (the justfile, .env, ... being in place) and on the stages
+    it needs or runs after, which may also be in `existing` (the stages made
+    by an earlier call). Needs that are in neither (for example install
+    stages skipped on a golden image) are ignored. Returns the new commands.
+    """
+    recipes = parse_recipes(justfile)
+    commands = dict(existing or {})
+    created = {}
+    for stage in stages:
+        needs = [commands[n] for n in stage.needs if n in commands]
+        after = [commands[n] for n in stage.after if n in commands]
+        triggers = [recipe_hash(recipes, r) for r in stage.recipes] + stage.triggers
+        if stage.rerun_with_needs:
+            triggers += [command.id for command in needs]
+        commands[stage.name] = created[stage.name] = ssh.command(
+            f"{prefix} {stage.name}",
+            create=JUST + f"python3 steprunner.py build-steps.json {' '.join(stage.recipes)} --only",
+            connection=connection,
+            opts=pulumi.ResourceOptions(depends_on=depends_on + stage.depends_on + needs + after),
+            triggers=triggers
+        )
+    return created
+
+
+def parse_timings(text: str) -> Dict[str, dict]:
+    """The latest timing of each step in a timings.jsonl file."""
+    timings = {}
+    for line in text.splitlines():
+        if line.strip():
+            record = json.loads(line)
+            timings[record["step"]] = record
+    return dict(sorted(timings.items(), key=lambda item: item[1]["start"]))
+
+
+def collect_timings(
+    prefix: str,
+    commands: Dict[str, pulumi.Resource],
+    connection: ssh.AnyConnection
+) -> pulumi.Output:
+    """Read the step timings back from a server once the stages are done.
+
+    Runs again whenever one of the stages in `commands` runs again.
+    """
+    command = ssh.command(
+        f"{prefix} collect timings",
+        create="cat ~/logs/timings.jsonl 2> /dev/null || true",
+        connection=connection,
+        opts=pulumi.ResourceOptions(depends_on=list(commands.values())),
+        triggers=[command.id for command in commands.values()]
+    )
+    return command.stdout.apply(parse_timings)
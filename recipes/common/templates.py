@@ -0,0 +1,76 @@
+"""Template rendering and file hashing.
+
+All of the recipes render their server side config files with jinja and use
+file hashes as pulumi triggers. A single jinja environment (with a bytecode
+cache on disk) and memoized hashes mean each template is read and compiled
+once per program run, no matter how many servers use it.
+
+jinja is only imported when the first template is rendered; a recipe that
+only hashes files never loads it.
+"""
+
+import functools
+import hashlib
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Tuple
+
+import pulumi
+
+from common import CACHE_DIR
+
+if TYPE_CHECKING:
+    import jinja2
+
+
+@functools.lru_cache(maxsize=None)
+def get_environment() -> "jinja2.Environment":
+    """Return the jinja environment used to load every template."""
+    import jinja2
+
+    bytecode_dir = CACHE_DIR / "jinja"
+    bytecode_dir.mkdir(parents=True, exist_ok=True)
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(str(Path.cwd())),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(str(bytecode_dir)),
+    )
+
+
+def create_template(path: str) -> "jinja2.Template":
+    return get_environment().get_template(Path(path).as_posix())
+
+
+def render_template(path: str, **context: Any) -> str:
+    """Render the template at `path`. Renders are memoized on the context."""
+    items = tuple(sorted(context.items()))
+    try:
+        hash(items)
+    except TypeError:
+        return create_template(path).render(**context)
+    return _render(path, _file_key(path), items)
+
+
+@functools.lru_cache(maxsize=None)
+def _render(path: str, file_key: Tuple, context: Tuple) -> str:
+    return create_template(path).render(**dict(context))
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha224(bytes(text, encoding='utf-8')).hexdigest()
+
+
+def hash_file(path: str) -> pulumi.Output:
+    return pulumi.Output.concat(_hash_file(path, _file_key(path)))
+
+
+@functools.lru_cache(maxsize=None)
+def _hash_file(path: str, file_key: Tuple) -> str:
+    with open(path, mode="r") as f:
+        text = f.read()
+    return hash_text(text)
+
+
+def _file_key(path: str) -> Tuple:
+    """Cache key for a file: its absolute path, mtime and size."""
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
@@ -0,0 +1,101 @@
+"""Tests for common/server/apply_bundle.py, installing into a temporary directory."""
+
+import hashlib
+import io
+import json
+import sys
+import tarfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from common.server import apply_bundle
+
+
+@pytest.fixture
+def bundle(tmp_path, monkeypatch):
+    """Makes a bundle of {name: (text, service)} and applies it.
+
+    Returns the services that were reloaded, in order.
+    """
+    monkeypatch.setattr(apply_bundle, "STATE_PATH", tmp_path / "state" / "config-bundle.json")
+    reloaded = []
+    # Commands that record the service instead of reloading it.
+    monkeypatch.setattr(apply_bundle, "RELOAD_COMMANDS", {
+        service: ([sys.executable, "-c", f"open({str(tmp_path / 'reloaded.txt')!r}, 'a').write('{service}\\n')"], required)
+        for service, (_, required) in apply_bundle.RELOAD_COMMANDS.items()
+    })
+
+    def apply(files):
+        path = tmp_path / "config-bundle.tar.gz"
+        manifest = {"files": [
+            {
+                "name": name,
+                "destination": str(tmp_path / "etc" / name),
+                "sha256": hashlib.sha256(text.encode()).hexdigest(),
+                "service": service,
+            }
+            for name, (text, service) in files.items()
+        ]}
+        with tarfile.open(path, "w:gz") as tar:
+            for name, data in [("manifest.json", json.dumps(manifest))] + [
+                (f"files/{name}", text) for name, (text, _) in files.items()
+            ]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data.encode())
+                tar.addfile(info, io.BytesIO(data.encode()))
+        log = tmp_path / "reloaded.txt"
+        log.unlink(missing_ok=True)
+        assert apply_bundle.apply(str(path)) == 0
+        return log.read_text().split() if log.exists() else []
+
+    return tmp_path / "etc", apply
+
+
+FILES = {
+    "rserver.conf": ("www-port=8787\n", "rstudio-server"),
+    "launcher.conf": ("[server]\n", "rstudio-launcher"),
+    "pgbouncer.ini": ("[databases]\n", "pgbouncer"),
+}
+
+
+def test_reloads_in_the_order_of_reload_commands(bundle):
+    etc, apply = bundle
+    assert apply(FILES) == ["pgbouncer", "rstudio-server", "rstudio-launcher"]
+    assert (etc / "rserver.conf").read_text() == "www-port=8787\n"
+
+
+def test_installs_only_changed_files(bundle, capsys):
+    etc, apply = bundle
+    apply(FILES)
+    capsys.readouterr()
+    assert apply(FILES | {"rserver.conf": ("www-port=80\n", "rstudio-server")}) == ["rstudio-server"]
+    out = capsys.readouterr().out
+    assert f"installed  {etc / 'rserver.conf'}" in out
+    assert f"unchanged  {etc / 'launcher.conf'}" in out
+
+
+def test_removes_a_file_dropped_from_the_bundle(bundle):
+    etc, apply = bundle
+    extra = {"logging.conf": ("[*]\n", "rstudio-server")}
+    apply(FILES | extra)
+    assert apply(FILES) == ["rstudio-server"]
+    assert not (etc / "logging.conf").exists()
+
+
+def test_keeps_a_dropped_file_edited_on_the_server(bundle):
+    etc, apply = bundle
+    extra = {"logging.conf": ("[*]\n", "rstudio-server")}
+    apply(FILES | extra)
+    (etc / "logging.conf").write_text("[*]\nlog-level=debug\n")
+    assert apply(FILES) == []
+    assert (etc / "logging.conf").exists()
+
+
+def test_does_not_reload_a_service_that_left_the_bundle(bundle):
+    etc, apply = bundle
+    apply(FILES)
+    assert apply({k: v for k, v in FILES.items() if k != "pgbouncer.ini"}) == []
+    assert not (etc / "pgbouncer.ini").exists()
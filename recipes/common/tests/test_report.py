@@ -0,0 +1,52 @@
+"""Tests for common/report.py, on lines from `pulumi up --logtostderr -v=9`."""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from common import report
+
+STACK = "urn:pulumi:dev::rsw-single-server::pulumi:pulumi:Stack::rsw-single-server-dev"
+ENV = "urn:pulumi:dev::rsw-single-server::command:remote:Command::set environment variables"
+COPY = "urn:pulumi:dev::rsw-single-server::command:remote:Command::copy ~/justfile"
+SETUP = "urn:pulumi:dev::rsw-single-server::command:remote:Command::build setup"
+SERVER = "urn:pulumi:dev::rsw-single-server::aws:ec2/instance:Instance::rstudio workbench server"
+
+LOG = f"""\
+I1017 10:00:00.000000   4242 source_eval.go:1127] ResourceMonitor.RegisterResource received: t=command:remote:Command, name=set environment variables, custom=true, #props=3, parent={STACK}, protect=false, provider=, deps=[{SERVER}], deleteBeforeReplace=false, ignoreChanges=[], aliases=[], customTimeouts={{0 0 0}}
+I1017 10:00:00.100000   4242 step_generator.go:1158] Planner decided to create '{ENV}' (oldprops=map[] inputs=map[create:{{echo}}])
+I1017 10:00:00.200000   4242 step_executor.go:380] StepExecutor worker(-2): applying step create on {ENV} (preview false)
+I1017 10:00:00.200000   4242 step_executor.go:380] StepExecutor worker(-3): applying step create on {COPY} (preview false)
+I1017 10:00:02.500000   4242 step_executor.go:421] StepExecutor worker(-3): step create on {COPY} retired
+I1017 10:00:03.000000   4242 step_executor.go:421] StepExecutor worker(-2): step create on {ENV} completed
+I1017 10:00:03.100000   4242 source_eval.go:1236] ResourceMonitor.RegisterResource operation finished: t=command:remote:Command, name=set environment variables, urn={ENV}, #outs=4
+I1017 10:00:03.200000   4242 step_executor.go:380] StepExecutor worker(-4): applying step create on {SETUP} (preview false)
+I1017 10:00:13.200000   4242 step_executor.go:350] StepExecutor worker(-4): step create on {SETUP} failed, signalling cancellation
+I1017 10:00:13.300000   4242 step_executor.go:380] StepExecutor worker(-5): applying step same on {SERVER} (preview false)
+I1017 10:00:13.400000   4242 step_executor.go:380] StepExecutor worker(-1): applying step same on {STACK} (preview false)
+not a glog line that mentions {SETUP} finished
+"""
+
+
+def parse(tmp_path):
+    path = tmp_path / "_logs.txt"
+    path.write_text(LOG)
+    return {span.urn: span for span in report.parse_log(str(path))}
+
+
+def test_names_stop_at_the_engine_delimiters(tmp_path):
+    assert set(parse(tmp_path)) == {ENV, COPY, SETUP}
+
+
+def test_spans(tmp_path):
+    spans = parse(tmp_path)
+    assert spans[ENV].ops == ["create"]
+    assert spans[ENV].duration == 3.0
+    assert round(spans[COPY].duration, 6) == 2.3
+    assert spans[SETUP].duration == 10.0
+    assert spans[COPY].name == "copy ~/justfile (command:remote:Command)"
+
+
+def test_urns_in_a_list():
+    assert report.URN.findall(f"deps=[{SERVER} {ENV}], deleteBeforeReplace=false") == [SERVER, ENV]
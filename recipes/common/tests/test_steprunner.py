@@ -0,0 +1,96 @@
+"""Tests for common/server/steprunner.py, with a fake `just` that records what ran."""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from common.server import steprunner
+
+# `just --dry-run <step>` prints recipes/<step>, `just <step>` appends the step
+# to ran.txt and fails if fail/<step> exists.
+FAKE_JUST = f"""\
+#!{sys.executable}
+import sys
+from pathlib import Path
+
+here = Path(__file__).parent
+if sys.argv[1] == "--dry-run":
+    print((here / "recipes" / sys.argv[2]).read_text())
+    sys.exit(0)
+with open(here / "ran.txt", "a") as f:
+    f.write(sys.argv[1] + "\\n")
+sys.exit(1 if (here / "fail" / sys.argv[1]).exists() else 0)
+"""
+
+STEPS = {
+    "steps": {
+        "download-r": {},
+        "install-r": {"needs": ["download-r"]},
+        "set-env": {"stamp": False},
+    }
+}
+
+
+@pytest.fixture
+def runner(tmp_path, monkeypatch):
+    monkeypatch.setattr(steprunner, "LOG_DIR", tmp_path / "logs")
+    monkeypatch.setattr(steprunner, "STAMP_DIR", tmp_path / "stamps")
+    just = tmp_path / "just"
+    just.write_text(FAKE_JUST)
+    just.chmod(0o755)
+    (tmp_path / "recipes").mkdir()
+    (tmp_path / "fail").mkdir()
+    for name in STEPS["steps"]:
+        (tmp_path / "recipes" / name).write_text(f"echo {name} 1.0")
+    steps_file = tmp_path / "build-steps.json"
+    steps_file.write_text(json.dumps(STEPS))
+
+    def run(*targets, only=False, force=False):
+        ran = tmp_path / "ran.txt"
+        ran.unlink(missing_ok=True)
+        steps = steprunner.load_steps(str(steps_file), list(targets), only)
+        stamps = steprunner.Stamps(str(steps_file), str(just), enabled=not force)
+        ok = steprunner.run(steps, str(just), 4, stamps)
+        return ok, ran.read_text().split() if ran.exists() else []
+
+    return tmp_path, run
+
+
+def test_a_matching_stamp_skips_the_step(runner):
+    _, run = runner
+    assert run("install-r") == (True, ["download-r", "install-r"])
+    assert run("install-r") == (True, [])
+
+
+def test_the_key_changes_with_a_needed_step(runner):
+    tmp_path, run = runner
+    run("install-r")
+    (tmp_path / "recipes" / "download-r").write_text("echo download-r 2.0")
+    assert run("install-r") == (True, ["download-r", "install-r"])
+
+
+def test_steps_without_stamps_and_force_always_run(runner):
+    _, run = runner
+    assert run("set-env") == (True, ["set-env"])
+    assert run("set-env") == (True, ["set-env"])
+    run("install-r")
+    assert run("install-r", force=True) == (True, ["download-r", "install-r"])
+
+
+def test_a_failed_step_removes_its_stamp(runner):
+    tmp_path, run = runner
+    run("download-r")
+    assert (tmp_path / "stamps" / "download-r").exists()
+    (tmp_path / "recipes" / "download-r").write_text("echo download-r 2.0")
+    (tmp_path / "fail" / "download-r").touch()
+    assert run("install-r") == (False, ["download-r"])
+    assert not (tmp_path / "stamps" / "download-r").exists()
+
+
+def test_only_runs_the_steps_in_the_given_order(runner):
+    _, run = runner
+    assert run("install-r", "set-env", "download-r", only=True) == (True, ["install-r", "set-env", "download-r"])
@@ -0,0 +1,161 @@
+"""Resolve the R, Python and RStudio product versions to install.
+
+The version indexes (the RStudio dailies, the R and Python builds on the
+RStudio CDN) are fetched with a hard timeout and kept on disk for a while, so
+most previews do not touch the network at all. A stale entry is revalidated
+with a conditional request (ETag / Last-Modified). When an index can not be
+fetched the last copy on disk is used, and without one the pinned default,
+so a slow or unreachable index never hangs or fails a preview.
+
+Set PULUMI_RECIPES_OFFLINE=1 to never fetch an index.
+"""
+
+import hashlib
+import json
+import os
+import time
+from typing import Any, List, Optional, Tuple
+
+import pulumi
+
+from common import CACHE_DIR
+
+DAILIES_URL = "https://dailies.rstudio.com/rstudio/latest/index.json"
+R_VERSIONS_URL = "https://cdn.rstudio.com/r/versions.json"
+PYTHON_VERSIONS_URL = "https://cdn.rstudio.com/python/versions.json"
+CONNECT_URL = "https://cdn.rstudio.com/connect/{minor}/rstudio-connect_{version}~ubuntu20_amd64.deb"
+
+# Seconds an index is used without asking the server again.
+DAILIES_TTL = 60 * 60
+VERSIONS_TTL = 24 * 60 * 60
+
+TIMEOUT = 5
+
+LATEST = "latest"
+
+
+def offline() -> bool:
+    return os.getenv("PULUMI_RECIPES_OFFLINE", "").lower() in ("1", "true", "yes")
+
+
+def _cache_path(url: str):
+    return CACHE_DIR / "versions" / f"{hashlib.sha1(url.encode()).hexdigest()}.json"
+
+
+def _write_entry(url: str, entry: dict):
+    path = _cache_path(url)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(entry))
+    os.replace(tmp, path)
+
+
+def fetch_json(url: str, ttl: int = VERSIONS_TTL, timeout: float = TIMEOUT) -> Optional[Any]:
+    """The JSON document at `url`, from the disk cache while it is fresh.
+
+    Returns the last cached copy if the request fails, and None if there is
+    none either.
+    """
+    path = _cache_path(url)
+    entry = None
+    if path.exists():
+        try:
+            entry = json.loads(path.read_text())
+        except ValueError:
+            entry = None
+    if entry is not None and (offline() or time.time() - entry["fetched_at"] < ttl):
+        return entry["body"]
+    if offline():
+        return None
+
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    # urllib pulls in http.client, email and ssl, only pay for that on a fetch.
+    import urllib.error
+    import urllib.request
+
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+            body = json.loads(response.read())
+            entry = {
+                "body": body,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+    except urllib.error.HTTPError as e:
+        if e.code != 304 or entry is None:
+            return _fallback(url, entry, e)
+    except (OSError, ValueError) as e:
+        # URLError, timeouts and connection errors are OSErrors.
+        return _fallback(url, entry, e)
+    entry["fetched_at"] = time.time()
+    _write_entry(url, entry)
+    return entry["body"]
+
+
+def _fallback(url: str, entry: Optional[dict], error: Exception) -> Optional[Any]:
+    age = f"from {time.ctime(entry['fetched_at'])}" if entry else "none cached"
+    pulumi.log.warn(f"could not fetch {url} ({error}), using the last known copy ({age})")
+    return entry["body"] if entry else None
+
+
+def _pick(requested: str, default: str, available: Optional[List[str]], what: str) -> str:
+    """Resolve `latest` against `available`, and check other versions."""
+    if available is None:
+        if requested == LATEST:
+            pulumi.log.warn(f"the latest {what} version is not known, using {default}")
+            return default
+        return requested
+    if requested == LATEST:
+        return max(available, key=_version_key)
+    if requested not in available:
+        pulumi.log.warn(f"{what} {requested} is not in the list of available versions")
+    return requested
+
+
+def _version_key(version: str) -> Tuple:
+    return tuple(int(part) if part.isdigit() else -1 for part in version.split("."))
+
+
+def r_version(requested: str, default: str) -> str:
+    """`requested` (or the newest R build for `latest`).
+
+    The pinned `default` is used as is, without looking at the index.
+    """
+    if requested == default:
+        return default
+    data = fetch_json(R_VERSIONS_URL)
+    return _pick(requested, default, data.get("r_versions") if data else None, "R")
+
+
+def python_version(requested: str, default: str) -> str:
+    """`requested` (or the newest Python build for `latest`)."""
+    if requested == default:
+        return default
+    data = fetch_json(PYTHON_VERSIONS_URL)
+    return _pick(requested, default, data.get("python_versions") if data else None, "Python")
+
+
+def connect_url(version: str) -> str:
+    """Download link of a Connect release, e.g. 2022.07.0."""
+    minor = ".".join(version.split(".")[:2])
+    return CONNECT_URL.format(minor=minor, version=version)
+
+
+def workbench_build(daily: bool, default_url: str, platform: str = "bionic") -> Tuple[str, str]:
+    """Link and file name of the Workbench build to install.
+
+    `default_url` unless `daily` is set, in which case the latest daily build
+    (or the last one seen, when the dailies can not be reached).
+    """
+    if daily:
+        data = fetch_json(DAILIES_URL, ttl=DAILIES_TTL)
+        if data is not None:
+            build = data["products"]["workbench"]["platforms"][platform]
+            return build["link"], build["filename"]
+        pulumi.log.warn(f"no daily Workbench build is known, using {default_url}")
+    return default_url, default_url.rsplit("/", 1)[-1]
@@ -1,12 +1,23 @@
-import hashlib
+import sys
 from dataclasses import dataclass, field
 from pathlib import Path
+from typing import List, Optional
 
-import jinja2
 import pulumi
 from pulumi_aws import ec2
-from pulumi_command import remote
-from rich import inspect, print
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from common import SERVER_FILES_DIR, artifacts, bundle, capacity, cloudinit, hardware, hibernation, images, keys, package_cache, ssh, steps, versions
+from common.templates import hash_file, hash_text, render_template
+
+# ------------------------------------------------------------------------------
+# Versions
+# ------------------------------------------------------------------------------
+
+R_VERSION = "4.1.2"
+PYTHON_VERSION = "3.10.4"
+RSC_VERSION = "2022.07.0"
 
 # ------------------------------------------------------------------------------
 # Helper functions
@@ -20,27 +31,81 @@ class ConfigValues:
     rsc_license: str = field(init=False)
     mail_trap_user: str = field(init=False)
     mail_trap_password: str = field(init=False)
-    public_key: str = field(init=False)
+    public_key: Optional[str] = field(init=False)
+    manage_keys: bool = field(init=False)
+    key_algorithm: str = field(init=False)
+    bake_image: bool = field(init=False)
+    artifact_cache: bool = field(init=False)
+    artifact_cache_max_mb: int = field(init=False)
+    ssh_multiplex: bool = field(init=False)
+    ssh_max_sessions: int = field(init=False)
+    bootstrap: str = field(init=False)
+    wait_for_ready: bool = field(init=False)
+    instance_type: str = field(init=False)
+    r_version: str = field(init=False)
+    python_version: str = field(init=False)
+    rsc_url: str = field(init=False)
+    plan: Optional[capacity.CapacityPlan] = field(init=False)
+    hibernation: hibernation.HibernationSettings = field(init=False)
+    package_cache: package_cache.PackageCacheSettings = field(init=False)
 
     def __post_init__(self):
         self.email = self.config.require("email")
         self.rsc_license = self.config.require("rsc_license")
         self.mail_trap_user = self.config.require("mail_trap_user")
         self.mail_trap_password = self.config.require("mail_trap_password")
-        self.public_key = self.config.require("public_key")   
-
+        self.manage_keys = self.config.get_bool("manage_keys") or False
+        self.key_algorithm = self.config.get("key_algorithm") or "ed25519"
+        self.public_key = self.config.get("public_key")
+        self.bake_image = self.config.get_bool("bake_image") or False
+        self.artifact_cache = self.config.get_bool("artifact_cache") or False
+        self.artifact_cache_max_mb = self.config.get_int("artifact_cache_max_mb") or 4096
+        self.ssh_multiplex = self.config.get_bool("ssh_multiplex") or False
+        self.ssh_max_sessions = self.config.get_int("ssh_max_sessions") or 4
+        self.bootstrap = self.config.get("bootstrap") or "ssh"
+        if self.bootstrap not in cloudinit.BOOTSTRAP_MODES:
+            raise ValueError(f"bootstrap must be one of: {', '.join(cloudinit.BOOTSTRAP_MODES)}")
+        self.wait_for_ready = self.config.get_bool("wait_for_ready") or False
+        self.plan = capacity.plan_from_config(self.config, max_nodes=1)
+        self.instance_type = self.config.get("instance_type") or (
+            self.plan.instance_type if self.plan else hardware.DEFAULT_INSTANCE_TYPE
+        )
+        self.r_version = versions.r_version(self.config.get("r_version") or R_VERSION, R_VERSION)
+        self.python_version = versions.python_version(self.config.get("python_version") or PYTHON_VERSION, PYTHON_VERSION)
+        self.hibernation = hibernation.settings_from_config(self.config)
+        self.package_cache = package_cache.settings_from_config(self.config)
+        self.rsc_url = versions.connect_url(self.config.get("rsc_version") or RSC_VERSION)
 
-def create_template(path: str) -> jinja2.Template:
-    with open(path, 'r') as f:
-        template = jinja2.Template(f.read())
-    return template
 
+def make_config_files(
+    config: ConfigValues,
+    ip_address: pulumi.Input[str],
+    cache: Optional[package_cache.PackageCache] = None,
+    substitute: bool = False
+) -> List[bundle.ConfigFile]:
+    """The config files for the server, rendered for `ip_address`.
 
-def hash_file(path: str) -> pulumi.Output:
-    with open(path, mode="r") as f:
-        text = f.read()
-    hash_str = hashlib.sha224(bytes(text, encoding='utf-8')).hexdigest()
-    return pulumi.Output.concat(hash_str)
+    With the package cache Connect restores R and Python packages from it.
+    """
+    files = [
+        bundle.ConfigFile(
+            "rstudio-connect.gcfg",
+            "/etc/rstudio-connect/rstudio-connect.gcfg",
+            pulumi.Output.all(ip_address, package_cache.cran_url(cache)).apply(
+                lambda x: render_template(
+                    "server-side-files/config/rstudio-connect.gcfg",
+                    rsc_ip_address=x[0],
+                    cran_url=x[1],
+                    mail_trap_user=config.mail_trap_user,
+                    mail_trap_password=config.mail_trap_password
+                )
+            ),
+            service="rstudio-connect",
+            substitute=substitute
+        ),
+        bundle.ConfigFile("pip.conf", "/etc/pip.conf", package_cache.pip_conf(cache)),
+    ]
+    return files
 
 
 # ------------------------------------------------------------------------------
@@ -52,6 +117,7 @@ def main():
     # Get configuration values
     # --------------------------------------------------------------------------
     config = ConfigValues()
+    capacity.publish(config.plan)
 
     tags = {
         "rs:environment": "development",
@@ -80,59 +146,134 @@ def main():
     # --------------------------------------------------------------------------
     # Stand up the servers
     # --------------------------------------------------------------------------
-    key_pair = ec2.KeyPair(
+    stack_keys = keys.make_keys(
         "ec2 key pair",
         key_name=f"{config.email}-keypair-for-pulumi",
-        public_key=config.public_key,
         tags=tags | {"Name": f"{config.email}-key-pair"},
+        managed=config.manage_keys,
+        public_key=config.public_key,
+        algorithm=config.key_algorithm
+    )
+    key_pair = stack_keys.key_pair
+
+    image = images.resolve_image(
+        config.bake_image, "server-side-files/justfile",
+        r=config.r_version, python=config.python_version, rsc=config.rsc_url
     )
 
+    # --------------------------------------------------------------------------
+    # Package cache
+    # --------------------------------------------------------------------------
+    cache = package_cache.make_package_cache(
+        "rsc",
+        config.package_cache,
+        tags | {"Name": f"{config.email}-rsc-package-cache"},
+        r_version=config.r_version,
+        python_version=config.python_version
+    )
+
+    server_env = {
+        "RSC_LICENSE": config.rsc_license,
+        "R_VERSION": config.r_version,
+        "PYTHON_VERSION": config.python_version,
+        "RSC_URL": config.rsc_url,
+        "HIBERNATION": str(config.hibernation.hibernate).lower(),
+    }
+
+    # With cloud-init the server provisions itself at boot from its user data.
+    # The config files are rendered before the server exists, so its ip
+    # address is filled in on the server.
+    user_data = None
+    if config.bootstrap == "cloud-init":
+        config_bundle = bundle.make_bundle(make_config_files(config, bundle.PUBLIC_IP, cache, substitute=True))
+        user_data = cloudinit.user_data(
+            "configure-rsc" if image.baked else "build-rsc",
+            {".env": cloudinit.env_file(server_env)},
+            bundle_path=config_bundle.apply(lambda b: b[0])
+        )
+
     rsc_server = ec2.Instance(
         f"rstudio workbench server",
-        instance_type="t3.medium",
+        instance_type=config.instance_type,
         vpc_security_group_ids=[security_group.id],
-        # Ubuntu Server 20.04 LTS (HVM), SSD Volume Type for us-east-2
-        ami="ami-0fb653ca2d3203ac1",                 
+        ami=image.ami,
         tags=tags | {"Name": f"{config.email}-rsc-server"},
-        key_name=key_pair.key_name
+        key_name=key_pair.key_name,
+        opts=images.instance_options(image),
+        **cloudinit.instance_args(user_data),
+        **hibernation.instance_args(config.hibernation, hardware.lookup(config.instance_type))
+    )
+    address = hibernation.public_address(
+        "rsc server", rsc_server, config.hibernation, tags | {"Name": f"{config.email}-rsc-server"}
     )
+    hibernation.make_schedule("rsc", [rsc_server], config.hibernation, tags)
 
-    connection = remote.ConnectionArgs(
-        host=rsc_server.public_dns, 
-        user="ubuntu", 
-        private_key=Path("key.pem").read_text()
+    connection = ssh.connection(
+        host=address.public_dns,
+        user="ubuntu",
+        private_key=stack_keys.private_key,
+        multiplex=config.ssh_multiplex,
+        max_sessions=config.ssh_max_sessions
     )
 
     # Export final pulumi variables.
-    pulumi.export('rsc_public_ip', rsc_server.public_ip)
-    pulumi.export('rsc_public_dns', rsc_server.public_dns)
+    pulumi.export('rsc_public_ip', address.public_ip)
+    pulumi.export('rsc_public_dns', address.public_dns)
     pulumi.export('rsc_subnet_id', rsc_server.subnet_id)
-  
+
+    # --------------------------------------------------------------------------
+    # Cloud-init: the server provisions itself, there is nothing to push
+    # --------------------------------------------------------------------------
+    if config.bootstrap == "cloud-init":
+        if config.wait_for_ready:
+            cloudinit.wait_until_ready(
+                "wait for rstudio connect",
+                pulumi.Output.concat("http://", address.public_ip, ":3939/__ping__"),
+                depends_on=[rsc_server]
+            )
+        if image.needs_bake:
+            pulumi.log.warn("Golden images are only baked with bootstrap: ssh")
+        if config.artifact_cache:
+            pulumi.log.warn("The artifact cache is only used with bootstrap: ssh")
+        return
+
+    # --------------------------------------------------------------------------
+    # Push artifacts from the local artifact cache
+    # --------------------------------------------------------------------------
+    artifact_cache = None
+    command_push_artifacts = []
+    if config.artifact_cache:
+        artifact_cache = artifacts.ArtifactCache(max_bytes=config.artifact_cache_max_mb * 1024**2)
+        server_artifacts = [artifacts.just_artifact()]
+        if not image.baked:
+            server_artifacts += [
+                artifacts.r_artifact(config.r_version),
+                artifacts.python_artifact(config.python_version),
+                artifacts.Artifact(config.rsc_url),
+            ]
+        command_push_artifacts = list(artifacts.push_artifacts(
+            "server", artifact_cache, server_artifacts, connection, depends_on=[rsc_server]
+        ).values())
 
     # --------------------------------------------------------------------------
     # Install required software one each server
     # --------------------------------------------------------------------------
     
-    command_set_environment_variables = remote.Command(
+    command_set_environment_variables = ssh.command(
         "set environment variables", 
-        create=pulumi.Output.concat(
-            'echo "export RSC_LICENSE=', config.rsc_license, '" > .env;',
-        ), 
+        create=cloudinit.write_env_command(images.install_env(server_env, image, ["RSC_LICENSE"])),
         connection=connection, 
         opts=pulumi.ResourceOptions(depends_on=[rsc_server])
     )
 
-    command_install_justfile = remote.Command(
+    command_install_justfile = ssh.command(
         f"install justfile",
-        create="\n".join([
-            """curl --proto '=https' --tlsv1.2 -sSf https://just.systems/install.sh | bash -s -- --to ~/bin;""",
-            """echo 'export PATH="$PATH:$HOME/bin"' >> ~/.bashrc;"""
-        ]),
+        create=artifacts.install_just_command(artifact_cache),
         connection=connection,
-        opts=pulumi.ResourceOptions(depends_on=[rsc_server])
+        opts=pulumi.ResourceOptions(depends_on=[rsc_server] + command_push_artifacts)
     )
 
-    command_copy_justfile = remote.CopyFile(
+    command_copy_justfile = ssh.copy_file(
         f"copy ~/justfile",  
         local_path="server-side-files/justfile", 
         remote_path='justfile', 
@@ -141,60 +282,90 @@ def main():
         triggers=[hash_file("server-side-files/justfile")]
     )
 
+    command_copy_build_files = [
+        ssh.copy_file(
+            f"copy ~/{path.name}",
+            local_path=str(path),
+            remote_path=path.name,
+            connection=connection,
+            opts=pulumi.ResourceOptions(depends_on=[rsc_server]),
+            triggers=[hash_file(str(path))]
+        )
+        for path in [
+            SERVER_FILES_DIR / "steprunner.py",
+            SERVER_FILES_DIR / "apply_bundle.py",
+            Path("server-side-files/build-steps.json"),
+        ]
+    ]
+
     # --------------------------------------------------------------------------
-    # Create config files
+    # Build
     # --------------------------------------------------------------------------
-    
-    @dataclass
-    class serverSideFile:
-        file_in: str
-        file_out: str
-        template_render_command: pulumi.Output
-
-    server_side_files = [
-        serverSideFile(
-            "server-side-files/config/rstudio-connect.gcfg",
-            "~/rstudio-connect.gcfg",
-            (
-                pulumi
-                .Output
-                .all(rsc_server.public_ip)
-                .apply(
-                    lambda x: (
-                        create_template("server-side-files/config/rstudio-connect.gcfg")
-                        .render(
-                            rsc_ip_address=x[0],
-                            mail_trap_user=config.mail_trap_user,
-                            mail_trap_password=config.mail_trap_password
-                        )
-                        .replace('"', '\\"')
-                    )
-                )
-            )
-        )
+    # Each stage only runs again when the recipes it runs or its own triggers
+    # change. The install stages are skipped on a golden image, which is taken
+    # after them and before the config files and the configure stages.
+    install_stages = [
+        steps.Stage("setup", ["setup"]),
+        steps.Stage("r", ["install-r", "symlink-r"], needs=["setup"], triggers=[config.r_version]),
+        steps.Stage("python", ["install-python", "configure-python"], needs=["setup"], triggers=[config.python_version]),
+        steps.Stage("rsc", ["install-rsc"], needs=["setup", "r"], triggers=[config.rsc_url]),
     ]
+    build_depends_on = [command_set_environment_variables, command_install_justfile, command_copy_justfile] + command_copy_build_files + command_push_artifacts
+    install_commands = steps.make_stages(
+        "build",
+        [] if image.baked else install_stages,
+        "server-side-files/justfile",
+        connection,
+        depends_on=build_depends_on
+    )
 
-    command_copy_config_files = []
-    for f in server_side_files:
-        command_copy_config_files.append(
-            remote.Command(
-                f"copy {f.file_out} to server",
-                create=pulumi.Output.concat('echo "', f.template_render_command, f'" > {f.file_out}'),
-                connection=connection, 
-                opts=pulumi.ResourceOptions(depends_on=[rsc_server]),
-                triggers=[hash_file(f.file_in)]
-            )
+    baked = []
+    if image.needs_bake:
+        golden_image = images.bake_image("rsc", rsc_server, image, tags, depends_on=list(install_commands.values()))
+        command_set_deployment_environment_variables = ssh.command(
+            "set deployment environment variables",
+            create=cloudinit.write_env_command(server_env),
+            connection=connection,
+            opts=pulumi.ResourceOptions(depends_on=[golden_image])
         )
-    
+        baked = [golden_image]
+        build_depends_on = build_depends_on + [golden_image, command_set_deployment_environment_variables]
+
     # --------------------------------------------------------------------------
-    # Build
+    # Create config files
     # --------------------------------------------------------------------------
+    # All config files go to the server as one bundle. Only the files that
+    # changed are installed and rstudio-connect only restarts when one of its
+    # files changed.
+    config_files = make_config_files(config, address.public_ip, cache)
 
-    command_build_rsc = remote.Command(
-        f"build rsc", 
-        create="""export PATH="$PATH:$HOME/bin"; just build-rsc""", 
-        connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[command_copy_justfile] + command_copy_config_files)
+    command_copy_config_bundle, config_bundle_sha256 = bundle.push_bundle(
+        "server", config_files, connection, depends_on=[rsc_server] + baked
     )
 
+    # --------------------------------------------------------------------------
+    # Configure
+    # --------------------------------------------------------------------------
+    configure_stages = [
+        steps.Stage("license", ["activate-license"], needs=["rsc"], triggers=[hash_text(config.rsc_license)]),
+        steps.Stage(
+            "config", ["apply-config"], needs=["rsc"],
+            triggers=[config_bundle_sha256],
+            depends_on=[command_copy_config_bundle]
+        ),
+        steps.Stage("hibernation", ["enable-hibernation"], needs=["setup"], triggers=[config.hibernation.hibernate]),
+        steps.Stage("restart", ["restart"], needs=["python", "license"], after=["config"], rerun_with_needs=True),
+    ]
+    configure_commands = steps.make_stages(
+        "build",
+        configure_stages,
+        "server-side-files/justfile",
+        connection,
+        depends_on=build_depends_on,
+        existing=install_commands
+    )
+    build_commands = {**install_commands, **configure_commands}
+
+    pulumi.export("build_timings", steps.collect_timings("build", build_commands, connection))
+
 main()
@@ -1,15 +1,62 @@
 """An AWS Python Pulumi program"""
 
-import hashlib
-import os
+import sys
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
 
-import jinja2
 import pulumi
-from pulumi_aws import ec2, efs, rds
-from pulumi_command import remote
+from pulumi_aws import ebs, ec2, efs, lb, rds
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from common import SERVER_FILES_DIR, artifacts, bundle, capacity, cloudinit, hardware, hibernation, images, keys, package_cache, ssh, steps, versions
+from common.templates import hash_file, hash_text, render_template
+
+# ------------------------------------------------------------------------------
+# Versions
+# ------------------------------------------------------------------------------
+
+R_VERSION = "4.1.2"
+RSW_URL = "https://download2.rstudio.org/server/bionic/amd64/rstudio-workbench-2022.02.0-443.pro2-amd64.deb"
+# The system python of Ubuntu 20.04, used by the nodes.
+PYTHON_VERSION = "3.8"
+
+# ------------------------------------------------------------------------------
+# EFS
+# ------------------------------------------------------------------------------
+
+EFS_THROUGHPUT_MODES = ("bursting", "elastic", "provisioned")
+EFS_PERFORMANCE_MODES = ("generalPurpose", "maxIO")
+
+# The NFS options recommended for EFS: large reads and writes, hard mounts
+# and a new source port on reconnect.
+EFS_MOUNT_OPTIONS = "tls,noresvport,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2"
+
+# ------------------------------------------------------------------------------
+# Storage
+# ------------------------------------------------------------------------------
+
+# efs: everything in the home directories on EFS. tiered: temp files on a
+# scratch volume of the node and common packages in a shared site library.
+STORAGE_PROFILES = ("efs", "tiered")
+SCRATCH_DEVICE_NAME = "/dev/sdf"
+SITE_LIBRARY_PACKAGES = ["tidyverse", "rmarkdown", "shiny"]
+
+# ------------------------------------------------------------------------------
+# Database
+# ------------------------------------------------------------------------------
+
+DB_STORAGE_TYPES = ("gp2", "gp3", "io1")
+PGBOUNCER_POOL_MODES = ("session", "transaction")
+PGBOUNCER_PORT = 6432
+
+# ------------------------------------------------------------------------------
+# Load balancer
+# ------------------------------------------------------------------------------
+
+# Served by every node with server-health-check-enabled=1 (see rserver.conf).
+HEALTH_CHECK_PATH = "/health-check"
 
 # ------------------------------------------------------------------------------
 # Helper functions
@@ -21,53 +68,393 @@ class ConfigValues:
     config: pulumi.Config = field(default_factory=lambda: pulumi.Config())
     email: str = field(init=False)
     rsw_license: str = field(init=False)
-    public_key: str = field(init=False)
+    public_key: Optional[str] = field(init=False)
+    manage_keys: bool = field(init=False)
+    key_algorithm: str = field(init=False)
+    bake_image: bool = field(init=False)
+    artifact_cache: bool = field(init=False)
+    artifact_cache_max_mb: int = field(init=False)
+    ssh_multiplex: bool = field(init=False)
+    ssh_max_sessions: int = field(init=False)
+    node_count: int = field(init=False)
+    bootstrap: str = field(init=False)
+    wait_for_ready: bool = field(init=False)
+    instance_type: str = field(init=False)
+    r_version: str = field(init=False)
+    efs_throughput_mode: str = field(init=False)
+    efs_provisioned_mibps: Optional[float] = field(init=False)
+    efs_performance_mode: str = field(init=False)
+    efs_transition_to_ia: Optional[str] = field(init=False)
+    efs_nconnect: Optional[int] = field(init=False)
+    efs_actimeo: Optional[int] = field(init=False)
+    efs_mount_options: str = field(init=False)
+    db_instance_class: str = field(init=False)
+    db_storage_type: Optional[str] = field(init=False)
+    db_allocated_storage: int = field(init=False)
+    db_iops: Optional[int] = field(init=False)
+    hibernation: hibernation.HibernationSettings = field(init=False)
+    alb: bool = field(init=False)
+    alb_certificate_arn: Optional[str] = field(init=False)
+    alb_stickiness_seconds: int = field(init=False)
+    alb_idle_timeout: int = field(init=False)
+    package_cache: package_cache.PackageCacheSettings = field(init=False)
+    storage_profile: str = field(init=False)
+    scratch_volume_gb: int = field(init=False)
+    site_library_packages: List[str] = field(init=False)
+    pgbouncer: bool = field(init=False)
+    pgbouncer_pool_mode: str = field(init=False)
+    pgbouncer_pool_size: int = field(init=False)
+    pgbouncer_reserve_pool_size: int = field(init=False)
+    pgbouncer_max_client_conn: int = field(init=False)
+    plan: Optional[capacity.CapacityPlan] = field(init=False)
 
     def __post_init__(self):
         self.email = self.config.require("email")
         self.rsw_license = self.config.require("rsw_license")
-        self.public_key = self.config.require("public_key")   
-
-
-def create_template(path: str) -> jinja2.Template:
-    with open(path, 'r') as f:
-        template = jinja2.Template(f.read())
-    return template
-
-
-def hash_file(path: str) -> pulumi.Output:
-    with open(path, mode="r") as f:
-        text = f.read()
-    hash_str = hashlib.sha224(bytes(text, encoding='utf-8')).hexdigest()
-    return pulumi.Output.concat(hash_str)
+        self.manage_keys = self.config.get_bool("manage_keys") or False
+        self.key_algorithm = self.config.get("key_algorithm") or "ed25519"
+        self.public_key = self.config.get("public_key")
+        self.bake_image = self.config.get_bool("bake_image") or False
+        self.artifact_cache = self.config.get_bool("artifact_cache") or False
+        self.artifact_cache_max_mb = self.config.get_int("artifact_cache_max_mb") or 4096
+        self.ssh_multiplex = self.config.get_bool("ssh_multiplex") or False
+        self.ssh_max_sessions = self.config.get_int("ssh_max_sessions") or 4
+        self.pgbouncer = self.config.get_bool("pgbouncer") or False
+        self.pgbouncer_pool_mode = self.config.get("pgbouncer_pool_mode") or "session"
+        if self.pgbouncer_pool_mode not in PGBOUNCER_POOL_MODES:
+            raise ValueError(f"pgbouncer_pool_mode must be one of: {', '.join(PGBOUNCER_POOL_MODES)}")
+        self.pgbouncer_pool_size = self.config.get_int("pgbouncer_pool_size") or 10
+        self.pgbouncer_reserve_pool_size = self.config.get_int("pgbouncer_reserve_pool_size") or 2
+        self.pgbouncer_max_client_conn = self.config.get_int("pgbouncer_max_client_conn") or 200
+        node_count = self.config.get_int("node_count")
+        if node_count is not None and node_count < 1:
+            raise ValueError("node_count must be at least 1")
+        # An explicit node_count is planned around. With pgbouncer every node
+        # holds at most its pool of connections.
+        self.plan = capacity.plan_from_config(
+            self.config,
+            min_nodes=node_count or 2,
+            max_nodes=node_count,
+            cluster=True,
+            db_connections_per_node=self.pgbouncer_pool_size + self.pgbouncer_reserve_pool_size if self.pgbouncer else None
+        )
+        self.node_count = node_count or (self.plan.node_count if self.plan else 2)
+        self.bootstrap = self.config.get("bootstrap") or "ssh"
+        if self.bootstrap not in cloudinit.BOOTSTRAP_MODES:
+            raise ValueError(f"bootstrap must be one of: {', '.join(cloudinit.BOOTSTRAP_MODES)}")
+        self.wait_for_ready = self.config.get_bool("wait_for_ready") or False
+        self.instance_type = self.config.get("instance_type") or (
+            self.plan.instance_type if self.plan else hardware.DEFAULT_INSTANCE_TYPE
+        )
+        self.r_version = versions.r_version(self.config.get("r_version") or R_VERSION, R_VERSION)
+        self.efs_throughput_mode = self.config.get("efs_throughput_mode") or (
+            self.plan.efs_throughput_mode if self.plan else "bursting"
+        )
+        if self.efs_throughput_mode not in EFS_THROUGHPUT_MODES:
+            raise ValueError(f"efs_throughput_mode must be one of: {', '.join(EFS_THROUGHPUT_MODES)}")
+        self.efs_provisioned_mibps = self.config.get_float("efs_provisioned_mibps")
+        if (self.efs_throughput_mode == "provisioned") != (self.efs_provisioned_mibps is not None):
+            raise ValueError("efs_provisioned_mibps must be set if and only if efs_throughput_mode is provisioned")
+        self.efs_performance_mode = self.config.get("efs_performance_mode") or "generalPurpose"
+        if self.efs_performance_mode not in EFS_PERFORMANCE_MODES:
+            raise ValueError(f"efs_performance_mode must be one of: {', '.join(EFS_PERFORMANCE_MODES)}")
+        if self.efs_performance_mode == "maxIO" and self.efs_throughput_mode == "elastic":
+            raise ValueError("efs_throughput_mode elastic needs efs_performance_mode generalPurpose")
+        self.efs_transition_to_ia = self.config.get("efs_transition_to_ia")
+        self.efs_nconnect = self.config.get_int("efs_nconnect")
+        self.efs_actimeo = self.config.get_int("efs_actimeo")
+        self.efs_mount_options = self.config.get("efs_mount_options") or EFS_MOUNT_OPTIONS
+        self.db_instance_class = self.config.get("db_instance_class") or (
+            self.plan.db_instance_class if self.plan else "db.t3.micro"
+        )
+        self.db_storage_type = self.config.get("db_storage_type")
+        if self.db_storage_type is not None and self.db_storage_type not in DB_STORAGE_TYPES:
+            raise ValueError(f"db_storage_type must be one of: {', '.join(DB_STORAGE_TYPES)}")
+        self.db_allocated_storage = self.config.get_int("db_allocated_storage") or 5
+        self.db_iops = self.config.get_int("db_iops")
+        if self.db_iops is not None and self.db_storage_type not in ("gp3", "io1"):
+            raise ValueError("db_iops needs db_storage_type gp3 or io1")
+        self.hibernation = hibernation.settings_from_config(self.config)
+        self.alb = self.config.get_bool("alb") or False
+        self.alb_certificate_arn = self.config.get("alb_certificate_arn")
+        self.alb_stickiness_seconds = self.config.get_int("alb_stickiness_seconds") or 24 * 60 * 60
+        # Sessions keep long running requests open, longer than the ALB
+        # default of 60 seconds.
+        self.alb_idle_timeout = self.config.get_int("alb_idle_timeout") or 3600
+        self.package_cache = package_cache.settings_from_config(self.config)
+        self.storage_profile = self.config.get("storage_profile") or "efs"
+        if self.storage_profile not in STORAGE_PROFILES:
+            raise ValueError(f"storage_profile must be one of: {', '.join(STORAGE_PROFILES)}")
+        self.scratch_volume_gb = self.config.get_int("scratch_volume_gb") or 50
+        site_library_packages = self.config.get_object("site_library_packages")
+        self.site_library_packages = SITE_LIBRARY_PACKAGES if site_library_packages is None else site_library_packages
 
 
 # ------------------------------------------------------------------------------
 # Infrastructure functions
 # ------------------------------------------------------------------------------
 
+def make_scratch_volume(
+    name: str,
+    server: ec2.Instance,
+    size_gb: Optional[int],
+    hibernation_settings: hibernation.HibernationSettings,
+    node_hardware: hardware.Hardware,
+    tags: Dict
+) -> Optional[ec2.VolumeAttachment]:
+    """Attach a gp3 scratch volume to `server`.
+
+    Instance types with an instance store use that instead, it is faster and
+    comes with the instance. The server finds and mounts either one at
+    /scratch (see setup-scratch). The volume is its own resource, so
+    resizing it (or turning it off) leaves the server alone.
+    """
+    if size_gb is None or node_hardware.instance_storage_gb:
+        return None
+    volume = ebs.Volume(
+        f"rstudio-workbench-{name}-scratch",
+        availability_zone=server.availability_zone,
+        size=size_gb,
+        type="gp3",
+        # Hibernation needs encrypted volumes.
+        encrypted=hibernation_settings.hibernate,
+        tags=tags,
+    )
+    return ec2.VolumeAttachment(
+        f"rstudio-workbench-{name}-scratch",
+        device_name=SCRATCH_DEVICE_NAME,
+        volume_id=volume.id,
+        instance_id=server.id,
+    )
+
+
 def make_rsw_server(
     name: str, 
     tags: Dict, 
     key_pair: ec2.KeyPair, 
-    vpc_group_ids: List[str]
+    vpc_group_ids: List[str],
+    image: images.MachineImage,
+    instance_type: str = hardware.DEFAULT_INSTANCE_TYPE,
+    hibernation_settings: hibernation.HibernationSettings = hibernation.HibernationSettings(),
+    subnet_id: Optional[pulumi.Input[str]] = None,
+    user_data: Optional[pulumi.Output] = None,
+    depends_on: Optional[List[pulumi.Resource]] = None
 ):
     # Stand up a server.
     server = ec2.Instance(
         f"rstudio-workbench-{name}",
-        instance_type="t3.medium",
+        instance_type=instance_type,
         vpc_security_group_ids=vpc_group_ids,
-        ami="ami-0fb653ca2d3203ac1",  # Ubuntu Server 20.04 LTS (HVM), SSD Volume Type
+        subnet_id=subnet_id,
+        ami=image.ami,
         tags=tags,
-        key_name=key_pair.key_name
+        key_name=key_pair.key_name,
+        opts=images.instance_options(image, depends_on=depends_on or []),
+        **cloudinit.instance_args(user_data),
+        **hibernation.instance_args(hibernation_settings, hardware.lookup(instance_type))
     )
+    address = hibernation.public_address(f"rstudio-workbench-{name}", server, hibernation_settings, tags)
     
     # Export final pulumi variables.
-    pulumi.export(f'rsw_{name}_public_ip', server.public_ip)
-    pulumi.export(f'rsw_{name}_public_dns', server.public_dns)
+    pulumi.export(f'rsw_{name}_public_ip', address.public_ip)
+    pulumi.export(f'rsw_{name}_public_dns', address.public_dns)
     pulumi.export(f'rsw_{name}_subnet_id', server.subnet_id)
 
-    return server
+    return server, address
+
+
+def make_load_balancer(
+    config: ConfigValues,
+    servers: Dict[str, ec2.Instance],
+    tags: Dict
+) -> pulumi.Output:
+    """An Application Load Balancer in front of the nodes, returns its url.
+
+    Each user sticks to one node (an ALB cookie) and a node that fails its
+    health check gets no new users until it passes again. With
+    `alb_certificate_arn` the ALB serves HTTPS and redirects HTTP to it.
+    """
+    vpc = ec2.get_vpc(default=True)
+    # An ALB needs subnets in at least two availability zones.
+    subnet_ids = ec2.get_subnets(filters=[
+        ec2.GetSubnetsFilterArgs(name="vpc-id", values=[vpc.id]),
+        ec2.GetSubnetsFilterArgs(name="default-for-az", values=["true"]),
+    ]).ids
+    listener_ports = [80, 443] if config.alb_certificate_arn else [80]
+    security_group = ec2.SecurityGroup(
+        "rsw-ha-alb-sg",
+        description="RSW load balancer",
+        vpc_id=vpc.id,
+        ingress=[
+            {"protocol": "TCP", "from_port": port, "to_port": port, "cidr_blocks": ["0.0.0.0/0"], "description": "HTTP(S)"}
+            for port in listener_ports
+        ],
+        egress=[
+            {"protocol": "All", "from_port": -1, "to_port": -1, "cidr_blocks": ["0.0.0.0/0"], "description": "Allow all outbound traffic"},
+        ],
+        tags=tags
+    )
+    load_balancer = lb.LoadBalancer(
+        "rsw-ha-alb",
+        load_balancer_type="application",
+        security_groups=[security_group.id],
+        subnets=subnet_ids,
+        idle_timeout=config.alb_idle_timeout,
+        tags=tags
+    )
+    target_group = lb.TargetGroup(
+        "rsw-ha-nodes",
+        port=8787,
+        protocol="HTTP",
+        target_type="instance",
+        vpc_id=vpc.id,
+        deregistration_delay=30,
+        health_check=lb.TargetGroupHealthCheckArgs(
+            path=HEALTH_CHECK_PATH,
+            port="8787",
+            matcher="200",
+            interval=15,
+            timeout=5,
+            healthy_threshold=2,
+            unhealthy_threshold=3,
+        ),
+        stickiness=lb.TargetGroupStickinessArgs(
+            type="lb_cookie",
+            enabled=True,
+            cookie_duration=config.alb_stickiness_seconds,
+        ),
+        tags=tags
+    )
+    for name, server in servers.items():
+        lb.TargetGroupAttachment(
+            f"rsw-ha-nodes-{name}",
+            target_group_arn=target_group.arn,
+            target_id=server.id,
+            port=8787
+        )
+
+    forward = [lb.ListenerDefaultActionArgs(type="forward", target_group_arn=target_group.arn)]
+    if config.alb_certificate_arn:
+        lb.Listener(
+            "rsw-ha-alb-https",
+            load_balancer_arn=load_balancer.arn,
+            port=443,
+            protocol="HTTPS",
+            ssl_policy="ELBSecurityPolicy-TLS13-1-2-2021-06",
+            certificate_arn=config.alb_certificate_arn,
+            default_actions=forward
+        )
+        lb.Listener(
+            "rsw-ha-alb-http",
+            load_balancer_arn=load_balancer.arn,
+            port=80,
+            protocol="HTTP",
+            default_actions=[lb.ListenerDefaultActionArgs(
+                type="redirect",
+                redirect=lb.ListenerDefaultActionRedirectArgs(port="443", protocol="HTTPS", status_code="HTTP_301"),
+            )]
+        )
+        return pulumi.Output.concat("https://", load_balancer.dns_name)
+
+    lb.Listener(
+        "rsw-ha-alb-http",
+        load_balancer_arn=load_balancer.arn,
+        port=80,
+        protocol="HTTP",
+        default_actions=forward
+    )
+    return pulumi.Output.concat("http://", load_balancer.dns_name)
+
+
+def efs_mount_options(config: ConfigValues) -> str:
+    """The options used to mount EFS on the nodes (and in their fstab)."""
+    options = [config.efs_mount_options]
+    if config.efs_nconnect:
+        options.append(f"nconnect={config.efs_nconnect}")
+    if config.efs_actimeo is not None:
+        # Home directories and R libraries are mostly many small files that
+        # are read far more often than written. A longer attribute cache
+        # saves a round trip per stat, at the cost of other nodes seeing
+        # changes later.
+        options.append(f"actimeo={config.efs_actimeo}")
+    return ",".join(options)
+
+
+def make_config_files(
+    config: ConfigValues,
+    db: rds.Instance,
+    server_ip_address: pulumi.Input[str],
+    cache: Optional[package_cache.PackageCache] = None,
+    substitute: bool = False
+) -> List[bundle.ConfigFile]:
+    """The config files for one node.
+
+    With pgbouncer Workbench connects to the pooler on the node, which keeps
+    at most `pgbouncer_pool_size` connections to the database. With the
+    package cache R and pip install from it. With the tiered storage profile
+    R keeps its temp files on the scratch volume of the node and finds the
+    shared site library on EFS.
+    """
+    if config.pgbouncer:
+        database_conf = render_template(
+            "server-side-files/config/database.conf", db_host="127.0.0.1", db_port=PGBOUNCER_PORT
+        )
+    else:
+        database_conf = db.address.apply(
+            lambda address: render_template("server-side-files/config/database.conf", db_host=address, db_port=5432)
+        )
+    files = [
+        bundle.ConfigFile(
+            "database.conf", "/etc/rstudio/database.conf", database_conf,
+            service="rstudio-server", mode="0600"
+        ),
+        bundle.ConfigFile(
+            "load-balancer", "/etc/rstudio/load-balancer",
+            pulumi.Output.from_input(server_ip_address).apply(
+                lambda ip: render_template("server-side-files/config/load-balancer", server_ip_address=ip)
+            ),
+            service="rstudio-server",
+            substitute=substitute
+        ),
+        bundle.ConfigFile(
+            "rserver.conf", "/etc/rstudio/rserver.conf",
+            render_template("server-side-files/config/rserver.conf"),
+            service="rstudio-server"
+        ),
+    ]
+    if config.pgbouncer:
+        files += [
+            bundle.ConfigFile(
+                "pgbouncer.ini", "/etc/pgbouncer/pgbouncer.ini",
+                db.address.apply(lambda address: render_template(
+                    "server-side-files/config/pgbouncer.ini",
+                    db_address=address,
+                    pool_mode=config.pgbouncer_pool_mode,
+                    pool_size=config.pgbouncer_pool_size,
+                    reserve_pool_size=config.pgbouncer_reserve_pool_size,
+                    max_client_conn=config.pgbouncer_max_client_conn
+                )),
+                service="pgbouncer", mode="0640", owner="postgres:postgres"
+            ),
+            bundle.ConfigFile(
+                "userlist.txt", "/etc/pgbouncer/userlist.txt",
+                render_template("server-side-files/config/userlist.txt"),
+                service="pgbouncer", mode="0640", owner="postgres:postgres"
+            ),
+        ]
+    if config.storage_profile == "tiered":
+        files.append(bundle.ConfigFile(
+            "Renviron.site", f"/opt/R/{config.r_version}/lib/R/etc/Renviron.site",
+            render_template("server-side-files/config/Renviron.site", r_version=config.r_version)
+        ))
+    files += [
+        bundle.ConfigFile(
+            "repos.conf", "/etc/rstudio/repos.conf", package_cache.repos_conf(cache),
+            service="rstudio-server"
+        ),
+        bundle.ConfigFile("pip.conf", "/etc/pip.conf", package_cache.pip_conf(cache)),
+    ]
+    return files
 
 
 def main():
@@ -75,6 +462,7 @@ def main():
     # Get configuration values
     # --------------------------------------------------------------------------
     config = ConfigValues()
+    capacity.publish(config.plan)
 
     tags = {
         "rs:environment": "development",
@@ -85,12 +473,15 @@ def main():
     # --------------------------------------------------------------------------
     # Set up keys.
     # --------------------------------------------------------------------------
-    key_pair = ec2.KeyPair(
+    stack_keys = keys.make_keys(
         "ec2 key pair",
         key_name=f"{config.email}-keypair-for-pulumi",
-        public_key=config.public_key,
         tags=tags | {"Name": f"{config.email}-key-pair"},
+        managed=config.manage_keys,
+        public_key=config.public_key,
+        algorithm=config.key_algorithm
     )
+    key_pair = stack_keys.key_pair
     
     # --------------------------------------------------------------------------
     # Make security groups
@@ -112,43 +503,54 @@ def main():
     )
     
     # --------------------------------------------------------------------------
-    # Stand up the servers
+    # Server images and artifacts
     # --------------------------------------------------------------------------
-    rsw_server_1 = make_rsw_server(
-        "1", 
-        tags=tags | {"Name": "rsw-1"},
-        key_pair=key_pair,
-        vpc_group_ids=[rsw_security_group.id]
-    )
-    rsw_server_2 = make_rsw_server(
-        "2", 
-        tags=tags | {"Name": "rsw-1"},
-        key_pair=key_pair,
-        vpc_group_ids=[rsw_security_group.id]
+    image = images.resolve_image(
+        config.bake_image, "server-side-files/justfile", r=config.r_version, rsw=RSW_URL
     )
+    artifact_cache = None
+    if config.artifact_cache:
+        artifact_cache = artifacts.ArtifactCache(max_bytes=config.artifact_cache_max_mb * 1024**2)
 
     # --------------------------------------------------------------------------
     # Create EFS.
     # --------------------------------------------------------------------------
     # Create a new file system.
-    file_system = efs.FileSystem("efs-rsw-ha",tags= tags | {"Name": "rsw-ha-efs"})
+    # Changing the performance mode replaces the file system (and its data).
+    lifecycle_policies = []
+    if config.efs_transition_to_ia:
+        lifecycle_policies = [
+            efs.FileSystemLifecyclePolicyArgs(transition_to_ia=config.efs_transition_to_ia),
+            efs.FileSystemLifecyclePolicyArgs(transition_to_primary_storage_class="AFTER_1_ACCESS"),
+        ]
+    file_system = efs.FileSystem(
+        "efs-rsw-ha",
+        throughput_mode=config.efs_throughput_mode,
+        provisioned_throughput_in_mibps=config.efs_provisioned_mibps,
+        performance_mode=config.efs_performance_mode,
+        lifecycle_policies=lifecycle_policies,
+        tags=tags | {"Name": "rsw-ha-efs"}
+    )
     pulumi.export("efs_id", file_system.id)
 
-    # Create a mount target. Assumes that the servers are on the same subnet id.
-    mount_target = efs.MountTarget(
-        f"mount-target-rsw",
-        file_system_id=file_system.id,
-        subnet_id=rsw_server_1.subnet_id,
-        security_groups=[rsw_security_group.id]
-    )
-    
+    def make_mount_target(subnet_id: pulumi.Input[str]) -> efs.MountTarget:
+        # Assumes that the servers are on the same subnet id.
+        return efs.MountTarget(
+            f"mount-target-rsw",
+            file_system_id=file_system.id,
+            subnet_id=subnet_id,
+            security_groups=[rsw_security_group.id]
+        )
+
     # --------------------------------------------------------------------------
     # Create a postgresql database.
     # --------------------------------------------------------------------------
     db = rds.Instance(
         "rsw-db",
-        instance_class="db.t3.micro",
-        allocated_storage=5,
+        instance_class=config.db_instance_class,
+        allocated_storage=config.db_allocated_storage,
+        storage_type=config.db_storage_type,
+        iops=config.db_iops,
         username="rsw_db_admin",
         password="password",
         db_name="rsw",
@@ -164,40 +566,153 @@ def main():
     pulumi.export("db_name", db.name)
     pulumi.export("db_domain", db.domain)
 
+    # --------------------------------------------------------------------------
+    # Package cache
+    # --------------------------------------------------------------------------
+    cache = package_cache.make_package_cache(
+        "rsw",
+        config.package_cache,
+        tags | {"Name": "rsw-package-cache"},
+        r_version=config.r_version,
+        python_version=PYTHON_VERSION
+    )
+
+    server_env = {
+        "EFS_ID": file_system.id,
+        "EFS_MOUNT_OPTIONS": efs_mount_options(config),
+        "PGBOUNCER": str(config.pgbouncer).lower(),
+        "HIBERNATION": str(config.hibernation.hibernate).lower(),
+        "RSW_LICENSE": config.rsw_license,
+        "R_VERSION": config.r_version,
+        "RSW_URL": RSW_URL,
+        "STORAGE_PROFILE": config.storage_profile,
+        "SITE_LIBRARY_PACKAGES": ",".join(config.site_library_packages),
+        "SITE_LIBRARY_REPO": package_cache.cran_url(cache),
+    }
+
+    # --------------------------------------------------------------------------
+    # Stand up the servers
+    # --------------------------------------------------------------------------
+    # Every node is built from the same resources and none of them depends on
+    # another node, so pulumi provisions all of the nodes in parallel.
+    node_names = [str(i) for i in range(1, config.node_count + 1)]
+
+    node_options = {}
+    if config.bootstrap == "cloud-init":
+        # The nodes provision themselves at boot, so the mount target, the
+        # database and the config files have to exist first. The nodes go in
+        # the first default subnet (the one the mount target is in) and fill
+        # in their own ip address.
+        subnet_id = sorted(ec2.get_subnets(
+            filters=[ec2.GetSubnetsFilterArgs(name="default-for-az", values=["true"])]
+        ).ids)[0]
+        mount_target = make_mount_target(subnet_id)
+        config_bundle = bundle.make_bundle(make_config_files(config, db, bundle.PUBLIC_IP, cache, substitute=True))
+        node_options = dict(
+            subnet_id=subnet_id,
+            user_data=cloudinit.user_data(
+                "configure-rsw" if image.baked else "build-rsw",
+                {".env": cloudinit.env_file(server_env)},
+                bundle_path=config_bundle.apply(lambda b: b[0])
+            ),
+            depends_on=[mount_target]
+        )
+
+    nodes = {
+        name: make_rsw_server(
+            name,
+            tags=tags | {"Name": f"rsw-{name}"},
+            key_pair=key_pair,
+            vpc_group_ids=[rsw_security_group.id],
+            image=image,
+            instance_type=config.instance_type,
+            hibernation_settings=config.hibernation,
+            **node_options
+        )
+        for name in node_names
+    }
+    servers = {name: server for name, (server, _) in nodes.items()}
+    addresses = {name: address for name, (_, address) in nodes.items()}
+    scratch_volumes = {
+        name: make_scratch_volume(
+            name, server,
+            size_gb=config.scratch_volume_gb if config.storage_profile == "tiered" else None,
+            hibernation_settings=config.hibernation,
+            node_hardware=hardware.lookup(config.instance_type),
+            tags=tags | {"Name": f"rsw-{name}-scratch"}
+        )
+        for name, server in servers.items()
+    }
+    hibernation.make_schedule("rsw", list(servers.values()), config.hibernation, tags)
+    if config.alb:
+        rsw_url = make_load_balancer(config, servers, tags)
+    else:
+        rsw_url = pulumi.Output.concat("http://", addresses[node_names[0]].public_ip, ":8787")
+    pulumi.export("rsw_url", rsw_url)
+    if config.bootstrap == "ssh":
+        mount_target = make_mount_target(servers[node_names[0]].subnet_id)
+
+    pulumi.export("rsw_nodes", [
+        {"name": name, "public_ip": address.public_ip, "public_dns": address.public_dns}
+        for name, address in addresses.items()
+    ])
+
+    # --------------------------------------------------------------------------
+    # Cloud-init: the servers provision themselves, there is nothing to push
+    # --------------------------------------------------------------------------
+    if config.bootstrap == "cloud-init":
+        if config.wait_for_ready:
+            for name, server in servers.items():
+                cloudinit.wait_until_ready(
+                    f"server-{name}-wait-for-rsw",
+                    pulumi.Output.concat("http://", addresses[name].public_ip, ":8787/"),
+                    depends_on=[server]
+                )
+        if image.needs_bake:
+            pulumi.log.warn("Golden images are only baked with bootstrap: ssh")
+        if artifact_cache is not None:
+            pulumi.log.warn("The artifact cache is only used with bootstrap: ssh")
+        return
+
     # --------------------------------------------------------------------------
     # Install required software one each server
     # --------------------------------------------------------------------------
-    for name, server in zip(
-        [1, 2],
-        [rsw_server_1, rsw_server_2]
-    ):
-        connection = remote.ConnectionArgs(
-            host=server.public_dns, 
-            user="ubuntu", 
-            private_key=Path("key.pem").read_text()
+    build_timings = {}
+    for name, server in servers.items():
+        # Only one of the servers is needed to bake the golden image.
+        bakes = image.needs_bake and name == node_names[0]
+        connection = ssh.connection(
+            host=addresses[name].public_dns,
+            user="ubuntu",
+            private_key=stack_keys.private_key,
+            multiplex=config.ssh_multiplex,
+            max_sessions=config.ssh_max_sessions
         )
 
-        command_set_environment_variables = remote.Command(
+        command_push_artifacts = []
+        if artifact_cache is not None:
+            server_artifacts = [artifacts.just_artifact()]
+            if not image.baked:
+                server_artifacts += [artifacts.r_artifact(config.r_version), artifacts.Artifact(RSW_URL)]
+            command_push_artifacts = list(artifacts.push_artifacts(
+                f"server-{name}", artifact_cache, server_artifacts, connection, depends_on=[server]
+            ).values())
+
+        command_set_environment_variables = ssh.command(
             f"server-{name}-set-env", 
-            create=pulumi.Output.concat(
-                'echo "export EFS_ID=',            file_system.id,           '" >> .env;\n',
-                'echo "export RSW_LICENSE=',       os.getenv("RSW_LICENSE"), '" >> .env;',
-            ), 
+            create=cloudinit.write_env_command(images.install_env(server_env, image, ["RSW_LICENSE"]) if bakes else server_env),
             connection=connection, 
             opts=pulumi.ResourceOptions(depends_on=[server, db, file_system])
         )
 
-        command_install_justfile = remote.Command(
+        command_install_justfile = ssh.command(
             f"server-{name}-install-justfile",
-            create="\n".join([
-                """curl --proto '=https' --tlsv1.2 -sSf https://just.systems/install.sh | bash -s -- --to ~/bin;""",
-                """echo 'export PATH="$PATH:$HOME/bin"' >> ~/.bashrc;"""
-            ]),
+            create=artifacts.install_just_command(artifact_cache),
             connection=connection, 
-            opts=pulumi.ResourceOptions(depends_on=[server])
+            opts=pulumi.ResourceOptions(depends_on=[server] + command_push_artifacts)
         )
 
-        command_copy_justfile = remote.CopyFile(
+        command_copy_justfile = ssh.copy_file(
             f"server-{name}-copy-justfile",  
             local_path="server-side-files/justfile", 
             remote_path='justfile', 
@@ -206,51 +721,96 @@ def main():
             triggers=[hash_file("server-side-files/justfile")]
         )
 
-        # Copy the server side files
-        @dataclass
-        class serverSideFile:
-            file_in: str
-            file_out: str
-            template_render_command: pulumi.Output
-
-        server_side_files = [
-            serverSideFile(
-                "server-side-files/config/database.conf",
-                "~/database.conf",
-                pulumi.Output.all(db.address).apply(lambda x: create_template("server-side-files/config/database.conf").render(db_address=x[0]))
-            ),
-            serverSideFile(
-                "server-side-files/config/load-balancer",
-                "~/load-balancer",
-                pulumi.Output.all(server.public_ip).apply(lambda x: create_template("server-side-files/config/load-balancer").render(server_ip_address=x[0]))
-            ),
-            serverSideFile(
-                "server-side-files/config/rserver.conf",
-                "~/rserver.conf",
-                pulumi.Output.all().apply(lambda x: create_template("server-side-files/config/rserver.conf").render())
+        command_copy_build_files = [
+            ssh.copy_file(
+                f"server-{name}-copy-{path.name}",
+                local_path=str(path),
+                remote_path=path.name,
+                connection=connection,
+                opts=pulumi.ResourceOptions(depends_on=[server]),
+                triggers=[hash_file(str(path))]
+            )
+            for path in [
+                SERVER_FILES_DIR / "steprunner.py",
+                SERVER_FILES_DIR / "apply_bundle.py",
+                Path("server-side-files/build-steps.json"),
+            ]
+        ]
 
-            ),
+        # Each stage only runs again when the recipes it runs or its own
+        # triggers change. The install stages are skipped on a golden image,
+        # which is taken after them and before the config files and the
+        # configure stages.
+        install_stages = [
+            steps.Stage("tools", ["install-linux-tools"]),
+            steps.Stage("efs-utils", ["build-efs-utils", "install-efs-utils"], needs=["tools"]),
+            steps.Stage("r", ["install-r", "symlink-r"], needs=["tools"], triggers=[config.r_version]),
+            steps.Stage("rsw", ["install-rsw", "backup-config-files"], needs=["tools", "r"], triggers=[RSW_URL]),
         ]
+        build_depends_on = [command_set_environment_variables, command_install_justfile, command_copy_justfile] + command_copy_build_files + command_push_artifacts
+        install_commands = steps.make_stages(
+            f"server-{name}",
+            [] if image.baked else install_stages,
+            "server-side-files/justfile",
+            connection,
+            depends_on=build_depends_on
+        )
 
-        command_copy_config_files = []
-        for f in server_side_files:
-            command_copy_config_files.append(
-                remote.Command(
-                    f"copy {f.file_out} server {name}",
-                    create=pulumi.Output.concat('echo "', f.template_render_command, f'" > {f.file_out}'),
-                    connection=connection, 
-                    opts=pulumi.ResourceOptions(depends_on=[server]),
-                    triggers=[hash_file(f.file_in)]
-                )
+        baked = []
+        if bakes:
+            golden_image = images.bake_image("rsw", server, image, tags, depends_on=list(install_commands.values()))
+            command_set_deployment_environment_variables = ssh.command(
+                f"server-{name}-set-deployment-env",
+                create=cloudinit.write_env_command(server_env),
+                connection=connection,
+                opts=pulumi.ResourceOptions(depends_on=[golden_image])
             )
-        
-        command_build_rsw = remote.Command(
-            f"server-{name}-build-rsw", 
-            # create="alias just='/home/ubuntu/bin/just'; just build-rsw", 
-            create="""export PATH="$PATH:$HOME/bin"; just build-rsw""", 
-            connection=connection, 
-            opts=pulumi.ResourceOptions(depends_on=[command_set_environment_variables, command_install_justfile, command_copy_justfile] + command_copy_config_files)
+            baked = [golden_image]
+            build_depends_on = build_depends_on + [golden_image, command_set_deployment_environment_variables]
+
+        # All config files go to the server as one bundle. Only the files that
+        # changed are installed and rstudio-server only restarts when one of
+        # them changed.
+        config_files = make_config_files(config, db, addresses[name].public_ip, cache)
+
+        command_copy_config_bundle, config_bundle_sha256 = bundle.push_bundle(
+            f"server-{name}", config_files, connection, depends_on=[server] + baked
+        )
+
+        configure_stages = [
+            steps.Stage("efs", ["setup-efs"], needs=["efs-utils"], triggers=[file_system.id, efs_mount_options(config)], depends_on=[mount_target]),
+            steps.Stage("users", ["add-users"], needs=["efs"]),
+            steps.Stage("license", ["activate-license"], needs=["rsw"], triggers=[hash_text(config.rsw_license)]),
+            steps.Stage("pgbouncer", ["install-pgbouncer"], needs=["tools"], triggers=[config.pgbouncer]),
+            steps.Stage("hibernation", ["enable-hibernation"], needs=["tools"], triggers=[config.hibernation.hibernate]),
+            steps.Stage(
+                "scratch", ["setup-scratch"], needs=["tools"], triggers=[config.storage_profile],
+                depends_on=[scratch_volumes[name]] if scratch_volumes[name] is not None else []
+            ),
+            steps.Stage(
+                "site-library", ["build-site-library"], needs=["efs", "r"],
+                triggers=[config.storage_profile, server_env["SITE_LIBRARY_PACKAGES"], server_env["SITE_LIBRARY_REPO"]]
+            ),
+            steps.Stage(
+                "config", ["apply-config"], needs=["rsw", "pgbouncer"],
+                triggers=[config_bundle_sha256],
+                depends_on=[command_copy_config_bundle]
+            ),
+            steps.Stage("restart", ["restart"], needs=["efs", "users", "license", "scratch"], after=["config"], rerun_with_needs=True),
+        ]
+        configure_commands = steps.make_stages(
+            f"server-{name}",
+            configure_stages,
+            "server-side-files/justfile",
+            connection,
+            depends_on=build_depends_on,
+            existing=install_commands
         )
+        build_commands = {**install_commands, **configure_commands}
+
+        build_timings[name] = steps.collect_timings(f"server-{name}", build_commands, connection)
+
+    pulumi.export("build_timings", build_timings)
 
 
 main()
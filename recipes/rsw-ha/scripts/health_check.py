@@ -0,0 +1,288 @@
+"""Probe every node of the cluster at once and report one table.
+
+Reads the nodes and the database from the stack outputs, then runs a small
+probe on all nodes concurrently over SSH. On each node it times:
+
+- the `/load-balancer/status` page (only served to localhost),
+- `rstudio-server list-nodes`,
+- a small write, fsync, read and delete on the EFS mount,
+- a TCP connection to the database,
+
+and reads the node's clock. The table lists the latencies per node, and the
+inconsistencies follow it: nodes that cannot be reached, failed probes, peers
+marked unreachable on a status page, nodes whose view of the cluster differs
+from the others and clocks that drift apart.
+
+    python scripts/health_check.py [--key key.pem] [--slow 1.0] [--json health.json]
+
+Checking all nodes at once takes as long as the slowest node, and shows them
+at the same moment. Only the python standard library is used.
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import shlex
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+PROBES = ["status", "list_nodes", "efs", "db"]
+
+# Run with `sudo python3 - <args>` on the node, it only uses the standard library.
+REMOTE_PROBE = r'''
+import json, os, socket, subprocess, sys, time, urllib.request
+
+args = json.loads(sys.argv[1])
+result = {}
+
+
+def timed(name, probe):
+    start = time.perf_counter()
+    try:
+        result[name] = {"value": probe()}
+    except Exception as e:
+        result[name] = {"error": f"{type(e).__name__}: {e}".strip()}
+    result[name]["seconds"] = time.perf_counter() - start
+
+
+def status():
+    with urllib.request.urlopen("http://localhost:8787/load-balancer/status", timeout=args["timeout"]) as response:
+        return response.read().decode()
+
+
+def list_nodes():
+    return subprocess.run(
+        ["rstudio-server", "list-nodes"], capture_output=True, text=True, timeout=args["timeout"], check=True
+    ).stdout
+
+
+def efs():
+    if not os.path.ismount("/mnt/efs"):
+        raise RuntimeError("/mnt/efs is not mounted")
+    directory = "/mnt/efs/.health-check"
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, socket.gethostname())
+    with open(path, "wb") as f:
+        f.write(os.urandom(4096))
+        f.flush()
+        os.fsync(f.fileno())
+    with open(path, "rb") as f:
+        f.read()
+    os.unlink(path)
+
+
+def db():
+    socket.create_connection((args["db_host"], args["db_port"]), timeout=args["timeout"]).close()
+
+
+timed("status", status)
+timed("list_nodes", list_nodes)
+timed("efs", efs)
+if args["db_host"]:
+    timed("db", db)
+result["clock"] = time.time()
+print(json.dumps(result))
+'''
+
+
+@dataclass
+class NodeHealth:
+    name: str
+    host: str
+    ssh_seconds: Optional[float] = None
+    probes: Dict[str, dict] = field(default_factory=dict)
+    clock_offset: Optional[float] = None
+    # The nodes on its status page (address -> reachable) and in list-nodes.
+    status_nodes: Dict[str, bool] = field(default_factory=dict)
+    listed_ips: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+def stack_outputs(path: Optional[str]) -> dict:
+    if path:
+        with open(path) as f:
+            return json.load(f)
+    return json.loads(subprocess.run(
+        ["pulumi", "stack", "output", "--json"], capture_output=True, text=True, check=True
+    ).stdout)
+
+
+def parse_status(text: str) -> Dict[str, bool]:
+    """The nodes on a status page and whether they are reachable:
+
+        10.0.1.12:8787  Load: 0.45, 0.17, 0.12
+           12108 - sam
+        10.0.1.34:8787 (unreachable)
+    """
+    return {
+        line.split()[0]: "unreachable" not in line
+        for line in text.splitlines() if re.match(r"^\S+:\d+", line)
+    }
+
+
+def parse_list_nodes(text: str) -> List[str]:
+    """The IPv4 addresses in the output of `rstudio-server list-nodes`."""
+    return sorted(set(re.findall(r"\b\d{1,3}(?:\.\d{1,3}){3}\b", text)))
+
+
+async def probe_node(args, node: dict, db_host: Optional[str], db_port: int) -> NodeHealth:
+    health = NodeHealth(node["name"], node["public_dns"])
+    probe_args = json.dumps({"db_host": db_host, "db_port": db_port, "timeout": args.timeout})
+    command = [
+        "ssh", "-i", args.key,
+        "-o", "StrictHostKeyChecking=no",
+        "-o", "BatchMode=yes",
+        "-o", f"ConnectTimeout={int(args.timeout)}",
+        f"ubuntu@{health.host}",
+        f"sudo python3 - {shlex.quote(probe_args)}",
+    ]
+    start = time.time()
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(REMOTE_PROBE.encode()), args.timeout * 6)
+    except asyncio.TimeoutError:
+        # Do not leave ssh running after the report.
+        process.kill()
+        await process.wait()
+        health.error = "timed out"
+        return health
+    end = time.time()
+    health.ssh_seconds = end - start
+    if process.returncode:
+        lines = stderr.decode().strip().splitlines()
+        health.error = lines[-1] if lines else f"ssh exited with {process.returncode}"
+        return health
+
+    lines = stdout.decode().strip().splitlines()
+    if not lines:
+        health.error = "the probe printed nothing"
+        return health
+    result = json.loads(lines[-1])
+    # The clock was read just before the probe exited, so this is off by about
+    # the time it takes the output to get here.
+    health.clock_offset = result.pop("clock") - end
+    health.probes = result
+    if "value" in result.get("status", {}):
+        health.status_nodes = parse_status(result["status"].pop("value"))
+    if "value" in result.get("list_nodes", {}):
+        health.listed_ips = parse_list_nodes(result["list_nodes"].pop("value"))
+    for probe in result.values():
+        probe.pop("value", None)
+    return health
+
+
+def inconsistencies(nodes: List[NodeHealth], max_clock_skew: float) -> List[str]:
+    problems = []
+    for node in nodes:
+        if node.error:
+            problems.append(f"node {node.name}: {node.error}")
+        for name, probe in node.probes.items():
+            if "error" in probe:
+                problems.append(f"node {node.name}: {name} failed: {probe['error']}")
+        unreachable = sorted(peer for peer, reachable in node.status_nodes.items() if not reachable)
+        if unreachable:
+            problems.append(f"node {node.name}: status page marks {', '.join(unreachable)} unreachable")
+
+    # Every node should see the same cluster.
+    for label, view in (
+        ("status page", lambda n: tuple(sorted(n.status_nodes))),
+        ("list-nodes", lambda n: tuple(n.listed_ips)),
+    ):
+        views: Dict[tuple, List[str]] = {}
+        for node in nodes:
+            if not node.error and view(node):
+                views.setdefault(view(node), []).append(node.name)
+        if len(views) > 1:
+            common = max(views, key=lambda v: len(views[v]))
+            for other, names in views.items():
+                if other != common:
+                    problems.append(
+                        f"{'node' if len(names) == 1 else 'nodes'} {', '.join(names)}: {label} lists {', '.join(other)}, "
+                        f"the others {', '.join(common)}"
+                    )
+
+    offsets = [n.clock_offset for n in nodes if n.clock_offset is not None]
+    if len(offsets) > 1 and max(offsets) - min(offsets) > max_clock_skew:
+        problems.append(f"clocks differ by {max(offsets) - min(offsets):.2f}s between nodes")
+    return problems
+
+
+def report(nodes: List[NodeHealth], problems: List[str], slow: float, wall: float):
+    def cell(seconds: Optional[float], failed: bool = False) -> str:
+        if failed:
+            return "FAIL"
+        if seconds is None:
+            return "-"
+        return f"{seconds * 1000:.0f}ms" + ("!" if seconds > slow else "")
+
+    columns = ["node", "ssh", "status", "list-nodes", "efs", "db", "clock", "peers"]
+    rows = []
+    for n in nodes:
+        probes = [
+            cell(n.probes[p].get("seconds"), "error" in n.probes[p]) if p in n.probes else "-"
+            for p in PROBES
+        ]
+        peers = f"{sum(n.status_nodes.values())}/{len(n.status_nodes)}" if n.status_nodes else "-"
+        clock = f"{n.clock_offset:+.2f}s" if n.clock_offset is not None else "-"
+        rows.append([n.name, cell(n.ssh_seconds, n.error is not None)] + probes + [clock, peers])
+
+    widths = [max(len(str(r[i])) for r in [columns] + rows) for i in range(len(columns))]
+    for row in [columns] + rows:
+        print("  ".join(str(v).rjust(w) if i else str(v).ljust(w) for i, (v, w) in enumerate(zip(row, widths))))
+
+    efs = [n.probes["efs"]["seconds"] for n in nodes if "seconds" in n.probes.get("efs", {})]
+    if efs:
+        print(f"\nefs median {statistics.median(efs) * 1000:.0f}ms, max {max(efs) * 1000:.0f}ms")
+    print(f"{len(nodes)} nodes probed in {wall:.1f}s, '!' is slower than {slow}s")
+    if problems:
+        print("\ninconsistencies")
+        for problem in problems:
+            print(f"  {problem}")
+
+
+async def main_async(args) -> Tuple[List[NodeHealth], List[str]]:
+    outputs = stack_outputs(args.outputs)
+    nodes = outputs["rsw_nodes"]
+    if args.only:
+        nodes = [n for n in nodes if n["name"] in args.only]
+    db_host = None if args.no_db else outputs.get("db_address")
+    db_port = int(outputs.get("db_port") or 5432)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(probe_node(args, node, db_host, db_port) for node in nodes))
+    wall = time.perf_counter() - start
+
+    problems = inconsistencies(results, args.max_clock_skew)
+    report(results, problems, args.slow, wall)
+    return results, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--key", default="key.pem", help="SSH key of the nodes")
+    parser.add_argument("--outputs", help="read the stack outputs from this json file instead of pulumi")
+    parser.add_argument("--only", nargs="+", metavar="NODE", help="only these nodes")
+    parser.add_argument("--no-db", action="store_true", help="skip the database check")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds per check")
+    parser.add_argument("--slow", type=float, default=1.0, help="mark checks slower than this many seconds")
+    parser.add_argument("--max-clock-skew", type=float, default=1.0, help="seconds that node clocks may differ")
+    parser.add_argument("--json", help="write the result of every node to this file")
+    args = parser.parse_args()
+
+    results, problems = asyncio.run(main_async(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"nodes": [asdict(r) for r in results], "inconsistencies": problems}, f, indent=2)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
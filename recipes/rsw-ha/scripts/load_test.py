@@ -0,0 +1,327 @@
+"""Check that Workbench spreads sessions across the nodes under load.
+
+Signs in as many users at once, opens a session for each of them and reports
+the sign in and session start latency percentiles. Once all sessions are
+started the `/load-balancer/status` page is read to find the node that runs
+each user's session.
+
+The users must exist on every node, see `just load-test-users`. The status
+page is only served to localhost, so pass `--status-command` to read it over
+SSH (the `just load-test` recipe does that).
+
+Run it offline against the mock server in `mock_workbench.py` with:
+
+    python scripts/load_test.py --mock 3 --users 30
+
+Only the python standard library is used.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import re
+import ssl
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urljoin, urlsplit
+
+MAX_REDIRECTS = 10
+CSRF_COOKIE = "rs-csrf-token"
+
+# ------------------------------------------------------------------------------
+# HTTP
+# ------------------------------------------------------------------------------
+
+
+@dataclass
+class Response:
+    url: str
+    status: int
+    headers: List[Tuple[str, str]]
+    body: bytes
+
+    def header(self, name: str) -> Optional[str]:
+        return next((v for k, v in self.headers if k.lower() == name.lower()), None)
+
+
+async def read_head(reader: asyncio.StreamReader) -> Tuple[str, List[Tuple[str, str]]]:
+    """The first line and the headers of an HTTP/1.1 request or response."""
+    first = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+    headers = []
+    while True:
+        line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+        if not line:
+            return first, headers
+        name, _, value = line.partition(":")
+        headers.append((name.strip(), value.strip()))
+
+
+async def read_body(reader: asyncio.StreamReader, headers: List[Tuple[str, str]], until_eof: bool) -> bytes:
+    values = {k.lower(): v for k, v in headers}
+    if values.get("transfer-encoding", "").lower() == "chunked":
+        body = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()
+                return body
+            body += await reader.readexactly(size)
+            await reader.readline()
+    if "content-length" in values:
+        return await reader.readexactly(int(values["content-length"]))
+    return await reader.read() if until_eof else b""
+
+
+class Client:
+    """A minimal HTTP client with a cookie jar, one connection per request."""
+
+    def __init__(self, base_url: str, timeout: float):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.cookies: Dict[str, str] = {}
+        # The recipes use self signed certs.
+        self.ssl = ssl.create_default_context()
+        self.ssl.check_hostname = False
+        self.ssl.verify_mode = ssl.CERT_NONE
+
+    async def _send(self, method: str, url: str, form: Optional[dict]) -> Response:
+        parts = urlsplit(url)
+        secure = parts.scheme == "https"
+        port = parts.port or (443 if secure else 80)
+        reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=self.ssl if secure else None)
+        try:
+            body = urlencode(form).encode() if form is not None else b""
+            lines = [
+                f"{method} {parts.path or '/'}{'?' + parts.query if parts.query else ''} HTTP/1.1",
+                f"Host: {parts.netloc}",
+                "Connection: close",
+                "User-Agent: rsw-ha-load-test",
+                f"Content-Length: {len(body)}",
+            ]
+            if form is not None:
+                lines.append("Content-Type: application/x-www-form-urlencoded")
+            if self.cookies:
+                lines.append("Cookie: " + "; ".join(f"{k}={v}" for k, v in self.cookies.items()))
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+            first, headers = await read_head(reader)
+            status = int(first.split()[1])
+            data = await read_body(reader, headers, until_eof=method != "HEAD")
+        finally:
+            writer.close()
+        for name, value in headers:
+            if name.lower() == "set-cookie":
+                key, _, rest = value.partition("=")
+                self.cookies[key.strip()] = rest.split(";")[0]
+        return Response(url, status, headers, data)
+
+    async def fetch(self, method: str, path: str, form: Optional[dict] = None, follow: bool = True) -> Response:
+        """Send a request and follow the redirects (unless `follow` is false)."""
+        url = urljoin(self.base_url + "/", path.lstrip("/"))
+        for _ in range(MAX_REDIRECTS):
+            response = await asyncio.wait_for(self._send(method, url, form), self.timeout)
+            location = response.header("location")
+            if not follow or response.status not in (301, 302, 303, 307, 308) or not location:
+                return response
+            url = urljoin(url, location)
+            if response.status in (301, 302, 303):
+                method, form = "GET", None
+        raise RuntimeError(f"too many redirects, last was to {url}")
+
+
+# ------------------------------------------------------------------------------
+# Sign in
+# ------------------------------------------------------------------------------
+
+
+def encrypt(public_key: str, message: str) -> str:
+    """Encrypt like the sign in page: RSA PKCS#1 v1.5 with the key served at
+    /auth-public-key ("<exponent hex>:<modulus hex>"), base64 encoded."""
+    exponent, modulus = (int(x, 16) for x in public_key.strip().split(":"))
+    size = (modulus.bit_length() + 7) // 8
+    data = message.encode()
+    if len(data) > size - 11:
+        raise ValueError("message too long for the public key")
+    padding = bytes(b % 255 + 1 for b in os.urandom(size - len(data) - 3))
+    block = int.from_bytes(b"\x00\x02" + padding + b"\x00" + data, "big")
+    return base64.b64encode(pow(block, exponent, modulus).to_bytes(size, "big")).decode()
+
+
+async def sign_in(client: Client, user: str, password: str):
+    await client.fetch("GET", "/auth-sign-in")
+    public_key = (await client.fetch("GET", "/auth-public-key")).body.decode()
+    response = await client.fetch("POST", "/auth-do-sign-in", form={
+        "persist": "0",
+        "appUri": "",
+        "clientPath": "/auth-sign-in",
+        "v": encrypt(public_key, f"{user}\n{password}"),
+        CSRF_COOKIE: client.cookies.get(CSRF_COOKIE, ""),
+    }, follow=False)
+    # The redirect is not followed, it would start the session. A failed sign
+    # in redirects back to the sign in page with an error.
+    location = response.header("location") or ""
+    if response.status not in (302, 303) or "auth-sign-in" in location:
+        raise RuntimeError(f"sign in failed ({response.status} {location})")
+
+
+# ------------------------------------------------------------------------------
+# Load test
+# ------------------------------------------------------------------------------
+
+
+@dataclass
+class Result:
+    user: str
+    sign_in_seconds: Optional[float] = None
+    session_seconds: Optional[float] = None
+    session_url: Optional[str] = None
+    node: Optional[str] = None
+    error: Optional[str] = None
+
+
+async def run_user(args, user: str, semaphore: asyncio.Semaphore) -> Result:
+    result = Result(user)
+    async with semaphore:
+        client = Client(args.url, args.timeout)
+        try:
+            start = time.perf_counter()
+            await sign_in(client, user, args.password)
+            result.sign_in_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            response = await client.fetch("GET", args.start_path)
+            if response.status != 200:
+                raise RuntimeError(f"session start returned {response.status}")
+            result.session_seconds = time.perf_counter() - start
+            result.session_url = urlsplit(response.url).path
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+async def read_status(args) -> str:
+    if args.status_command:
+        process = await asyncio.create_subprocess_shell(args.status_command, stdout=asyncio.subprocess.PIPE)
+        stdout, _ = await process.communicate()
+        if process.returncode:
+            raise RuntimeError(f"status command exited with {process.returncode}")
+        return stdout.decode()
+    return (await Client(args.url, args.timeout).fetch("GET", "/load-balancer/status")).body.decode()
+
+
+def parse_status(text: str) -> Dict[str, List[str]]:
+    """The users with a session on each node, from the status page:
+
+        10.0.1.12:8787  Load: 0.45, 0.17, 0.12
+           12108 - sam
+        10.0.1.34:8787 (unreachable)
+    """
+    nodes: Dict[str, List[str]] = {}
+    node = None
+    for line in text.splitlines():
+        if re.match(r"^\S+:\d+", line):
+            node = line.split()[0]
+            nodes[node] = []
+        elif node and (match := re.match(r"^\s+\d+\s+-\s+(\S+)", line)):
+            nodes[node].append(match.group(1))
+    return nodes
+
+
+def percentiles(values: List[float]) -> str:
+    if not values:
+        return "-"
+    values = sorted(values)
+
+    def rank(p: float) -> float:
+        return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+    return "  ".join(f"p{p} {rank(p):6.2f}s" for p in (50, 90, 99)) + f"  max {values[-1]:6.2f}s"
+
+
+def report(results: List[Result], nodes: Optional[Dict[str, List[str]]], wall: float):
+    ok = [r for r in results if not r.error]
+    print(f"{len(ok)} of {len(results)} sessions started in {wall:.1f}s")
+    print(f"sign in        {percentiles([r.sign_in_seconds for r in results if r.sign_in_seconds is not None])}")
+    print(f"session start  {percentiles([r.session_seconds for r in ok])}")
+
+    errors: Dict[str, int] = {}
+    for r in results:
+        if r.error:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    for error, count in sorted(errors.items(), key=lambda e: -e[1]):
+        print(f"  {count} x {error}")
+
+    if nodes is None:
+        return
+    print("\nsessions per node")
+    tested = {r.user for r in results}
+    for node, users in nodes.items():
+        ours = [u for u in users if u in tested]
+        print(f"  {node:<24} {len(ours):>4} {'#' * len(ours)}{f'  (+{len(users) - len(ours)} other)' if len(users) > len(ours) else ''}")
+    missing = [r.user for r in ok if r.node is None]
+    if missing:
+        print(f"  not on the status page: {len(missing)}")
+    counts = [len([u for u in users if u in tested]) for users in nodes.values()]
+    if counts and sum(counts):
+        print(f"  imbalance (max / mean): {max(counts) / (sum(counts) / len(counts)):.2f}")
+
+
+async def main_async(args) -> List[Result]:
+    users = [f"{args.user_prefix}{i}" for i in range(1, args.users + 1)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run_user(args, user, semaphore) for user in users))
+    wall = time.perf_counter() - start
+
+    nodes = None
+    try:
+        nodes = parse_status(await read_status(args))
+    except Exception as e:
+        print(f"could not read the load balancer status: {e}", file=sys.stderr)
+    if nodes:
+        node_of = {user: node for node, node_users in nodes.items() for user in node_users}
+        for r in results:
+            r.node = node_of.get(r.user)
+    report(results, nodes, wall)
+    return results
+
+
+async def run_with_mock(args) -> List[Result]:
+    from mock_workbench import MockWorkbench
+
+    mock = MockWorkbench(nodes=args.mock, password=args.password)
+    server = await mock.serve("127.0.0.1", 0)
+    args.url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    args.status_command = None
+    async with server:
+        return await main_async(args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("url", nargs="?", help="Workbench url, e.g. http://<node ip>:8787")
+    parser.add_argument("--users", type=int, default=20, help="number of users (and sessions)")
+    parser.add_argument("--concurrency", type=int, default=20, help="users starting at the same time")
+    parser.add_argument("--user-prefix", default="loadtest", help="users are <prefix>1 to <prefix><users>")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--start-path", default="/", help="path that starts a user's session")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds per request")
+    parser.add_argument("--status-command", help="shell command that prints /load-balancer/status")
+    parser.add_argument("--json", help="write the result of every user to this file")
+    parser.add_argument("--mock", type=int, metavar="NODES", help="run against a local mock with this many nodes")
+    args = parser.parse_args()
+    if not args.url and not args.mock:
+        parser.error("pass the Workbench url or --mock")
+
+    results = asyncio.run(run_with_mock(args) if args.mock else main_async(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([asdict(r) for r in results], f, indent=2)
+    sys.exit(1 if any(r.error for r in results) else 0)
+
+
+if __name__ == '__main__':
+    main()
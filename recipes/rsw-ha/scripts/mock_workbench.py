@@ -0,0 +1,164 @@
+"""A local stand-in for a Workbench cluster, to test `load_test.py` offline.
+
+Serves the endpoints the load test uses: the sign in page, the public key
+and form post of the sign in, `/` (which starts the user's session on the
+node with the fewest sessions, like `balancer=sessions`, after a delay that
+grows with the load of the node) and `/load-balancer/status`.
+
+    python scripts/mock_workbench.py --nodes 3 --port 8787
+
+Only the python standard library is used.
+"""
+
+import argparse
+import asyncio
+import base64
+import random
+import secrets
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs
+
+from load_test import CSRF_COOKIE, read_body, read_head
+
+SESSION_COOKIE = "user-id"
+
+
+def is_probable_prime(n: int, rounds: int = 20) -> bool:
+    if n < 4:
+        return n in (2, 3)
+    if n % 2 == 0:
+        return False
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d // 2, s + 1
+    for _ in range(rounds):
+        x = pow(random.randrange(2, n - 1), d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def new_rsa_key(bits: int = 1024) -> Tuple[int, int, int]:
+    """A throwaway RSA key (exponent, modulus, private exponent)."""
+    e = 65537
+    while True:
+        primes = []
+        while len(primes) < 2:
+            candidate = secrets.randbits(bits // 2) | (1 << (bits // 2 - 1)) | 1
+            if is_probable_prime(candidate) and (candidate - 1) % e:
+                primes.append(candidate)
+        p, q = primes
+        if p != q:
+            return e, p * q, pow(e, -1, (p - 1) * (q - 1))
+
+
+class MockWorkbench:
+
+    def __init__(self, nodes: int = 2, password: str = "password", start_delay: float = 0.2):
+        self.password = password
+        self.start_delay = start_delay
+        self.exponent, self.modulus, self.private = new_rsa_key()
+        self.nodes: Dict[str, List[Tuple[int, str]]] = {f"10.0.0.{i}:8787": [] for i in range(1, nodes + 1)}
+        self.signed_in: Dict[str, str] = {}
+        self.sessions: Dict[str, str] = {}
+        self.next_pid = 1000
+
+    def decrypt(self, v: str) -> str:
+        size = (self.modulus.bit_length() + 7) // 8
+        block = pow(int.from_bytes(base64.b64decode(v), "big"), self.private, self.modulus).to_bytes(size, "big")
+        return block[block.index(b"\x00", 2) + 1:].decode()
+
+    async def start_session(self, user: str) -> str:
+        if user not in self.sessions:
+            node = min(self.nodes, key=lambda n: len(self.nodes[n]))
+            self.next_pid += 1
+            self.nodes[node].append((self.next_pid, user))
+            self.sessions[user] = secrets.token_hex(4)
+            # Starting a session gets slower the busier the node is.
+            await asyncio.sleep(self.start_delay * (1 + len(self.nodes[node]) / 10) * random.uniform(0.5, 1.5))
+        return self.sessions[user]
+
+    def status(self) -> str:
+        lines = []
+        for node, sessions in self.nodes.items():
+            lines.append(f"{node}  Load: {len(sessions) / 10:.2f}, 0.00, 0.00")
+            lines += [f"   {pid} - {user}" for pid, user in sessions]
+        return "\n".join(lines) + "\n"
+
+    async def route(self, method: str, path: str, cookies: Dict[str, str], form: Dict[str, str]):
+        """Returns the status, the extra headers and the body of a response."""
+        user = self.signed_in.get(cookies.get(SESSION_COOKIE, ""))
+        if path == "/auth-sign-in":
+            return 200, [("Set-Cookie", f"{CSRF_COOKIE}={secrets.token_hex(8)}; Path=/")], b"<form>sign in</form>"
+        if path == "/auth-public-key":
+            return 200, [], f"{self.exponent:x}:{self.modulus:x}".encode()
+        if path == "/auth-do-sign-in" and method == "POST":
+            try:
+                name, password = self.decrypt(form.get("v", "")).split("\n", 1)
+            except ValueError:
+                name, password = "", None
+            if not cookies.get(CSRF_COOKIE) or form.get(CSRF_COOKIE) != cookies.get(CSRF_COOKIE) or password != self.password:
+                return 302, [("Location", "/auth-sign-in?error=2")], b""
+            token = secrets.token_hex(16)
+            self.signed_in[token] = name
+            return 302, [("Set-Cookie", f"{SESSION_COOKIE}={token}; Path=/"), ("Location", "/")], b""
+        if path == "/load-balancer/status":
+            return 200, [], self.status().encode()
+        if user is None:
+            return 302, [("Location", "/auth-sign-in")], b""
+        if path == "/":
+            return 302, [("Location", f"/s/{await self.start_session(user)}/")], b""
+        if path.startswith("/s/") and path.strip("/").split("/")[-1] == self.sessions.get(user):
+            return 200, [], b"<html>session</html>"
+        return 404, [], b"not found"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            first, headers = await read_head(reader)
+            method, target, _ = first.split(" ", 2)
+            body = await read_body(reader, headers, until_eof=False)
+            cookies = {}
+            for name, value in headers:
+                if name.lower() == "cookie":
+                    for pair in value.split(";"):
+                        key, _, v = pair.strip().partition("=")
+                        cookies[key] = v
+            form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            status, extra, content = await self.route(method, target.split("?")[0], cookies, form)
+            head = [f"HTTP/1.1 {status} X", f"Content-Length: {len(content)}", "Connection: close"]
+            head += [f"{k}: {v}" for k, v in extra]
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + content)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle, host, port)
+
+
+async def main_async(args):
+    mock = MockWorkbench(nodes=args.nodes, password=args.password, start_delay=args.start_delay)
+    server = await mock.serve(args.host, args.port)
+    print(f"mock Workbench with {args.nodes} nodes on http://{args.host}:{args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=2)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--start-delay", type=float, default=0.2, help="seconds to start a session on an idle node")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,23 @@
-from Crypto.PublicKey import RSA
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
 
 
-def main():
-    """Create a new keypair."""
+def new_ed25519_keypair():
+    """Create a new Ed25519 keypair with ssh-keygen (which takes milliseconds)."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "key")
+        subprocess.run(["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-C", "", "-f", path], check=True)
+        shutil.copyfile(path, "key.pem")
+        shutil.copyfile(path + ".pub", "key.pub")
+
+
+def new_rsa_keypair():
+    """Create a new 2048 bit RSA keypair."""
+    from Crypto.PublicKey import RSA
+
     key = RSA.generate(2048)
     private_key = key.exportKey("PEM")
     public_key = key.publickey().exportKey("OpenSSH")
@@ -12,5 +27,16 @@ def main():
         f.write(public_key.decode())
 
 
+def main():
+    """Create a new keypair."""
+    parser = argparse.ArgumentParser(description="Create key.pem and key.pub")
+    parser.add_argument("--type", choices=["ed25519", "rsa"], default="ed25519")
+    args = parser.parse_args()
+    if args.type == "ed25519":
+        new_ed25519_keypair()
+    else:
+        new_rsa_keypair()
+
+
 if __name__ == '__main__':
     main()
@@ -1,17 +1,27 @@
-from dataclasses import dataclass, field
+import sys
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
+from typing import List, Optional, Tuple
 
 import pulumi
 import pulumi_tls as tls
-import requests
-import jinja2
 from pulumi_aws import ec2
-from pulumi_command import remote
-from rich import print, inspect
-import hashlib
-from Crypto.PublicKey import RSA
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from common import SERVER_FILES_DIR, artifacts, bundle, capacity, cloudinit, hardware, hibernation, images, keys, ssh, steps, versions
+from common.templates import hash_file, hash_text, render_template
 
 
+# ------------------------------------------------------------------------------
+# Versions
+# ------------------------------------------------------------------------------
+
+R_VERSION = "4.1.2"
+PYTHON_VERSION = "3.10.4"
+# Unless `daily` is set, see versions.workbench_build.
+RSW_URL = "https://download2.rstudio.org/server/bionic/amd64/rstudio-workbench-2022.07.1-554.pro3-amd64.deb"
+
 # ------------------------------------------------------------------------------
 # Helper functions
 # ------------------------------------------------------------------------------
@@ -24,49 +34,123 @@ class ConfigValues:
     rsw_license: str = field(init=False)
     daily: bool = field(init=False)
     ssl: bool = field(init=False)
-    public_key: str = field(init=False)
+    public_key: Optional[str] = field(init=False)
+    manage_keys: bool = field(init=False)
+    key_algorithm: str = field(init=False)
+    bake_image: bool = field(init=False)
+    artifact_cache: bool = field(init=False)
+    artifact_cache_max_mb: int = field(init=False)
+    ssh_multiplex: bool = field(init=False)
+    ssh_max_sessions: int = field(init=False)
+    bootstrap: str = field(init=False)
+    wait_for_ready: bool = field(init=False)
+    instance_type: str = field(init=False)
+    r_version: str = field(init=False)
+    python_version: str = field(init=False)
+    plan: Optional[capacity.CapacityPlan] = field(init=False)
+    hibernation: hibernation.HibernationSettings = field(init=False)
+    launcher_debug_logging: bool = field(init=False)
 
     def __post_init__(self):
         self.email = self.config.require("email")
         self.rsw_license = self.config.require("rsw_license")
         self.daily = self.config.require("daily").lower() in ("yes", "true", "t", "1")
         self.ssl = self.config.require("ssl").lower() in ("yes", "true", "t", "1")
-        self.public_key = self.config.require("public_key")   
-
-
-def get_private_key(file_path: str) -> str:
-    path = Path(file_path)
-    if path.exists() == False:
-        path = path.expanduser()
-    with open(path, mode="r") as f:
-        private_key = f.read()
-    return private_key
-
-
-def get_latest_build(daily: bool) -> str:
-    if daily:
-        url = "https://dailies.rstudio.com/rstudio/latest/index.json"
-        r = requests.get(url)
-        data = r.json()
-        link = data["products"]["workbench"]["platforms"]["bionic"]["link"]
-        filename = data["products"]["workbench"]["platforms"]["bionic"]["filename"]
-    else:
-        link = "https://download2.rstudio.org/server/bionic/amd64/rstudio-workbench-2022.07.1-554.pro3-amd64.deb"
-        filename = "rstudio-workbench-2022.07.1-554.pro3-amd64.deb"
-    return (link, filename)
-
-
-def create_template(path: str) -> jinja2.Template:
-    with open(path, 'r') as f:
-        template = jinja2.Template(f.read())
-    return template
+        self.manage_keys = self.config.get_bool("manage_keys") or False
+        self.key_algorithm = self.config.get("key_algorithm") or "ed25519"
+        self.public_key = self.config.get("public_key")
+        self.bake_image = self.config.get_bool("bake_image") or False
+        self.artifact_cache = self.config.get_bool("artifact_cache") or False
+        self.artifact_cache_max_mb = self.config.get_int("artifact_cache_max_mb") or 4096
+        self.ssh_multiplex = self.config.get_bool("ssh_multiplex") or False
+        self.ssh_max_sessions = self.config.get_int("ssh_max_sessions") or 4
+        self.bootstrap = self.config.get("bootstrap") or "ssh"
+        if self.bootstrap not in cloudinit.BOOTSTRAP_MODES:
+            raise ValueError(f"bootstrap must be one of: {', '.join(cloudinit.BOOTSTRAP_MODES)}")
+        self.wait_for_ready = self.config.get_bool("wait_for_ready") or False
+        self.plan = capacity.plan_from_config(self.config, max_nodes=1)
+        self.instance_type = self.config.get("instance_type") or (
+            self.plan.instance_type if self.plan else hardware.DEFAULT_INSTANCE_TYPE
+        )
+        self.r_version = versions.r_version(self.config.get("r_version") or R_VERSION, R_VERSION)
+        self.python_version = versions.python_version(self.config.get("python_version") or PYTHON_VERSION, PYTHON_VERSION)
+        self.hibernation = hibernation.settings_from_config(self.config)
+        self.launcher_debug_logging = self.config.get_bool("launcher_debug_logging") or False
 
 
-def hash_file(path: str) -> pulumi.Output:
-    with open(path, mode="r") as f:
-        text = f.read()
-    hash_str = hashlib.sha224(bytes(text, encoding='utf-8')).hexdigest()
-    return pulumi.Output.concat(hash_str)
+def make_ssl_cert(dns_names: List[pulumi.Input[str]]) -> Tuple[tls.PrivateKey, tls.SelfSignedCert]:
+    """Create a private key and a self signed cert for `dns_names`."""
+    private_key = tls.PrivateKey(
+        "private key for ssl",
+        algorithm="RSA",
+        rsa_bits="2048"
+    )
+    cert = tls.SelfSignedCert(
+        "self signed cert for ssl",
+        private_key_pem=private_key.private_key_pem,
+        is_ca_certificate=False,
+        validity_period_hours=8760,
+        allowed_uses=[
+            "key_encipherment",
+            "digital_signature",
+            "cert_signing"
+        ],
+        dns_names=dns_names,
+        subject=tls.SelfSignedCertSubjectArgs(
+            common_name="private-ca",
+            organization="RStudio"
+        )
+    )
+    return private_key, cert
+
+
+def make_config_files(
+    config: ConfigValues,
+    ssl_key: tls.PrivateKey,
+    ssl_cert: tls.SelfSignedCert
+) -> List[bundle.ConfigFile]:
+    """The config files for the server, including the ssl files.
+
+    The launcher thread pool and the session limits are sized to the
+    instance type.
+    """
+    server_hardware = hardware.lookup(config.instance_type)
+    launcher = hardware.launcher_settings(server_hardware, debug_logging=config.launcher_debug_logging)
+    return [
+        bundle.ConfigFile(
+            "rserver.conf", "/etc/rstudio/rserver.conf",
+            render_template("server-side-files/config/rserver.conf", ssl=config.ssl),
+            service="rstudio-server"
+        ),
+        bundle.ConfigFile(
+            "launcher.conf", "/etc/rstudio/launcher.conf",
+            render_template("server-side-files/config/launcher.conf", **launcher),
+            service="rstudio-launcher"
+        ),
+        bundle.ConfigFile(
+            "launcher.local.profiles.conf", "/etc/rstudio/launcher.local.profiles.conf",
+            render_template(
+                "server-side-files/config/launcher.local.profiles.conf",
+                **launcher, **asdict(server_hardware)
+            ),
+            service="rstudio-launcher"
+        ),
+        bundle.ConfigFile(
+            "vscode.extensions.conf", "/etc/rstudio/vscode.extensions.conf",
+            render_template("server-side-files/config/vscode.extensions.conf"),
+            service="rstudio-server"
+        ),
+        bundle.ConfigFile(
+            "server.key", "/etc/ssl/server.key",
+            ssl_key.private_key_pem,
+            service="rstudio-server", mode="0600"
+        ),
+        bundle.ConfigFile(
+            "server.crt", "/etc/ssl/server.crt",
+            ssl_cert.cert_pem,
+            service="rstudio-server", mode="0600"
+        ),
+    ]
 
 
 # ------------------------------------------------------------------------------
@@ -78,6 +162,7 @@ def main():
     # Get configuration values
     # --------------------------------------------------------------------------
     config = ConfigValues()
+    capacity.publish(config.plan)
 
     tags = {
         "rs:environment": "development",
@@ -106,106 +191,135 @@ def main():
     # --------------------------------------------------------------------------
     # Stand up the servers
     # --------------------------------------------------------------------------
-    key_pair = ec2.KeyPair(
+    stack_keys = keys.make_keys(
         "ec2 key pair",
-        key_name="samedwardes-keypair-for-pulumi",
-        public_key=config.public_key,
+        key_name=f"{config.email}-keypair-for-pulumi",
         tags=tags | {"Name": f"{config.email}-key-pair"},
+        managed=config.manage_keys,
+        public_key=config.public_key,
+        algorithm=config.key_algorithm
     )
+    key_pair = stack_keys.key_pair
 
-    # Ubuntu Server 20.04 LTS (HVM), SSD Volume Type for us-east-2
-    ami_id = "ami-0fb653ca2d3203ac1"
+    rsw_url, rsw_filename = versions.workbench_build(config.daily, RSW_URL)
+    image = images.resolve_image(
+        config.bake_image, "server-side-files/justfile",
+        r=config.r_version, python=config.python_version, rsw=rsw_filename
+    )
+
+    server_env = {
+        "RSW_LICENSE": config.rsw_license,
+        "RSW_URL": rsw_url,
+        "RSW_FILENAME": rsw_filename,
+        "R_VERSION": config.r_version,
+        "PYTHON_VERSION": config.python_version,
+        "HIBERNATION": str(config.hibernation.hibernate).lower(),
+    }
+
+    # With cloud-init the server provisions itself at boot from its user data.
+    # The ssl cert is created before the server exists, so it can not name the
+    # server's host name.
+    user_data = None
+    if config.bootstrap == "cloud-init":
+        ssl_key, ssl_cert = make_ssl_cert(dns_names=[])
+        config_bundle = bundle.make_bundle(make_config_files(config, ssl_key, ssl_cert))
+        user_data = cloudinit.user_data(
+            "configure-rsw" if image.baked else "build-rsw",
+            {".env": cloudinit.env_file(server_env)},
+            bundle_path=config_bundle.apply(lambda b: b[0])
+        )
 
     rsw_server = ec2.Instance(
         f"rstudio workbench server",
-        instance_type="t3.medium",
+        instance_type=config.instance_type,
         vpc_security_group_ids=[security_group.id],
-        ami=ami_id,                 
+        ami=image.ami,
         tags=tags | {"Name": f"{config.email}-rsw-server"},
-        key_name=key_pair.key_name
+        key_name=key_pair.key_name,
+        opts=images.instance_options(image),
+        **cloudinit.instance_args(user_data),
+        **hibernation.instance_args(config.hibernation, hardware.lookup(config.instance_type))
     )
-
-    connection = remote.ConnectionArgs(
-        host=rsw_server.public_dns, 
-        user="ubuntu", 
-        private_key=Path("key.pem").read_text()
+    address = hibernation.public_address(
+        "rsw server", rsw_server, config.hibernation, tags | {"Name": f"{config.email}-rsw-server"}
+    )
+    hibernation.make_schedule("rsw", [rsw_server], config.hibernation, tags)
+
+    connection = ssh.connection(
+        host=address.public_dns,
+        user="ubuntu",
+        private_key=stack_keys.private_key,
+        multiplex=config.ssh_multiplex,
+        max_sessions=config.ssh_max_sessions
     )
 
     # Export final pulumi variables.
-    pulumi.export('rsw_public_ip', rsw_server.public_ip)
-    pulumi.export('rsw_public_dns', rsw_server.public_dns)
+    pulumi.export('rsw_public_ip', address.public_ip)
+    pulumi.export('rsw_public_dns', address.public_dns)
     pulumi.export('rsw_subnet_id', rsw_server.subnet_id)
-  
+
     # --------------------------------------------------------------------------
-    # Create a self signed cert
+    # Cloud-init: the server provisions itself, there is nothing to push
     # --------------------------------------------------------------------------
-    # Create a new private CA
-    ca_private_key = tls.PrivateKey(
-        "private key for ssl",
-        algorithm="RSA",
-        rsa_bits="2048"
-    )
+    if config.bootstrap == "cloud-init":
+        if config.wait_for_ready:
+            cloudinit.wait_until_ready(
+                "wait for rstudio workbench",
+                pulumi.Output.concat(
+                    "https://" if config.ssl else "http://",
+                    address.public_ip,
+                    "/" if config.ssl else ":8787/"
+                ),
+                depends_on=[rsw_server]
+            )
+        if image.needs_bake:
+            pulumi.log.warn("Golden images are only baked with bootstrap: ssh")
+        if config.artifact_cache:
+            pulumi.log.warn("The artifact cache is only used with bootstrap: ssh")
+        return
 
+    # --------------------------------------------------------------------------
     # Create a self signed cert
-    ca_cert = tls.SelfSignedCert(
-        "self signed cert for ssl",
-        private_key_pem=ca_private_key.private_key_pem,
-        is_ca_certificate=False,
-        validity_period_hours=8760,
-        allowed_uses=[
-            "key_encipherment",
-            "digital_signature",
-            "cert_signing"
-        ],
-        dns_names=[rsw_server.public_dns],
-        subject=tls.SelfSignedCertSubjectArgs(
-            common_name="private-ca",
-            organization="RStudio"
-        )
-    )
-
-    tls_crt_setup = remote.Command(
-        "write ~/server.crt for ssl",
-        create=pulumi.Output.concat('echo "', ca_cert.cert_pem, '" > ~/server.crt'),
-        connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[rsw_server, ca_cert, ca_private_key])
-    )
+    # --------------------------------------------------------------------------
+    ssl_key, ssl_cert = make_ssl_cert(dns_names=[address.public_dns])
 
-    tls_key_setup = remote.Command(
-        "write ~/server.key for ssl",
-        create=pulumi.Output.concat('echo "', ca_private_key.private_key_pem, '" > ~/server.key',),
-        connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[rsw_server, ca_cert, ca_private_key])
-    )
+    # --------------------------------------------------------------------------
+    # Push artifacts from the local artifact cache
+    # --------------------------------------------------------------------------
+    artifact_cache = None
+    command_push_artifacts = []
+    if config.artifact_cache:
+        artifact_cache = artifacts.ArtifactCache(max_bytes=config.artifact_cache_max_mb * 1024**2)
+        server_artifacts = [artifacts.just_artifact()]
+        if not image.baked:
+            server_artifacts += [
+                artifacts.r_artifact(config.r_version),
+                artifacts.python_artifact(config.python_version),
+                artifacts.Artifact(rsw_url),
+            ]
+        command_push_artifacts = list(artifacts.push_artifacts(
+            "server", artifact_cache, server_artifacts, connection, depends_on=[rsw_server]
+        ).values())
 
     # --------------------------------------------------------------------------
     # Install required software one each server
     # --------------------------------------------------------------------------
-    
-    rsw_url, rsw_filename = get_latest_build(config.daily)
-    
-    command_set_environment_variables = remote.Command(
+
+    command_set_environment_variables = ssh.command(
         "set environment variables", 
-        create=pulumi.Output.concat(
-            'echo "export RSW_LICENSE=', config.rsw_license, '" > .env;',
-            'echo "export RSW_URL=', rsw_url,'" >> .env;',
-            'echo "export RSW_FILENAME=', rsw_filename, '" >> .env;',
-        ), 
+        create=cloudinit.write_env_command(images.install_env(server_env, image, ["RSW_LICENSE"])),
         connection=connection, 
         opts=pulumi.ResourceOptions(depends_on=[rsw_server])
     )
 
-    command_install_justfile = remote.Command(
+    command_install_justfile = ssh.command(
         f"install justfile",
-        create="\n".join([
-            """curl --proto '=https' --tlsv1.2 -sSf https://just.systems/install.sh | bash -s -- --to ~/bin;""",
-            """echo 'export PATH="$PATH:$HOME/bin"' >> ~/.bashrc;"""
-        ]),
+        create=artifacts.install_just_command(artifact_cache),
         connection=connection,
-        opts=pulumi.ResourceOptions(depends_on=[rsw_server])
+        opts=pulumi.ResourceOptions(depends_on=[rsw_server] + command_push_artifacts)
     )
 
-    command_copy_justfile = remote.CopyFile(
+    command_copy_justfile = ssh.copy_file(
         f"copy ~/justfile",  
         local_path="server-side-files/justfile", 
         remote_path='justfile', 
@@ -214,57 +328,95 @@ def main():
         triggers=[hash_file("server-side-files/justfile")]
     )
 
+    command_copy_build_files = [
+        ssh.copy_file(
+            f"copy ~/{path.name}",
+            local_path=str(path),
+            remote_path=path.name,
+            connection=connection,
+            opts=pulumi.ResourceOptions(depends_on=[rsw_server]),
+            triggers=[hash_file(str(path))]
+        )
+        for path in [
+            SERVER_FILES_DIR / "steprunner.py",
+            SERVER_FILES_DIR / "apply_bundle.py",
+            Path("server-side-files/build-steps.json"),
+        ]
+    ]
+
+    # --------------------------------------------------------------------------
+    # Build
+    # --------------------------------------------------------------------------
+    # Each stage only runs again when the recipes it runs or its own triggers
+    # change. The install stages are skipped on a golden image, which is taken
+    # after them and before the config files and the configure stages.
+    install_stages = [
+        steps.Stage("setup", ["setup"]),
+        steps.Stage("r", ["install-r", "symlink-r"], needs=["setup"], triggers=[config.r_version]),
+        steps.Stage("python", ["install-python", "configure-python"], needs=["setup"], triggers=[config.python_version]),
+        steps.Stage("rsw", ["install-rsw", "install-vscode", "backup-config-files"], needs=["setup", "r"], triggers=[rsw_url]),
+    ]
+    build_depends_on = [
+        command_set_environment_variables,
+        command_install_justfile,
+        command_copy_justfile,
+    ] + command_copy_build_files + command_push_artifacts
+    install_commands = steps.make_stages(
+        "build",
+        [] if image.baked else install_stages,
+        "server-side-files/justfile",
+        connection,
+        depends_on=build_depends_on
+    )
+
+    baked = []
+    if image.needs_bake:
+        golden_image = images.bake_image("rsw", rsw_server, image, tags, depends_on=list(install_commands.values()))
+        command_set_deployment_environment_variables = ssh.command(
+            "set deployment environment variables",
+            create=cloudinit.write_env_command(server_env),
+            connection=connection,
+            opts=pulumi.ResourceOptions(depends_on=[golden_image])
+        )
+        baked = [golden_image]
+        build_depends_on = build_depends_on + [golden_image, command_set_deployment_environment_variables]
+
     # --------------------------------------------------------------------------
     # Config files
     # --------------------------------------------------------------------------
-    file_path_rserver = "server-side-files/config/rserver.conf"
-    copy_rserver_conf = remote.Command(
-        "copy ~/rserver.conf",
-        create=pulumi.Output.concat(
-            'echo "', 
-            pulumi.Output.all(rsw_server.public_ip).apply(lambda x: create_template(file_path_rserver).render(ssl=config.ssl)), 
-            '" > ~/rserver.conf'
-        ),
-        connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[rsw_server]),
-        triggers=[hash_file(file_path_rserver)]
-    )
-    
-    file_path_launcher = "server-side-files/config/launcher.conf"
-    copy_launcher_conf = remote.Command(
-        "copy ~/launcher.conf",
-        create=pulumi.Output.concat(
-            'echo "', 
-            pulumi.Output.all(rsw_server.public_ip).apply(lambda x: create_template(file_path_launcher).render()), 
-            '" > ~/launcher.conf'
-        ),
-        connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[rsw_server]),
-        triggers=[hash_file(file_path_launcher)]
-    )
-    
-    file_path_vscode = "server-side-files/config/vscode.extensions.conf"
-    copy_vscode_conf = remote.Command(
-        "copy ~/vscode.extensions.conf",
-        create=pulumi.Output.concat(
-            'echo "', 
-            pulumi.Output.all(rsw_server.public_ip).apply(lambda x: create_template(file_path_vscode).render()), 
-            '" > ~/vscode.extensions.conf'
-        ),
-        connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[rsw_server]),
-        triggers=[hash_file(file_path_vscode)]
+    # All config files (and the ssl files) go to the server as one bundle.
+    # Only the files that changed are installed and only the services that use
+    # them are restarted.
+    config_files = make_config_files(config, ssl_key, ssl_cert)
+
+    command_copy_config_bundle, config_bundle_sha256 = bundle.push_bundle(
+        "server", config_files, connection, depends_on=[rsw_server] + baked
     )
 
     # --------------------------------------------------------------------------
-    # Build
+    # Configure
     # --------------------------------------------------------------------------
-
-    command_build_rsw = remote.Command(
-        f"build rsw", 
-        create="""export PATH="$PATH:$HOME/bin"; just build-rsw""", 
-        connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[command_copy_justfile])
+    configure_stages = [
+        steps.Stage("users", ["add-users"]),
+        steps.Stage("license", ["activate-license"], needs=["rsw"], triggers=[hash_text(config.rsw_license)]),
+        steps.Stage(
+            "config", ["apply-config"], needs=["rsw"],
+            triggers=[config_bundle_sha256],
+            depends_on=[command_copy_config_bundle]
+        ),
+        steps.Stage("hibernation", ["enable-hibernation"], needs=["setup"], triggers=[config.hibernation.hibernate]),
+        steps.Stage("restart", ["restart"], needs=["users", "python", "license"], after=["config"], rerun_with_needs=True),
+    ]
+    configure_commands = steps.make_stages(
+        "build",
+        configure_stages,
+        "server-side-files/justfile",
+        connection,
+        depends_on=build_depends_on,
+        existing=install_commands
     )
+    build_commands = {**install_commands, **configure_commands}
+
+    pulumi.export("build_timings", steps.collect_timings("build", build_commands, connection))
 
 main()
\ No newline at end of file
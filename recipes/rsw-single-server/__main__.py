@@ -1,12 +1,23 @@
-import hashlib
+import sys
 from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Optional
 
 import pulumi
-from Crypto.PublicKey import RSA
 from pulumi_aws import ec2
-from pulumi_command import remote
-from rich import inspect, print
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from common import SERVER_FILES_DIR, artifacts, capacity, cloudinit, hardware, hibernation, images, keys, ssh, steps, versions
+from common.templates import hash_file, hash_text
+
+# ------------------------------------------------------------------------------
+# Versions
+# ------------------------------------------------------------------------------
+
+R_VERSION = "4.1.2"
+PYTHON_VERSION = "3.10.4"
+RSW_URL = "https://download2.rstudio.org/server/bionic/amd64/rstudio-workbench-2022.02.3-492.pro3-amd64.deb"
 
 # ------------------------------------------------------------------------------
 # Helper functions
@@ -18,19 +29,44 @@ class ConfigValues:
     config: pulumi.Config = field(default_factory=lambda: pulumi.Config())
     email: str = field(init=False)
     rsw_license: str = field(init=False)
-    public_key: str = field(init=False)
+    public_key: Optional[str] = field(init=False)
+    manage_keys: bool = field(init=False)
+    key_algorithm: str = field(init=False)
+    bake_image: bool = field(init=False)
+    artifact_cache: bool = field(init=False)
+    artifact_cache_max_mb: int = field(init=False)
+    ssh_multiplex: bool = field(init=False)
+    ssh_max_sessions: int = field(init=False)
+    bootstrap: str = field(init=False)
+    wait_for_ready: bool = field(init=False)
+    instance_type: str = field(init=False)
+    r_version: str = field(init=False)
+    python_version: str = field(init=False)
+    plan: Optional[capacity.CapacityPlan] = field(init=False)
+    hibernation: hibernation.HibernationSettings = field(init=False)
 
     def __post_init__(self):
         self.email = self.config.require("email")
         self.rsw_license = self.config.require("rsw_license")
-        self.public_key = self.config.require("public_key")   
-
-
-def hash_file(path: str) -> pulumi.Output:
-    with open(path, mode="r") as f:
-        text = f.read()
-    hash_str = hashlib.sha224(bytes(text, encoding='utf-8')).hexdigest()
-    return pulumi.Output.concat(hash_str)
+        self.manage_keys = self.config.get_bool("manage_keys") or False
+        self.key_algorithm = self.config.get("key_algorithm") or "ed25519"
+        self.public_key = self.config.get("public_key")
+        self.bake_image = self.config.get_bool("bake_image") or False
+        self.artifact_cache = self.config.get_bool("artifact_cache") or False
+        self.artifact_cache_max_mb = self.config.get_int("artifact_cache_max_mb") or 4096
+        self.ssh_multiplex = self.config.get_bool("ssh_multiplex") or False
+        self.ssh_max_sessions = self.config.get_int("ssh_max_sessions") or 4
+        self.bootstrap = self.config.get("bootstrap") or "ssh"
+        if self.bootstrap not in cloudinit.BOOTSTRAP_MODES:
+            raise ValueError(f"bootstrap must be one of: {', '.join(cloudinit.BOOTSTRAP_MODES)}")
+        self.wait_for_ready = self.config.get_bool("wait_for_ready") or False
+        self.plan = capacity.plan_from_config(self.config, max_nodes=1)
+        self.instance_type = self.config.get("instance_type") or (
+            self.plan.instance_type if self.plan else hardware.DEFAULT_INSTANCE_TYPE
+        )
+        self.r_version = versions.r_version(self.config.get("r_version") or R_VERSION, R_VERSION)
+        self.python_version = versions.python_version(self.config.get("python_version") or PYTHON_VERSION, PYTHON_VERSION)
+        self.hibernation = hibernation.settings_from_config(self.config)
 
 
 # ------------------------------------------------------------------------------
@@ -42,6 +78,7 @@ def main():
     # Get configuration values
     # --------------------------------------------------------------------------
     config = ConfigValues()
+    capacity.publish(config.plan)
 
     tags = {
         "rs:environment": "development",
@@ -70,59 +107,119 @@ def main():
     # --------------------------------------------------------------------------
     # Stand up the servers
     # --------------------------------------------------------------------------
-    key_pair = ec2.KeyPair(
+    stack_keys = keys.make_keys(
         "ec2 key pair",
         key_name=f"{config.email}-keypair-for-pulumi",
-        public_key=config.public_key,
         tags=tags | {"Name": f"{config.email}-key-pair"},
+        managed=config.manage_keys,
+        public_key=config.public_key,
+        algorithm=config.key_algorithm
     )
+    key_pair = stack_keys.key_pair
+
+    image = images.resolve_image(
+        config.bake_image, "server-side-files/justfile",
+        r=config.r_version, python=config.python_version, rsw=RSW_URL
+    )
+
+    server_env = {
+        "RSW_LICENSE": config.rsw_license,
+        "R_VERSION": config.r_version,
+        "PYTHON_VERSION": config.python_version,
+        "RSW_URL": RSW_URL,
+        "HIBERNATION": str(config.hibernation.hibernate).lower(),
+    }
+
+    # With cloud-init the server provisions itself at boot from its user data.
+    user_data = None
+    if config.bootstrap == "cloud-init":
+        user_data = cloudinit.user_data(
+            "configure-rsw" if image.baked else "build-rsw",
+            {".env": cloudinit.env_file(server_env)}
+        )
 
     rsw_server = ec2.Instance(
         f"rstudio workbench server",
-        instance_type="t3.medium",
+        instance_type=config.instance_type,
         vpc_security_group_ids=[security_group.id],
-        # Ubuntu Server 20.04 LTS (HVM), SSD Volume Type for us-east-2
-        ami="ami-0fb653ca2d3203ac1",                 
+        ami=image.ami,
         tags=tags | {"Name": f"{config.email}-rsw-server"},
-        key_name=key_pair.key_name
+        key_name=key_pair.key_name,
+        opts=images.instance_options(image),
+        **cloudinit.instance_args(user_data),
+        **hibernation.instance_args(config.hibernation, hardware.lookup(config.instance_type))
+    )
+    address = hibernation.public_address(
+        "rsw server", rsw_server, config.hibernation, tags | {"Name": f"{config.email}-rsw-server"}
     )
+    hibernation.make_schedule("rsw", [rsw_server], config.hibernation, tags)
 
-    connection = remote.ConnectionArgs(
-        host=rsw_server.public_dns, 
-        user="ubuntu", 
-        private_key=Path("key.pem").read_text()
+    connection = ssh.connection(
+        host=address.public_dns,
+        user="ubuntu",
+        private_key=stack_keys.private_key,
+        multiplex=config.ssh_multiplex,
+        max_sessions=config.ssh_max_sessions
     )
 
     # Export final pulumi variables.
-    pulumi.export('rsw_public_ip', rsw_server.public_ip)
-    pulumi.export('rsw_public_dns', rsw_server.public_dns)
+    pulumi.export('rsw_public_ip', address.public_ip)
+    pulumi.export('rsw_public_dns', address.public_dns)
     pulumi.export('rsw_subnet_id', rsw_server.subnet_id)
-  
+
+    # --------------------------------------------------------------------------
+    # Cloud-init: the server provisions itself, there is nothing to push
+    # --------------------------------------------------------------------------
+    if config.bootstrap == "cloud-init":
+        if config.wait_for_ready:
+            cloudinit.wait_until_ready(
+                "wait for rstudio workbench",
+                pulumi.Output.concat("http://", address.public_ip, ":8787/"),
+                depends_on=[rsw_server]
+            )
+        if image.needs_bake:
+            pulumi.log.warn("Golden images are only baked with bootstrap: ssh")
+        if config.artifact_cache:
+            pulumi.log.warn("The artifact cache is only used with bootstrap: ssh")
+        return
+
+    # --------------------------------------------------------------------------
+    # Push artifacts from the local artifact cache
+    # --------------------------------------------------------------------------
+    artifact_cache = None
+    command_push_artifacts = []
+    if config.artifact_cache:
+        artifact_cache = artifacts.ArtifactCache(max_bytes=config.artifact_cache_max_mb * 1024**2)
+        server_artifacts = [artifacts.just_artifact()]
+        if not image.baked:
+            server_artifacts += [
+                artifacts.r_artifact(config.r_version),
+                artifacts.python_artifact(config.python_version),
+                artifacts.Artifact(RSW_URL),
+            ]
+        command_push_artifacts = list(artifacts.push_artifacts(
+            "server", artifact_cache, server_artifacts, connection, depends_on=[rsw_server]
+        ).values())
 
     # --------------------------------------------------------------------------
     # Install required software one each server
     # --------------------------------------------------------------------------
     
-    command_set_environment_variables = remote.Command(
+    command_set_environment_variables = ssh.command(
         "set environment variables", 
-        create=pulumi.Output.concat(
-            'echo "export RSW_LICENSE=', config.rsw_license, '" > .env;',
-        ), 
+        create=cloudinit.write_env_command(images.install_env(server_env, image, ["RSW_LICENSE"])),
         connection=connection, 
         opts=pulumi.ResourceOptions(depends_on=[rsw_server])
     )
 
-    command_install_justfile = remote.Command(
+    command_install_justfile = ssh.command(
         f"install justfile",
-        create="\n".join([
-            """curl --proto '=https' --tlsv1.2 -sSf https://just.systems/install.sh | bash -s -- --to ~/bin;""",
-            """echo 'export PATH="$PATH:$HOME/bin"' >> ~/.bashrc;"""
-        ]),
+        create=artifacts.install_just_command(artifact_cache),
         connection=connection,
-        opts=pulumi.ResourceOptions(depends_on=[rsw_server])
+        opts=pulumi.ResourceOptions(depends_on=[rsw_server] + command_push_artifacts)
     )
 
-    command_copy_justfile = remote.CopyFile(
+    command_copy_justfile = ssh.copy_file(
         f"copy ~/justfile",  
         local_path="server-side-files/justfile", 
         remote_path='justfile', 
@@ -131,15 +228,65 @@ def main():
         triggers=[hash_file("server-side-files/justfile")]
     )
 
+    command_copy_build_files = [
+        ssh.copy_file(
+            f"copy ~/{path.name}",
+            local_path=str(path),
+            remote_path=path.name,
+            connection=connection,
+            opts=pulumi.ResourceOptions(depends_on=[rsw_server]),
+            triggers=[hash_file(str(path))]
+        )
+        for path in [SERVER_FILES_DIR / "steprunner.py", Path("server-side-files/build-steps.json")]
+    ]
+
     # --------------------------------------------------------------------------
     # Build
     # --------------------------------------------------------------------------
+    # Each stage only runs again when the recipes it runs or its own triggers
+    # change. The install stages are skipped on a golden image, which is taken
+    # after them and before the configure stages.
+    install_stages = [
+        steps.Stage("setup", ["setup"]),
+        steps.Stage("r", ["install-r", "symlink-r"], needs=["setup"], triggers=[config.r_version]),
+        steps.Stage("python", ["install-python", "configure-python"], needs=["setup"], triggers=[config.python_version]),
+        steps.Stage("rsw", ["install-rsw"], needs=["setup", "r"], triggers=[RSW_URL]),
+    ]
+    configure_stages = [
+        steps.Stage("users", ["add-users"]),
+        steps.Stage("license", ["activate-license"], needs=["rsw"], triggers=[hash_text(config.rsw_license)]),
+        steps.Stage("hibernation", ["enable-hibernation"], needs=["setup"], triggers=[config.hibernation.hibernate]),
+        steps.Stage("restart", ["restart"], needs=["users", "python", "license"], rerun_with_needs=True),
+    ]
+    build_depends_on = [command_set_environment_variables, command_install_justfile, command_copy_justfile] + command_copy_build_files + command_push_artifacts
+    install_commands = steps.make_stages(
+        "build",
+        [] if image.baked else install_stages,
+        "server-side-files/justfile",
+        connection,
+        depends_on=build_depends_on
+    )
 
-    command_build_rsw = remote.Command(
-        f"build rsw", 
-        create="""export PATH="$PATH:$HOME/bin"; just build-rsw""", 
-        connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[command_copy_justfile])
+    if image.needs_bake:
+        golden_image = images.bake_image("rsw", rsw_server, image, tags, depends_on=list(install_commands.values()))
+        command_set_deployment_environment_variables = ssh.command(
+            "set deployment environment variables",
+            create=cloudinit.write_env_command(server_env),
+            connection=connection,
+            opts=pulumi.ResourceOptions(depends_on=[golden_image])
+        )
+        build_depends_on = build_depends_on + [golden_image, command_set_deployment_environment_variables]
+
+    configure_commands = steps.make_stages(
+        "build",
+        configure_stages,
+        "server-side-files/justfile",
+        connection,
+        depends_on=build_depends_on,
+        existing=install_commands
     )
+    build_commands = {**install_commands, **configure_commands}
+
+    pulumi.export("build_timings", steps.collect_timings("build", build_commands, connection))
 
 main()